@@ -1,10 +1,12 @@
 import aiohttp
 from starlette.endpoints import HTTPEndpoint
 from starlette.requests import Request
-from starlette.responses import JSONResponse, RedirectResponse
+from starlette.responses import JSONResponse, RedirectResponse, PlainTextResponse
 
 from bridge.api.utils import get_debug_response
 from bridge.conf import settings
+from bridge.extensions import ext
+from bridge.utils.metrics import REGISTRY
 
 
 class Index(HTTPEndpoint):
@@ -17,11 +19,22 @@ class Index(HTTPEndpoint):
         member_id = request.query_params.get('member_id')
         server_domain = request.query_params.get('server_domain')
 
-        bx24 = settings.bitrix24
-        bx24.register_code(code=code)
-        bx24.scope = scope
-        bx24.domain = domain
-        bx24.server_domain = server_domain
+        pool = ext.bitrix24_pool
+        bx24 = pool.get(domain=domain, member_id=member_id)
+        if bx24 is None and domain:
+            """
+            Application installed on new portal
+            """
+            bx24 = pool.add(
+                domain=domain,
+                member_id=member_id,
+                client_id=settings.BITRIX24_CLIENT_ID,
+                client_secret=settings.BITRIX24_CLIENT_SECRET,
+            )
+        if bx24 is not None:
+            bx24.register_code(code=code)
+            bx24.scope = scope
+            bx24.server_domain = server_domain
 
         pars = {k: v for k, v in request.query_params.items()}
 
@@ -33,7 +46,7 @@ class Index(HTTPEndpoint):
 
 class Auth(HTTPEndpoint):
     async def get(self, request: Request, *args, **kwargs):
-        bx24 = settings.bitrix24
+        bx24 = ext.bitrix24
         url = bx24.resolve_authorize_endpoint()
 
         async with aiohttp.ClientSession() as session:
@@ -46,8 +59,13 @@ class Auth(HTTPEndpoint):
 class Test(HTTPEndpoint):
 
     async def get(self, request: Request, *args, **kwargs):
-        bx24 = settings.bitrix24
+        bx24 = ext.bitrix24
         r = await bx24.crm.productsection.list()
 
-        r = await r.json()
-        return JSONResponse(r)
+        return JSONResponse(r.data)
+
+
+class Metrics(HTTPEndpoint):
+
+    async def get(self, request: Request, *args, **kwargs):
+        return PlainTextResponse(REGISTRY.render(), media_type='text/plain; version=0.0.4')
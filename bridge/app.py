@@ -12,11 +12,12 @@ from starlette.routing import Route
 
 from bridge import settings
 from bridge.utils.amqp.handlers import AMQPHandler
-from bridge.utils.commands.handlers import CommandHandler
+from bridge.utils.commands.handlers import PortalCommandHandler
 from .extensions import ext
 from .routes import routes
 from .utils.amqp.amqp import RabbitMQClient
-from .utils.bitrix24.api import Bitrix24
+from .utils.bitrix24.pool import Bitrix24Pool
+from .utils.bitrix24.tokens import get_token_store
 
 
 def create_app(debug=True, cli=False) -> Starlette:
@@ -48,19 +49,38 @@ async def on_startup_event(*args, **kwargs):
     :param kwargs:
     :return:
     """
+    # all portals share one connections pool, each portal has own rate limiter
+    ext.bitrix24_pool = Bitrix24Pool(
+        connections=settings.BITRIX24_POOL_CONNECTIONS,
+        connections_per_host=settings.BITRIX24_POOL_CONNECTIONS_PER_HOST,
+        token_store=get_token_store(
+            settings.BITRIX24_TOKEN_STORE,
+            path=settings.BITRIX24_TOKEN_FILE,
+            url=settings.DATABASE['url'],
+        ),
+    )
+
     # TODO maybe need load from db
-    ext.bitrix24 = Bitrix24(
+    ext.bitrix24 = ext.bitrix24_pool.add(
         code=settings.BITRIX24_CODE,
         domain=settings.BITRIX24_DOMAIN,
+        member_id=settings.BITRIX24_MEMBER_ID or None,
         client_id=settings.BITRIX24_CLIENT_ID,
         client_secret=settings.BITRIX24_CLIENT_SECRET,
         access_token=settings.BITRIX24_ACCESS_TOKEN,
         refresh_token=settings.BITRIX24_REFRESH_TOKEN,
         webhook_code=settings.BITRIX24_WEBHOOK_CODE,
         use_webhook=True,
+        default=True,
     )
 
-    ext.command_handler = CommandHandler(ext.bitrix24)
+    for portal in settings.BITRIX24_PORTALS:
+        ext.bitrix24_pool.add(**portal)
+
+    # tokens saved before restart
+    await ext.bitrix24_pool.load_tokens()
+
+    ext.command_handler = PortalCommandHandler(ext.bitrix24_pool)
 
     ext.loop = asyncio.get_running_loop()
 
@@ -89,9 +109,9 @@ async def on_shutdown_event(*args, **kwargs):
     :return:
     """
     # close Http Session connection
-    ext.bitrix24.close()
+    await ext.bitrix24_pool.close()
     # close AMQP connection
-    ext.amqp_client.close()
+    await ext.amqp_client.close()
 
 
 def configure_logger(loop):
@@ -4,11 +4,13 @@ from bridge.api.views import (
     Index,
     Test,
     Auth,
+    Metrics,
 )
 
 routes = [
     Route(r'/', endpoint=Index, methods=["GET", "POST"]),
     Route(r'/test', endpoint=Test, methods=["GET", ]),
     Route(r'/auth', endpoint=Auth, methods=["GET", ]),
+    Route(r'/metrics', endpoint=Metrics, methods=["GET", ]),
 
 ]
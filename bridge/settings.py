@@ -47,11 +47,91 @@ RABBITMQ_QUEUE_DURABLE = env.bool("RABBITMQ_QUEUE_DURABLE", True)
 RABBITMQ_EXCHANGE_DURABLE = env.bool("RABBITMQ_EXCHANGE_DURABLE", True)
 RABBITMQ_EXCHANGE_TYPE = env.str("RABBITMQ_EXCHANGE_TYPE", "TOPIC")
 RABBITMQ_COMMAND_QUEUE = env.str('RABBITMQ_COMMAND_QUEUE', "bitrix24-command")
+# x-max-priority of command queue, 0 - queue without priorities
+# (RabbitMQ doesn't change arguments of existing queue, it should be recreated)
+RABBITMQ_COMMAND_QUEUE_MAX_PRIORITY = env.int('RABBITMQ_COMMAND_QUEUE_MAX_PRIORITY', 0)
 
 RABBITMQ_URL = env.str("RABBITMQ_URL", None)
 
-REQUESTS_PER_PERIOD = env.int('REQUESTS_PER_PERIOD', 100)
-REQUESTS_PERIOD = env.int('REQUESTS_PERIOD', 15)
+# max count of unacknowledged command messages, should be more than COMMAND_WORKERS,
+# else commands waiting for action limit hold prefetch window
+RABBITMQ_PREFETCH_COUNT = env.int("RABBITMQ_PREFETCH_COUNT", 20)
+
+# wait broker confirms for published messages
+RABBITMQ_PUBLISHER_CONFIRMS = env.bool("RABBITMQ_PUBLISHER_CONFIRMS", True)
+# send buffer: messages published by groups of RABBITMQ_PUBLISH_BUFFER_SIZE (0 - without buffer)
+# or after RABBITMQ_PUBLISH_FLUSH_INTERVAL seconds
+RABBITMQ_PUBLISH_BUFFER_SIZE = env.int("RABBITMQ_PUBLISH_BUFFER_SIZE", 0)
+RABBITMQ_PUBLISH_FLUSH_INTERVAL = env.float("RABBITMQ_PUBLISH_FLUSH_INTERVAL", 0.05)
+# compression of sent messages (gzip, deflate or empty), messages less than RABBITMQ_COMPRESSION_THRESHOLD bytes
+# are sent as is, content_encoding of compressed message is set to algorithm
+RABBITMQ_COMPRESSION = env.str("RABBITMQ_COMPRESSION", "")
+RABBITMQ_COMPRESSION_THRESHOLD = env.int("RABBITMQ_COMPRESSION_THRESHOLD", 64 * 1024)
+RABBITMQ_COMPRESSION_LEVEL = env.int("RABBITMQ_COMPRESSION_LEVEL", 1)
+# default format of sent messages: application/json, application/msgpack,
+# application/vnd.bridge.columnar+json or application/vnd.bridge.columnar+msgpack, command meta.accept overrides it
+RABBITMQ_CONTENT_TYPE = env.str("RABBITMQ_CONTENT_TYPE", "application/json")
+# max body size of sent message in bytes (RabbitMQ max_message_size is 16MB by default since 4.0),
+# larger message is published as ordered chunks with x-chunk-index, x-chunk-count headers, 0 - without limit
+RABBITMQ_MAX_MESSAGE_SIZE = env.int("RABBITMQ_MAX_MESSAGE_SIZE", 16 * 1024 * 1024)
+
+# max count of commands processed in parallel
+COMMAND_WORKERS = env.int("COMMAND_WORKERS", 10)
+# max count of commands processed in parallel for action, other actions limited by COMMAND_WORKERS only
+COMMAND_ACTION_WORKERS = {
+    action: int(count)
+    for action, count in env.dict("COMMAND_ACTION_WORKERS", {'list': 2, 'keyset': 2, 'batch': 4}).items()
+}
+
+# Bitrix24 leaky bucket: burst size and requests per second
+REQUESTS_BUCKET_SIZE = env.int('REQUESTS_BUCKET_SIZE', 50)
+REQUESTS_LEAK_RATE = env.float('REQUESTS_LEAK_RATE', 2)
+# directory (e.g. /dev/shm) of rate limit state shared by processes of host (gunicorn workers), empty - per process
+REQUESTS_SHARED_DIR = env.str('REQUESTS_SHARED_DIR', '')
+# requests waiting free slot are served by command priority, waiting request gains
+# REQUESTS_PRIORITY_AGING priority points per second, so bulk commands still make progress (0 - strict priority)
+REQUESTS_PRIORITY_AGING = env.float('REQUESTS_PRIORITY_AGING', 1)
+# under contention requests are shared by flows (meta.producer or entity of command) with deficit round robin,
+# flow weight - share of requests, e.g. crm.deal=1,reports=3, other flows have weight 1
+REQUESTS_FLOW_WEIGHTS = {
+    flow: float(weight)
+    for flow, weight in env.dict('REQUESTS_FLOW_WEIGHTS', {}).items()
+}
+
+# max count of batch requests from one command processed in parallel
+COMMAND_BATCH_CONCURRENCY = env.int('COMMAND_BATCH_CONCURRENCY', 5)
+# max size of encoded sub commands in one batch request, bytes
+COMMAND_BATCH_MAX_SIZE = env.int('COMMAND_BATCH_MAX_SIZE', 1000000)
+
+# retry with exponential backoff and full jitter: delay is random in [0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt)]
+COMMAND_RETRY_MAX_COUNT = env.int('COMMAND_RETRY_MAX_COUNT', 3)
+COMMAND_RETRY_BASE_DELAY = env.float('COMMAND_RETRY_BASE_DELAY', 0.5)
+COMMAND_RETRY_MAX_DELAY = env.float('COMMAND_RETRY_MAX_DELAY', 30)
+# max retries count for all requests of one command
+COMMAND_RETRY_BUDGET = env.int('COMMAND_RETRY_BUDGET', 10)
+
+# identical concurrent read only commands (get, list, fields) share one request
+COMMAND_COALESCE_ENABLED = env.bool('COMMAND_COALESCE_ENABLED', True)
+
+# default commands, which arrive in COMMAND_AUTO_BATCH_WINDOW seconds, are sent by one batch request
+COMMAND_AUTO_BATCH_ENABLED = env.bool('COMMAND_AUTO_BATCH_ENABLED', False)
+COMMAND_AUTO_BATCH_WINDOW = env.float('COMMAND_AUTO_BATCH_WINDOW', 0.05)
+COMMAND_AUTO_BATCH_SIZE = env.int('COMMAND_AUTO_BATCH_SIZE', 50)
+
+# cache for responses of read only methods, used by default action only
+COMMAND_CACHE_ENABLED = env.bool('COMMAND_CACHE_ENABLED', False)
+# max sum of cached responses size in bytes
+COMMAND_CACHE_MAX_SIZE = env.int('COMMAND_CACHE_MAX_SIZE', 64 * 1024 * 1024)
+# seconds for method type or method name, methods without ttl are not cached
+COMMAND_CACHE_TTL = {
+    method: float(ttl)
+    for method, ttl in env.dict('COMMAND_CACHE_TTL', {'fields': 3600, 'get': 60, 'list': 30}).items()
+}
+
+# methods of commands in metrics labels, other methods are labeled "other"
+METRICS_COMMAND_METHODS = env.list('METRICS_COMMAND_METHODS', [], subcast=str)
+# if METRICS_COMMAND_METHODS is empty, first methods are labeled by name up to this count
+METRICS_COMMAND_METHODS_MAX = env.int('METRICS_COMMAND_METHODS_MAX', 200)
 
 # Bitrix24 Settings
 
@@ -63,6 +143,19 @@ BITRIX24_ACCESS_TOKEN = env.str("BITRIX24_ACCESS_TOKEN", '')
 BITRIX24_REFRESH_TOKEN = env.str("BITRIX24_REFRESH_TOKEN", '')
 BITRIX24_WEBHOOK_CODE = env.str("BITRIX24_WEBHOOK_CODE", '')
 BITRIX24_USE_WEBHOOK = env.bool("BITRIX24_USE_WEBHOOK", True)
+BITRIX24_MEMBER_ID = env.str("BITRIX24_MEMBER_ID", '')
+
+# seconds before access token expiration, when it is refreshed
+BITRIX24_TOKEN_REFRESH_MARGIN = env.float("BITRIX24_TOKEN_REFRESH_MARGIN", 300)
+# persistent token store: file, database (DATABASE) or empty - tokens are not saved
+BITRIX24_TOKEN_STORE = env.str("BITRIX24_TOKEN_STORE", '')
+BITRIX24_TOKEN_FILE = env.str("BITRIX24_TOKEN_FILE", os.path.join(BASE_DIR, '.tokens.json'))
+
+# other portals, json list of Bitrix24 kwargs, e.g. [{"domain": "...", "member_id": "...", "webhook_code": "..."}]
+BITRIX24_PORTALS = env.json("BITRIX24_PORTALS", '[]')
+# connections pool shared by all portals, 0 - unlimited
+BITRIX24_POOL_CONNECTIONS = env.int("BITRIX24_POOL_CONNECTIONS", 100)
+BITRIX24_POOL_CONNECTIONS_PER_HOST = env.int("BITRIX24_POOL_CONNECTIONS_PER_HOST", 0)
 
 
 LOGGING_DIR = os.path.join(BASE_DIR, '.logs')
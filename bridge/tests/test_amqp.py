@@ -0,0 +1,392 @@
+import asyncio
+import collections
+import gzip
+import logging
+
+import pytest
+import ujson
+
+from bridge.extensions import ext
+from bridge.tests.test_commands import FakeKeysetBitrix24
+from bridge.utils.amqp.amqp import PublishBuffer, RabbitMQClient
+from bridge.utils.amqp.chunks import ChunkAssembler, chunk_messages
+from bridge.utils.amqp.compression import compress, decompress
+from bridge.utils.amqp.handlers import AMQPHandler
+from bridge.utils.amqp.serializers import (
+    COLUMNAR_JSON_CONTENT_TYPE, get_serializer, to_columns, UnsupportedContentType,
+)
+from bridge.utils.bench import mix_commands, parse_mix, run_memory_bench
+from bridge.utils.bitrix24.limiter import current_priority
+from bridge.utils.commands.handlers import CommandHandler
+
+
+class FakeIncomingMessage:
+    def __init__(self, data: dict, **properties):
+        self.body = ujson.dumps(data).encode()
+        self.headers = {}
+        for name, value in properties.items():
+            setattr(self, name, value)
+
+    def process(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class FakeMessageClient:
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, message, **kwargs):
+        self.messages.append(message)
+
+    async def flush(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def fixture_logger():
+    ext.logger = logging.getLogger('bitrix24-bridge-tests')
+
+
+@pytest.mark.asyncio
+async def test_handle_stream():
+    client = FakeMessageClient()
+    handler = AMQPHandler(client=client, command_handler=CommandHandler(FakeKeysetBitrix24(items_count=120)))
+
+    await handler.handle(FakeIncomingMessage({
+        'action': 'keyset',
+        'method': 'crm.product.list',
+        'meta': {'stream': True, 'id': 42},
+    }))
+
+    assert [message['stream']['seq'] for message in client.messages] == [0, 1, 2]
+    assert [message['stream']['offset'] for message in client.messages] == [0, 50, 120]
+    assert [message['stream']['done'] for message in client.messages] == [False, False, True]
+    assert [len(message['result'][0]['result']) for message in client.messages] == [50, 70, 0]
+
+    last = client.messages[-1]
+    assert last['entity'] == 'crm.product'
+    assert last['result'][0]['total'] == 120
+    assert last['result'][0]['meta'] == {'stream': True, 'id': 42}
+    assert last['stream']['error'] is None
+
+
+class SlowCommandHandler:
+    def __init__(self):
+        self.in_flight = collections.Counter()
+        self.max_in_flight = collections.Counter()
+
+    async def __call__(self, data):
+        action = data['action']
+        self.in_flight[action] += 1
+        self.in_flight['total'] += 1
+        self.max_in_flight[action] = max(self.max_in_flight[action], self.in_flight[action])
+        self.max_in_flight['total'] = max(self.max_in_flight['total'], self.in_flight['total'])
+        await asyncio.sleep(0.01)
+        self.in_flight[action] -= 1
+        self.in_flight['total'] -= 1
+        return []
+
+
+@pytest.mark.asyncio
+async def test_handle_workers_limits():
+    command_handler = SlowCommandHandler()
+    handler = AMQPHandler(
+        client=FakeMessageClient(),
+        command_handler=command_handler,
+        workers=4,
+        action_workers={'list': 1}
+    )
+
+    messages = [
+        FakeIncomingMessage({'action': action, 'method': 'crm.product.list'})
+        for action in ['list'] * 5 + ['default'] * 10
+    ]
+
+    await asyncio.gather(*[handler.handle(message) for message in messages])
+
+    assert command_handler.max_in_flight['list'] == 1
+    assert command_handler.max_in_flight['total'] == 4
+
+
+@pytest.mark.asyncio
+async def test_handle_priority():
+    priorities = []
+
+    async def command_handler(data):
+        priorities.append(current_priority.get())
+        return []
+
+    handler = AMQPHandler(client=FakeMessageClient(), command_handler=command_handler)
+
+    await handler.handle(FakeIncomingMessage({'action': 'default', 'method': 'crm.product.get'}, priority=7))
+    await handler.handle(FakeIncomingMessage(
+        {'action': 'default', 'method': 'crm.product.get', 'meta': {'priority': '2'}}, priority=7,
+    ))
+    await handler.handle(FakeIncomingMessage({'action': 'default', 'method': 'crm.product.get'}))
+
+    # meta.priority overrides message priority, priority is reset after command
+    assert priorities == [7, 2, 0]
+
+
+def test_compression():
+    body = ujson.dumps([{'ID': str(i), 'NAME': 'product'} for i in range(1000)]).encode()
+
+    # small message is sent as is
+    assert compress(body[:100], 'gzip', threshold=1024) == (body[:100], None)
+    assert compress(body, '', threshold=0) == (body, None)
+
+    for encoding in ['gzip', 'deflate']:
+        compressed, content_encoding = compress(body, encoding, threshold=1024)
+        assert content_encoding == encoding
+        assert len(compressed) < len(body) / 5
+        assert decompress(compressed, content_encoding) == body
+
+    # not compression encoding
+    assert decompress(body, 'utf-8') == body
+
+
+@pytest.mark.asyncio
+async def test_send_compressed():
+    client = RabbitMQClient(buffer_size=0, compression='gzip', compression_threshold=1024)
+    published = []
+
+    async def publish(message, routing_key):
+        published.append(message)
+
+    client.publish = publish
+
+    await client.send({'result': 'small'})
+    await client.send({'result': ['product'] * 1000})
+
+    assert published[0].content_encoding is None
+    assert ujson.loads(published[0].body) == {'result': 'small'}
+    assert published[1].content_encoding == 'gzip'
+    assert ujson.loads(gzip.decompress(published[1].body)) == {'result': ['product'] * 1000}
+
+
+@pytest.mark.asyncio
+async def test_handle_compressed():
+    received = []
+
+    async def command_handler(data):
+        received.append(data)
+        return []
+
+    handler = AMQPHandler(client=FakeMessageClient(), command_handler=command_handler)
+    data = {'action': 'default', 'method': 'crm.product.get', 'params': {'id': 1}}
+    message = FakeIncomingMessage(data, content_encoding='gzip')
+    message.body = gzip.compress(message.body)
+
+    await handler.handle(message)
+
+    assert received == [data]
+
+
+def test_serializers():
+    data = {
+        'entity': 'crm.product',
+        'result': [{'ID': str(i), 'NAME': f"product {i}", 'PRICE': None} for i in range(100)],
+        'other': [{'ID': '1'}, {'NAME': 'product'}, 1],
+    }
+
+    assert to_columns(data)['result']['$columns'] == ['ID', 'NAME', 'PRICE']
+    assert to_columns(data)['result']['$rows'][1] == ['1', 'product 1', None]
+    # records with different fields are not changed
+    assert to_columns(data)['other'] == data['other']
+
+    json_serializer = get_serializer()
+    columnar = get_serializer(COLUMNAR_JSON_CONTENT_TYPE)
+    assert get_serializer('application/json; charset=utf-8') is json_serializer
+    assert columnar.loads(columnar.dumps(data)) == data
+    assert len(columnar.dumps(data)) < len(json_serializer.dumps(data)) * 0.6
+
+    # dicts with columnar keys in data are not mixed up with columnar lists
+    data = {
+        'fields': {'$columns': ['a'], '$rows': [[1]]},
+        'result': [{'$rows': 1, 'ID': '1'}, {'$rows': 2, 'ID': '2'}],
+        '$$key': {'$columns': 1},
+    }
+    assert to_columns(data)['fields'] == {'$$columns': ['a'], '$$rows': [[1]]}
+    assert columnar.loads(columnar.dumps(data)) == data
+
+    with pytest.raises(UnsupportedContentType):
+        get_serializer('application/xml')
+
+
+def test_msgpack_serializer():
+    data = {'result': [{'ID': str(i), 'NAME': f"product {i}"} for i in range(100)]}
+    for content_type in ['application/msgpack', 'application/vnd.bridge.columnar+msgpack']:
+        serializer = get_serializer(content_type)
+        assert serializer.loads(serializer.dumps(data)) == data
+
+
+class ContentTypeMessageClient(FakeMessageClient):
+    def __init__(self):
+        super().__init__()
+        self.content_types = []
+
+    async def send(self, message, content_type=None):
+        self.messages.append(message)
+        self.content_types.append(content_type)
+
+
+@pytest.mark.asyncio
+async def test_handle_content_type():
+    received = []
+
+    async def command_handler(data):
+        received.append(data)
+        return []
+
+    client = ContentTypeMessageClient()
+    handler = AMQPHandler(client=client, command_handler=command_handler)
+
+    data = {
+        'action': 'batch', 'method': 'batch',
+        'params': {'cmd': [{'method': 'crm.product.get', 'id': 1}, {'method': 'crm.product.get', 'id': 2}]},
+        'meta': {'accept': COLUMNAR_JSON_CONTENT_TYPE},
+    }
+    message = FakeIncomingMessage({}, content_type=COLUMNAR_JSON_CONTENT_TYPE)
+    message.body = get_serializer(COLUMNAR_JSON_CONTENT_TYPE).dumps(data)
+    await handler.handle(message)
+
+    await handler.handle(FakeIncomingMessage({'method': 'crm.product.get', 'meta': {'accept': 'application/xml'}}))
+
+    assert received[0] == data
+    # unsupported format - client default
+    assert client.content_types == [COLUMNAR_JSON_CONTENT_TYPE, None]
+
+
+def test_chunk_assembler():
+    data = {'result': [{'ID': str(i), 'NAME': f"product {i}"} for i in range(1000)]}
+    body = ujson.dumps(data).encode()
+
+    small = chunk_messages(body, len(body), content_type='application/json')
+    assert len(small) == 1 and small[0].correlation_id is None
+
+    chunks = chunk_messages(body, 1000, content_type='application/json')
+    other = chunk_messages(body, 10000, content_type='application/json')
+    assert len(chunks) == len(body) // 1000 + 1
+    assert len({message.correlation_id for message in chunks}) == 1
+    assert all(len(message.body) <= 1000 for message in chunks)
+
+    assembler = ChunkAssembler()
+    # chunks of two messages interleaved and out of order
+    assert assembler.feed(chunks[-1]) is None
+    assert [assembler.feed(message) for message in other] == [None] * (len(other) - 1) + [data]
+    results = [assembler.feed(message) for message in chunks[:-1]]
+    assert results[-1] == data and results[:-1] == [None] * (len(chunks) - 2)
+    assert len(assembler) == 0
+
+    assert assembler.feed(small[0]) == data
+
+    # incomplete message is dropped after ttl
+    assembler = ChunkAssembler(ttl=0)
+    assembler.feed(chunks[0])
+    assembler.feed(other[0])
+    assert len(assembler) == 1
+    assert assembler.dropped == 1
+
+
+@pytest.mark.asyncio
+async def test_send_chunked():
+    client = RabbitMQClient(buffer_size=0, compression='gzip', compression_threshold=1024, max_message_size=1024)
+    published = []
+
+    async def publish(message, routing_key):
+        published.append(message)
+
+    client.publish = publish
+
+    data = {'result': [{'ID': str(i), 'NAME': f"product {i}"} for i in range(10000)]}
+    await client.send(data)
+
+    # compressed body is split
+    assert len(published) > 1
+    assert all(message.content_encoding == 'gzip' for message in published)
+
+    assembler = ChunkAssembler()
+    assert [assembler.feed(message) for message in published][-1] == data
+
+
+@pytest.mark.asyncio
+async def test_handle_waits_buffered_publish():
+    client = RabbitMQClient(buffer_size=10, flush_interval=0.01, max_message_size=0)
+    published = []
+    flushes = []
+
+    async def publish(message, routing_key):
+        await asyncio.sleep(0.02)
+        if b'crm.b' in message.body:
+            raise ConnectionError('nack')
+        published.append(ujson.loads(message.body)['entity'])
+
+    flush = client.buffer.flush
+
+    async def counted_flush():
+        flushes.append(len(client.buffer))
+        await flush()
+
+    client.buffer._publish = publish
+    client.buffer.flush = counted_flush
+
+    async def command_handler(data):
+        return []
+
+    handler = AMQPHandler(client=client, command_handler=command_handler, workers=2)
+
+    async def handle(method):
+        await handler.handle(FakeIncomingMessage({'action': 'default', 'method': method}))
+        # command is acked only after its result is published
+        assert method.rsplit('.', 1)[0] in published
+
+    results = await asyncio.gather(handle('crm.a.get'), handle('crm.b.get'), return_exceptions=True)
+
+    assert results[0] is None
+    # publish error of result is not lost, command is not acked
+    assert isinstance(results[1], ConnectionError)
+    # results of concurrent commands are published by one flush of buffer
+    assert flushes == [2]
+
+
+@pytest.mark.asyncio
+async def test_publish_buffer():
+    published = []
+
+    async def publish(message, routing_key):
+        await asyncio.sleep(0.01)
+        published.append(message)
+        return message
+
+    buffer = PublishBuffer(publish=publish, max_size=3, flush_interval=0.01)
+
+    futures = [await buffer.put(i, 'routing_key') for i in range(4)]
+
+    # first group flushed on size, messages published in parallel
+    assert published == [0, 1, 2]
+    assert [future.result() for future in futures[:3]] == [0, 1, 2]
+    assert len(buffer) == 1
+
+    # last message flushed on time
+    assert await futures[3] == 3
+    assert published == [0, 1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_memory_bench():
+    commands = mix_commands(parse_mix('list=1,batch=1,default=3'), 40, batch_size=60, items_count=200)
+    assert {command['action'] for command in commands} == {'list', 'batch', 'default'}
+
+    result = await run_memory_bench(
+        commands, prefetch_count=5, workers=3, bucket_size=50, leak_rate=1000, entities={'crm.product': 200},
+    )
+
+    assert result.errors == 0
+    assert len(result.latencies) == 40
+    assert result.upstream_requests >= 40
@@ -1,6 +1,25 @@
+import asyncio
+import multiprocessing
+import time
+
 import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 
-from bridge.utils.bitrix24.utils import bitrix_urlencode, get_request_params, prepare_batch
+from bridge.utils.bitrix24.api import Bitrix24
+from bridge.utils.bitrix24.drivers import HttpDriver
+from bridge.utils.bitrix24.exceptions import UnknownPortal
+from bridge.utils.bitrix24.limiter import LeakyBucket, SharedLeakyBucket, current_priority
+from bridge.utils.bitrix24.pool import Bitrix24Pool
+from bridge.utils.bitrix24.tokens import FileTokenStore
+from bridge.utils.bitrix24.utils import (
+    bitrix_urlencode,
+    get_request_params,
+    pack_batches,
+    prepare_batch,
+    prepare_list_calls,
+    Response,
+)
 
 
 @pytest.fixture
@@ -79,3 +98,359 @@ def test_prepare_batch(fixture_batch_commands):
         assert isinstance(v, (str, ))
 
 
+
+
+@pytest.mark.asyncio
+async def test_leaky_bucket_burst_and_leak():
+    bucket = LeakyBucket(capacity=3, leak_rate=50)
+
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+
+    for _ in range(3):
+        await bucket.acquire()
+
+    # burst passed without waiting
+    assert loop.time() - started < 0.01
+
+    for _ in range(5):
+        await bucket.acquire()
+
+    # 5 requests over capacity leaks with 50 req/s
+    assert 0.08 <= loop.time() - started < 0.2
+
+    bucket.close()
+
+
+@pytest.mark.asyncio
+async def test_leaky_bucket_fifo():
+    bucket = LeakyBucket(capacity=1, leak_rate=100)
+    order = []
+
+    async def worker(i):
+        await bucket.acquire()
+        order.append(i)
+
+    await asyncio.gather(*[worker(i) for i in range(10)])
+
+    assert order == list(range(10))
+
+    bucket.close()
+
+
+@pytest.mark.asyncio
+async def test_leaky_bucket_priority():
+    bucket = LeakyBucket(capacity=1, leak_rate=100)
+    order = []
+
+    async def worker(i, priority):
+        current_priority.set(priority)
+        await bucket.acquire()
+        order.append(i)
+
+    await bucket.acquire()
+    tasks = [asyncio.ensure_future(worker(i, priority)) for i, priority in enumerate([0, 5, 0, 10, 5])]
+    cancelled = asyncio.ensure_future(bucket.acquire(priority=20))
+    await asyncio.sleep(0)
+    assert bucket.waiting == 6
+
+    cancelled.cancel()
+    await asyncio.gather(*tasks)
+
+    # higher priority first, FIFO within priority, cancelled waiter skipped
+    assert order == [3, 1, 4, 0, 2]
+    assert bucket.waiting == 0
+
+    bucket.close()
+
+
+@pytest.mark.asyncio
+async def test_leaky_bucket_priority_aging():
+    async def run(aging):
+        bucket = LeakyBucket(capacity=1, leak_rate=10, aging=aging)
+        order = []
+
+        async def worker(name, priority):
+            await bucket.acquire(priority=priority)
+            order.append(name)
+
+        await bucket.acquire()
+        bulk = asyncio.ensure_future(worker('bulk', 0))
+        await asyncio.sleep(0.05)
+        urgent = asyncio.ensure_future(worker('urgent', 3))
+        await asyncio.gather(bulk, urgent)
+
+        bucket.close()
+        return order
+
+    assert await run(aging=0) == ['urgent', 'bulk']
+    # bulk waited 0.05s and gained 5 points
+    assert await run(aging=100) == ['bulk', 'urgent']
+
+
+@pytest.mark.asyncio
+async def test_leaky_bucket_fair_share():
+    bucket = LeakyBucket(capacity=1, leak_rate=200, weights={'b': 2})
+    order = []
+
+    async def worker(flow):
+        await bucket.acquire(flow=flow)
+        order.append(flow)
+
+    await bucket.acquire()
+    await asyncio.gather(*[worker(flow) for flow in 'a' * 6 + 'b' * 6])
+
+    # flow b gets 2 slots per round while both flows wait, then a takes the rest
+    assert ''.join(order) == 'abbabbabbaaa'
+    assert bucket.waiting == 0
+
+    bucket.close()
+
+
+def acquire_shared(path, count):
+    """
+    Take slots of shared bucket in other process
+    """
+    async def run():
+        bucket = SharedLeakyBucket(capacity=5, leak_rate=2, path=path)
+        for _ in range(count):
+            await bucket.acquire()
+        bucket.close()
+
+    asyncio.run(run())
+
+
+@pytest.mark.asyncio
+async def test_shared_leaky_bucket(tmp_path):
+    path = str(tmp_path / "portal.bucket")
+
+    # other process takes 3 of 5 slots
+    process = multiprocessing.get_context('fork').Process(target=acquire_shared, args=(path, 3))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+    first = SharedLeakyBucket(capacity=5, leak_rate=2, path=path)
+    second = SharedLeakyBucket(capacity=5, leak_rate=2, path=path)
+
+    await first.acquire()
+    await second.acquire()
+    # all slots are taken by processes together
+    assert first.locked() and second.locked()
+    assert 4.5 <= second.level <= 5
+
+    loop = asyncio.get_event_loop()
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(first.acquire(), 0.2)
+
+    started = loop.time()
+    await asyncio.gather(first.acquire(), second.acquire())
+    assert loop.time() - started >= 0.3
+
+    first.close()
+    second.close()
+
+
+@pytest.mark.asyncio
+async def test_http_driver_response():
+    async def handler(request):
+        return web.json_response({'result': {'ID': '1'}}, status=201, headers={'Retry-After': '2'})
+
+    app = web.Application()
+    app.router.add_post('/rest/crm.product.get.json', handler)
+
+    async with TestServer(app) as server:
+        driver = HttpDriver()
+        url = str(server.make_url('/rest/crm.product.get.json'))
+
+        response = await driver.post(url, json={'id': 1})
+        await driver.close()
+
+    assert isinstance(response, Response)
+    assert response.data == {'result': {'ID': '1'}}
+    assert response.status == 201
+    assert response.url == url
+    assert response.headers['Retry-After'] == '2'
+    assert response.size == len(b'{"result": {"ID": "1"}}')
+
+
+def test_bitrix_urlencode_escape():
+    params = {
+        "filter": {">ID": 10, "NAME": "a&b=c%"},
+        "select": ["ID", "PROPERTY_*"],
+        "empty": [],
+    }
+
+    assert bitrix_urlencode(params) == "filter[%3EID]=10&filter[NAME]=a%26b%3Dc%25&select[0]=ID&select[1]=PROPERTY_%2A"
+
+    assert bitrix_urlencode(["first", "second"]) == "0=first&1=second"
+
+
+def test_pack_batches():
+    small = ("crm.product.get", {"id": 1})
+    big = ("crm.product.update", {"id": 2, "fields": {"DESCRIPTION": "x" * 500}})
+    calls = [("a", small), ("b", small), ("c", big), ("d", small), ("e", small), ("f", small)]
+
+    batches = pack_batches(calls, max_count=2, max_size=300)
+
+    # order saved, count and size limits respected, big command sent alone
+    assert [list(batch) for batch in batches] == [["a", "b"], ["c"], ["d", "e"], ["f"]]
+    assert batches[0] == prepare_batch({"a": small, "b": small})
+    assert batches[1] == prepare_batch({"c": big})
+
+    # size limit packs as much as possible into each batch
+    size = len("a") + len(batches[0]["a"]) + 6
+    batches = pack_batches(calls[:2] + calls[3:], max_count=50, max_size=size * 3)
+    assert [list(batch) for batch in batches] == [["a", "b", "d"], ["e", "f"]]
+
+    assert pack_batches([], max_count=50, max_size=100) == []
+
+
+def test_prepare_list_calls():
+    params = {"filter": {">ID": 10}, "select": ["*"], "start": 0}
+
+    calls = prepare_list_calls("crm.product.list", params, starts=[50, 100])
+
+    assert calls == [
+        "crm.product.list?filter[%3EID]=10&select[0]=%2A&start=50",
+        "crm.product.list?filter[%3EID]=10&select[0]=%2A&start=100",
+    ]
+    assert prepare_list_calls("crm.product.list", {}, starts=[50]) == ["crm.product.list?start=50"]
+
+
+def test_prepare_list_calls_as_batch():
+    """
+    Common part encoded once gives the same sub commands as encoding of each sub command
+    """
+    params = {
+        "filter": {"ID": list(range(100)), "ACTIVE": "Y"},
+        "select": ["ID", "NAME", "PROPERTY_*"],
+        "order": {"ID": "ASC"},
+    }
+    starts = [i * 50 for i in range(1, 51)]
+
+    calls = prepare_list_calls("crm.product.list", params, starts)
+
+    assert calls == list(prepare_batch({
+        str(start): ("crm.product.list", {**params, "start": start}) for start in starts
+    }).values())
+
+
+@pytest.mark.asyncio
+async def test_bitrix24_pool():
+    pool = Bitrix24Pool()
+
+    first = pool.add("first.bitrix24.ru", member_id="m1", webhook_code="a", use_webhook=True)
+    second = pool.add("second.bitrix24.ru", member_id="m2", webhook_code="b", use_webhook=True)
+
+    # shared connections, own rate limiter
+    assert first.driver.session is second.driver.session
+    assert first.driver._rate_limiter is not second.driver._rate_limiter
+
+    assert pool.resolve() is first
+    assert pool.resolve({"member_id": "m2"}) is second
+    assert pool.resolve({"domain": "second.bitrix24.ru"}) is second
+    with pytest.raises(UnknownPortal):
+        pool.resolve({"domain": "unknown.bitrix24.ru"})
+
+    # same portal is replaced
+    replaced = pool.add("second.bitrix24.ru", member_id="m2", webhook_code="c", use_webhook=True, default=True)
+    assert len(pool) == 2
+    assert pool.resolve({"member_id": "m2"}) is replaced
+    assert pool.resolve() is replaced
+
+    # replaced client is closed by pool
+    await asyncio.sleep(0)
+    assert second.driver.closed
+    assert not replaced.driver.closed
+
+    # client doesn't close shared session
+    await first.close()
+    assert first.driver.closed
+    assert not pool.session.closed
+
+    session = pool.session
+    await pool.close()
+    assert session.closed
+
+
+class LocalBitrix24(Bitrix24):
+    _client_endpoint_template = 'http://{domain}/rest/'
+    _oauth_endpoint_template = 'http://{domain}/oauth/{action}/'
+
+
+@pytest.mark.asyncio
+async def test_bitrix24_token_refresh(tmp_path):
+    refreshes = []
+    tokens = {'token': 'old'}
+
+    async def oauth(request):
+        refreshes.append(request.query['refresh_token'])
+        await asyncio.sleep(0.01)
+        tokens['token'] = f"new{len(refreshes)}"
+        return web.json_response({
+            'access_token': tokens['token'], 'refresh_token': f"refresh{len(refreshes)}", 'expires_in': 3600,
+        })
+
+    async def method(request):
+        if request.query['auth'] != tokens['token']:
+            return web.json_response({'error': 'expired_token'}, status=401)
+        return web.json_response({'result': request.query['auth']})
+
+    app = web.Application()
+    app.router.add_get('/oauth/token/', oauth)
+    app.router.add_post('/rest/crm.product.get.json', method)
+
+    store = FileTokenStore(str(tmp_path / "tokens.json"))
+
+    async with TestServer(app) as server:
+        domain = f"{server.host}:{server.port}"
+
+        # token expires in refresh margin
+        bx24 = LocalBitrix24(domain, client_id='app', client_secret='secret', driver=HttpDriver, token_store=store,
+                             access_token='old', refresh_token='refresh0', expires_in=10, refresh_margin=60)
+        responses = await asyncio.gather(*[bx24.call_method('crm.product.get') for _ in range(5)])
+
+        # concurrent requests waited one refresh
+        assert refreshes == ['refresh0']
+        assert [response.data['result'] for response in responses] == ['new1'] * 5
+        assert bx24.expires_at > time.time() + 3000
+
+        # tokens survive restart
+        restarted = LocalBitrix24(domain, client_id='app', client_secret='secret', driver=HttpDriver, token_store=store)
+        assert await restarted.load_tokens()
+        assert restarted.tokens == {'access_token': 'new1', 'refresh_token': 'refresh1'}
+
+        # token rejected by portal earlier than expected
+        tokens['token'] = 'revoked'
+        response = await restarted.call_method('crm.product.get')
+        assert refreshes == ['refresh0', 'refresh1']
+        assert response.data == {'result': 'new2'}
+
+        # tokens refreshed by other process are loaded from store, used refresh token is not sent
+        response = await bx24.call_method('crm.product.get')
+        assert refreshes == ['refresh0', 'refresh1']
+        assert response.data == {'result': 'new2'}
+        assert bx24.tokens == {'access_token': 'new2', 'refresh_token': 'refresh2'}
+
+        await bx24.close()
+        await restarted.close()
+
+
+@pytest.mark.asyncio
+async def test_file_token_store_lock(tmp_path):
+    store = FileTokenStore(str(tmp_path / "tokens.json"))
+    events = []
+
+    async def refresh(name):
+        async with store.lock('portal'):
+            events.append(name)
+            await asyncio.sleep(0.01)
+            await store.save('portal', {'access_token': name})
+            events.append(name)
+
+    await asyncio.gather(refresh('a'), refresh('b'))
+
+    # refreshes don't overlap
+    assert events in (['a', 'a', 'b', 'b'], ['b', 'b', 'a', 'a'])
+    assert await store.load('portal') == {'access_token': events[-1]}
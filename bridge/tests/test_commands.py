@@ -1,9 +1,19 @@
+import asyncio
 import math
 
 import pytest
+import ujson
 
+from bridge.conf import settings
+from bridge.utils.bitrix24.limiter import current_flow, current_priority
+from bridge.utils.bitrix24.utils import Response, get_batch_item_size, prepare_call
 from bridge.utils.commands import Command, CommandResponse, ResponseModem
-from bridge.utils.commands.utils import fast_div_ceil
+from bridge.utils.commands.batcher import AutoBatcher
+from bridge.utils.commands.cache import ResponseCache
+from bridge.utils.bitrix24.pool import Bitrix24Pool
+from bridge.utils.commands.handlers import CommandHandler, PortalCommandHandler
+from bridge.utils.commands.scheduler import get_call_refs, resolve_refs, resolve_batch, schedule_batch, UnresolvedRef
+from bridge.utils.commands.utils import fast_div_ceil, retry, RetryPolicy, RetryBudget, current_retry_budget
 
 
 def test_fast_div_ceil():
@@ -72,3 +82,650 @@ def test_response_modem(fixture_command_data):
     assert output == response.data()
 
 
+def fake_response(data, status=200, headers=None):
+    body = ujson.dumps(data).encode()
+    return Response(data=ujson.loads(body), status=status, headers=headers, size=len(body))
+
+
+class FakeBitrix24:
+    PAGE_SIZE = 50
+    PAGE_SIZE_MINIS_ONE = PAGE_SIZE - 1
+
+    def __init__(self):
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def call_batch(self, calls, halt_on_error=False):
+        self.calls.append(calls)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        # reverse finish order
+        await asyncio.sleep(0.01 / len(self.calls))
+        self.in_flight -= 1
+        return fake_response({'result': {'result': {name: name for name in calls}}})
+
+
+@pytest.mark.asyncio
+async def test_batch_concurrent_sub_batches():
+    client = FakeBitrix24()
+    handler = CommandHandler(client, batch_concurrency=3)
+
+    cmd = Command(
+        action='batch',
+        method='batch',
+        params={'cmd': {f"cmd_{i}": f"crm.product.get?id={i}" for i in range(420)}}
+    )
+
+    responses = await handler.batch(cmd)
+
+    # no lost commands, original order
+    assert len(responses) == 9
+    names = [name for response in responses for name in response.result[0]['result']['result']]
+    assert names == [f"cmd_{i}" for i in range(420)]
+    assert 1 < client.max_in_flight <= 3
+
+
+class FakeKeysetBitrix24(FakeBitrix24):
+    def __init__(self, items_count):
+        super().__init__()
+        self.items = [{'ID': str(i)} for i in range(1, items_count + 1)]
+
+    async def call_batch(self, calls, halt_on_error=False):
+        self.calls.append(calls)
+        result, result_total = {}, {}
+        for name, call in calls.items():
+            cursor = call['params']['filter']['>ID']
+            if isinstance(cursor, str) and cursor.startswith('$result'):
+                step, index, field = cursor[len('$result['):-1].split('][')
+                try:
+                    cursor = result[step][int(index)][field]
+                except (KeyError, IndexError):
+                    cursor = 0
+            selected = [item for item in self.items if int(item['ID']) > int(cursor)]
+            result[name] = selected[:self.PAGE_SIZE]
+            if call['params']['start'] == 0:
+                result_total[name] = len(selected)
+            else:
+                assert call['params']['start'] == -1
+        return fake_response({'result': {'result': result, 'result_total': result_total}})
+
+
+@pytest.mark.asyncio
+async def test_keyset_list():
+    client = FakeKeysetBitrix24(items_count=420)
+    handler = CommandHandler(client)
+
+    responses = await handler.keyset(Command(action='keyset', method='crm.product.list', params={'start': 100}))
+
+    assert len(responses) == 1
+    assert [item['ID'] for item in responses[0].result] == [str(i) for i in range(1, 421)]
+    assert responses[0].total == 420
+    # 1 + 2 + 4 steps, then 2 steps for 70 records left, no steps after the last page
+    assert [len(calls) for calls in client.calls] == [1, 2, 4, 2]
+    # only first request counts total
+    assert [calls['step_0']['params']['start'] for calls in client.calls] == [0, -1, -1, -1]
+
+
+
+class FailingKeysetBitrix24(FakeKeysetBitrix24):
+    """
+    Step with given cursor fails fail_count times, steps after it fail too
+    """
+
+    def __init__(self, items_count, fail_cursor, fail_count):
+        super().__init__(items_count)
+        self.fail_cursor = fail_cursor
+        self.fail_count = fail_count
+
+    async def call_batch(self, calls, halt_on_error=False):
+        response = await super().call_batch(calls, halt_on_error)
+        result = response.data['result']['result']
+        result_error = response.data['result']['result_error'] = {}
+
+        names = list(calls)
+        for i, name in enumerate(names):
+            if i == 0:
+                cursor = int(calls[name]['params']['filter']['>ID'])
+            else:
+                prev_page = result[names[i - 1]]
+                cursor = int(prev_page[-1]['ID']) if prev_page else 0
+
+            if cursor == self.fail_cursor and self.fail_count > 0:
+                self.fail_count -= 1
+                for failed in names[i:]:
+                    del result[failed]
+                    result_error[failed] = {'error': 'OPERATION_TIME_LIMIT', 'error_description': 'Method is blocked'}
+                break
+
+        return response
+
+
+@pytest.mark.asyncio
+async def test_keyset_step_error(monkeypatch):
+    monkeypatch.setattr(settings, 'COMMAND_RETRY_BASE_DELAY', 0)
+
+    # second step of second batch fails, next batch starts from it
+    client = FailingKeysetBitrix24(items_count=420, fail_cursor=100, fail_count=1)
+    handler = CommandHandler(client)
+
+    responses = await handler.keyset(Command(action='keyset', method='crm.product.list'))
+
+    assert responses[0].status_code == 200
+    assert [item['ID'] for item in responses[0].result] == [str(i) for i in range(1, 421)]
+    assert [calls['step_0']['params']['filter']['>ID'] for calls in client.calls[:3]] == [0, '50', '100']
+
+    # first step fails until retries are exhausted, error instead of not complete list
+    client = FailingKeysetBitrix24(items_count=420, fail_cursor=100, fail_count=100)
+    handler = CommandHandler(client)
+
+    responses = await handler.keyset(Command(action='keyset', method='crm.product.list'))
+
+    assert len(responses) == 1
+    assert responses[0].result == [{'error': 'OPERATION_TIME_LIMIT', 'error_description': 'Method is blocked'}]
+    # second step of batch, then first step with retries
+    assert 100 - client.fail_count == 1 + 1 + settings.COMMAND_RETRY_MAX_COUNT
+
+
+class EmptyKeysetBitrix24(FakeKeysetBitrix24):
+    """
+    Some batch requests get 200 response with empty body
+    """
+
+    def __init__(self, items_count, empty_count):
+        super().__init__(items_count)
+        self.empty_count = empty_count
+
+    async def call_batch(self, calls, halt_on_error=False):
+        # first request is answered
+        if self.calls and self.empty_count > 0:
+            self.empty_count -= 1
+            self.calls.append(calls)
+            return fake_response({})
+        return await super().call_batch(calls, halt_on_error)
+
+
+@pytest.mark.asyncio
+async def test_keyset_empty_response(monkeypatch):
+    monkeypatch.setattr(settings, 'COMMAND_RETRY_BASE_DELAY', 0)
+
+    # response without result is retried, not the end of list
+    client = EmptyKeysetBitrix24(items_count=420, empty_count=1)
+    handler = CommandHandler(client)
+
+    responses = await handler.keyset(Command(action='keyset', method='crm.product.list'))
+
+    assert [item['ID'] for item in responses[0].result] == [str(i) for i in range(1, 421)]
+
+    # error when retries are exhausted
+    client = EmptyKeysetBitrix24(items_count=420, empty_count=100)
+    handler = CommandHandler(client)
+
+    responses = await handler.keyset(Command(action='keyset', method='crm.product.list'))
+
+    assert len(responses) == 1
+    assert responses[0].result[0]['error'] == 'INTERNAL_SERVER_ERROR'
+
+
+def test_schedule_batch():
+    commands = {
+        'link': 'crm.deal.update?id=%24result%5Bdeal%5D&fields%5BCONTACT_ID%5D=%24result%5Bcontact%5D',
+        'contact': 'crm.contact.add?fields%5BNAME%5D=a',
+        'other': 'crm.product.get?id=1',
+        'deal': 'crm.deal.add?fields%5BTITLE%5D=b',
+    }
+
+    assert get_call_refs(commands['link']) == {'deal', 'contact'}
+    assert get_call_refs('crm.deal.get?id=$result[deal][0][ID]') == {'deal'}
+    assert get_call_refs('crm.deal.list?start=$result_next[deals]&total=%24result_total%5Bdeals%5D') == {'deals'}
+    assert get_call_refs('log.add?message=$result_error[deal][error]') == {'deal'}
+
+    # producers before consumer in the same batch
+    chains = schedule_batch(commands, max_count=3, max_size=10000)
+    assert [[list(batch) for batch in chain] for chain in chains] == [[['contact', 'deal', 'link']], [['other']]]
+
+    # independent commands are packed together
+    chains = schedule_batch(commands, max_count=50, max_size=10000)
+    assert [[list(batch) for batch in chain] for chain in chains] == [[['contact', 'deal', 'link', 'other']]]
+
+    # too big dependency group becomes chain of batches
+    chains = schedule_batch(commands, max_count=2, max_size=10000)
+    assert [[list(batch) for batch in chain] for chain in chains] == [[['contact', 'deal'], ['link']], [['other']]]
+
+
+def test_resolve_refs():
+    results = {'result': {'deal': 10, 'list': [{'ID': '7'}]}, 'result_next': {'list': 50}}
+
+    assert resolve_refs('crm.deal.get?id=%24result%5Bdeal%5D', results) == 'crm.deal.get?id=10'
+    assert resolve_refs('crm.deal.get?id=$result[list][0][ID]', results) == 'crm.deal.get?id=7'
+    assert resolve_refs('crm.deal.list?start=$result_next[list]', results) == 'crm.deal.list?start=50'
+    # unknown and not scalar results are left for Bitrix24
+    assert resolve_refs('crm.deal.get?id=$result[other]', results) == 'crm.deal.get?id=$result[other]'
+    assert resolve_refs('crm.deal.get?id=$result[list]', results) == 'crm.deal.get?id=$result[list]'
+
+    # macros of sub commands from sent batches can't be left
+    with pytest.raises(UnresolvedRef):
+        resolve_refs('crm.deal.get?id=$result[other]', results, sent={'deal', 'list', 'other'})
+    with pytest.raises(UnresolvedRef):
+        resolve_refs('crm.deal.get?id=$result[list][5][ID]', results, sent={'deal', 'list'})
+    assert resolve_refs('crm.deal.get?id=$result[other]', results, sent={'deal'}) == 'crm.deal.get?id=$result[other]'
+
+
+def test_resolve_batch():
+    results = {'result': {'deal': 10}, 'result_error': {'contact': {'error': 'NOT_FOUND'}}}
+    batch = {
+        'link': 'crm.deal.update?id=$result[deal]&fields[CONTACT_ID]=$result[contact]',
+        'get': 'crm.deal.get?id=$result[link]',
+        'deal': 'crm.deal.get?id=$result[deal]',
+    }
+
+    resolved, errors = resolve_batch(batch, results, sent={'deal', 'contact'})
+
+    assert resolved == {'deal': 'crm.deal.get?id=10'}
+    assert set(errors) == {'link', 'get'}
+    assert errors['link']['error'] == 'UNRESOLVED_RESULT'
+
+
+class FakeMacroBitrix24(FakeBitrix24):
+    """
+    Resolve $result[name] macros of the same batch, unresolved macros are errors
+    """
+
+    async def call_batch(self, calls, halt_on_error=False):
+        self.calls.append(dict(calls))
+        result, result_error = {}, {}
+        for name, command in calls.items():
+            refs = get_call_refs(command)
+            if refs - set(result):
+                result_error[name] = {'error': 'unresolved macro'}
+            else:
+                result[name] = resolve_refs(command, {'result': result})
+        return fake_response({'result': {'result': result, 'result_error': result_error}})
+
+
+@pytest.mark.asyncio
+async def test_batch_dependencies():
+    client = FakeMacroBitrix24()
+    client.PAGE_SIZE = 2
+    handler = CommandHandler(client)
+
+    cmd = Command(
+        action='batch',
+        method='batch',
+        params={'cmd': {
+            'link': ('crm.deal.update', {'id': '$result[deal]', 'contact': '$result[contact]'}),
+            'contact': 'crm.contact.add?id=1',
+            'deal': ('crm.deal.add', {'id': 2}),
+            'other': 'crm.product.get?id=3',
+        }}
+    )
+
+    responses = await handler.batch(cmd)
+
+    assert len(client.calls) == 3
+    results = {}
+    for response in responses:
+        assert not response.result[0]['result']['result_error']
+        results.update(response.result[0]['result']['result'])
+    # macros of previous batch resolved by bridge
+    assert results['link'] == 'crm.deal.update?id=crm.deal.add%3Fid%3D2&contact=crm.contact.add%3Fid%3D1'
+
+
+class FailingMacroBitrix24(FakeMacroBitrix24):
+    """
+    crm.contact.add sub command fails
+    """
+
+    async def call_batch(self, calls, halt_on_error=False):
+        response = await super().call_batch(calls, halt_on_error)
+        batch_result = response.data['result']
+        for name, command in calls.items():
+            if command.startswith('crm.contact.add'):
+                batch_result['result'].pop(name, None)
+                batch_result['result_error'][name] = {'error': 'ERROR_CORE'}
+        return response
+
+
+@pytest.mark.asyncio
+async def test_batch_unresolved_dependencies():
+    client = FailingMacroBitrix24()
+    client.PAGE_SIZE = 2
+    handler = CommandHandler(client)
+
+    cmd = Command(
+        action='batch',
+        method='batch',
+        params={'cmd': {
+            'link': ('crm.deal.update', {'id': '$result[deal]', 'contact': '$result[contact]'}),
+            'contact': 'crm.contact.add?id=1',
+            'deal': ('crm.deal.add', {'id': 2}),
+        }}
+    )
+
+    responses = await handler.batch(cmd)
+
+    # link isn't sent with raw $result[contact] macro
+    assert len(client.calls) == 1
+    assert len(responses) == 2
+    assert responses[1].result[0]['result']['result'] == {}
+    assert responses[1].result[0]['result']['result_error']['link']['error'] == 'UNRESOLVED_RESULT'
+
+
+def test_response_cache():
+    cache = ResponseCache(ttl={'get': 60, 'crm.product.fields': 3600}, max_size=10)
+
+    assert cache.is_cacheable('crm.product.get')
+    assert cache.is_cacheable('crm.product.fields')
+    assert not cache.is_cacheable('crm.deal.fields')
+    assert not cache.is_cacheable('crm.product.add')
+
+    cache.set('crm.product.get', {'id': 1, 'select': ['ID']}, 'product_1', size=4)
+    cache.set('crm.deal.get', {'id': 1}, 'deal_1', size=4)
+
+    # params order doesn't matter
+    assert cache.get('crm.product.get', {'select': ['ID'], 'id': 1}) == 'product_1'
+    assert cache.get('crm.product.get', {'id': 2}) is None
+
+    # least recently used deal_1 evicted
+    cache.set('crm.product.get', {'id': 2}, 'product_2', size=4)
+    assert cache.get('crm.deal.get', {'id': 1}) is None
+    assert cache.size == 8
+
+    # write method invalidate entity
+    cache.invalidate('crm.product.update')
+    assert cache.get('crm.product.get', {'id': 2}) is None
+    assert len(cache) == 0
+
+    assert cache.stats() == {'hits': 1, 'misses': 3, 'evictions': 1, 'count': 0, 'size': 0}
+
+    # response read before invalidation is not cached
+    generation = cache.generation('crm.product.get')
+    cache.invalidate('crm.product.delete')
+    cache.set('crm.product.get', {'id': 1}, 'product_1', size=4, generation=generation)
+    assert len(cache) == 0
+    cache.set('crm.product.get', {'id': 1}, 'product_1', size=4, generation=cache.generation('crm.product.get'))
+    assert len(cache) == 1
+
+
+class FakeDefaultBitrix24(FakeBitrix24):
+    async def call_method(self, method, params=None):
+        self.calls.append((method, params))
+        return fake_response({'result': {'method': method}})
+
+
+@pytest.mark.asyncio
+async def test_default_cache():
+    client = FakeDefaultBitrix24()
+    handler = CommandHandler(client, cache=ResponseCache(ttl={'get': 60}, max_size=1024))
+
+    for method in ['crm.product.get', 'crm.product.get', 'crm.product.update', 'crm.product.get']:
+        responses = await handler.default(Command(method=method, params={'id': 1}))
+        assert responses[0].result == [{'result': {'method': method}}]
+
+    assert [method for method, _ in client.calls] == ['crm.product.get', 'crm.product.update', 'crm.product.get']
+
+
+
+class SlowReadBitrix24(FakeDefaultBitrix24):
+    async def call_method(self, method, params=None):
+        response = await super().call_method(method, params)
+        if method.endswith('.get'):
+            await asyncio.sleep(0.02)
+        return response
+
+
+@pytest.mark.asyncio
+async def test_default_cache_invalidated_in_flight():
+    client = SlowReadBitrix24()
+    cache = ResponseCache(ttl={'get': 60}, max_size=1024)
+    handler = CommandHandler(client, cache=cache, coalesce=False)
+
+    async def update():
+        await asyncio.sleep(0.01)
+        await handler.default(Command(method='crm.product.update', params={'id': 1}))
+
+    # read started before update, finished after it
+    await asyncio.gather(handler.default(Command(method='crm.product.get', params={'id': 1})), update())
+
+    assert cache.get('crm.product.get', {'id': 1}) is None
+    assert len(cache) == 0
+
+    await handler.default(Command(method='crm.product.get', params={'id': 1}))
+    assert len(cache) == 1
+
+class FakeContextBitrix24(FakeBitrix24):
+    async def call_method(self, method, params=None):
+        self.calls.append((current_flow.get(), current_priority.get()))
+        return fake_response({'result': {}})
+
+
+@pytest.mark.asyncio
+async def test_dispatch_flow_and_priority():
+    client = FakeContextBitrix24()
+    handler = CommandHandler(client, coalesce=False)
+
+    await handler.dispatch({'method': 'crm.deal.get', 'params': {'id': 1}})
+    await handler.dispatch({'method': 'crm.deal.get', 'params': {'id': 1}, 'meta': {'producer': 'export'}})
+    await handler.dispatch({'method': 'crm.deal.get', 'params': {'id': 1}, 'meta': {'priority': 5}})
+
+    # flow - meta.producer or entity, context is reset after command
+    assert client.calls == [('crm.deal', 0), ('export', 0), ('crm.deal', 5)]
+    assert current_flow.get() == 'default'
+
+
+class FakePortalBitrix24(FakeDefaultBitrix24):
+    def __init__(self, domain, member_id=None):
+        super().__init__()
+        self.domain = domain
+        self.member_id = member_id
+
+
+@pytest.mark.asyncio
+async def test_portal_command_handler():
+    pool = Bitrix24Pool()
+    first, second = FakePortalBitrix24('first.bitrix24.ru'), FakePortalBitrix24('second.bitrix24.ru', 'm2')
+    pool.register(first)
+    pool.register(second)
+    handler = PortalCommandHandler(pool, cache=None, coalesce=False)
+
+    await handler.dispatch({'method': 'crm.product.get', 'params': {'id': 1}})
+    await handler.dispatch({'method': 'crm.product.get', 'params': {'id': 2}, 'meta': {'member_id': 'm2'}})
+    await handler.dispatch({'method': 'crm.product.get', 'params': {'id': 3}, 'meta': {'domain': 'first.bitrix24.ru'}})
+
+    assert client_ids(first) == [1, 3]
+    assert client_ids(second) == [2]
+    # one CommandHandler per portal
+    assert handler.get_handler() is handler.get_handler({'domain': 'first.bitrix24.ru'})
+    assert handler.get_handler().bx_client is first
+
+
+def client_ids(client):
+    return [params['id'] for _, params in client.calls]
+
+
+class SlowDefaultBitrix24(FakeDefaultBitrix24):
+    async def call_method(self, method, params=None):
+        response = await super().call_method(method, params)
+        await asyncio.sleep(0.01)
+        return response
+
+
+@pytest.mark.asyncio
+async def test_default_single_flight():
+    client = SlowDefaultBitrix24()
+    handler = CommandHandler(client, coalesce=True)
+
+    commands = [
+        Command(method='crm.productsection.list', params={'filter': {'ACTIVE': 'Y'}}, meta={'id': i})
+        for i in range(5)
+    ] + [
+        Command(method='crm.product.add', params={'fields': {'NAME': 'name'}}, meta={'id': i})
+        for i in range(5, 7)
+    ]
+
+    responses = await asyncio.gather(*[handler.default(command) for command in commands])
+
+    # one request for identical reads, write requests are not coalesced
+    assert sorted(method for method, _ in client.calls) == ['crm.product.add', 'crm.product.add', 'crm.productsection.list']
+    assert [response[0].meta for response in responses] == [{'id': i} for i in range(7)]
+    assert len(handler.single_flight) == 0
+
+
+class FakeAutoBatchBitrix24(FakeBitrix24):
+    async def call_batch(self, calls, halt_on_error=False):
+        self.calls.append(calls)
+        result, result_error = {}, {}
+        for name, call in calls.items():
+            if call['method'].endswith('.delete'):
+                result_error[name] = {'error': 'ERROR_CORE', 'error_description': 'Not found'}
+            else:
+                result[name] = call['params']
+        return fake_response({
+            'result': {'result': result, 'result_error': result_error, 'result_total': {}, 'result_next': {}}
+        })
+
+
+@pytest.mark.asyncio
+async def test_default_auto_batch():
+    client = FakeAutoBatchBitrix24()
+    handler = CommandHandler(client, auto_batcher=AutoBatcher(client, window=0.01, max_size=3), coalesce=False)
+
+    commands = [Command(method='crm.product.get', params={'id': i}) for i in range(4)]
+    commands.append(Command(method='crm.product.delete', params={'id': 42}))
+
+    responses = await asyncio.gather(*[handler.default(command) for command in commands])
+
+    # first batch sent on size, second on window
+    assert [len(calls) for calls in client.calls] == [3, 2]
+
+    for i in range(4):
+        assert responses[i][0].status_code == 200
+        assert responses[i][0].result == [{'result': {'id': i}}]
+
+    # error of request keeps batch status
+    assert responses[4][0].status_code == 200
+    assert responses[4][0].result == [{'error': 'ERROR_CORE', 'error_description': 'Not found'}]
+
+
+
+class LimitedAutoBatchBitrix24(FakeAutoBatchBitrix24):
+    """
+    First batch request with crm.deal.get gets QUERY_LIMIT_EXCEEDED for it
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.limited = True
+
+    async def call_batch(self, calls, halt_on_error=False):
+        response = await super().call_batch(calls, halt_on_error)
+        batch_result = response.data['result']
+        for name, call in calls.items():
+            if call['method'] == 'crm.deal.get' and self.limited:
+                self.limited = False
+                del batch_result['result'][name]
+                batch_result['result_error'][name] = {'error': 'QUERY_LIMIT_EXCEEDED', 'error_description': 'Too many'}
+        return response
+
+
+@pytest.mark.asyncio
+async def test_auto_batch_retry_and_size():
+    client = LimitedAutoBatchBitrix24()
+    policy = RetryPolicy(max_count=3, base_delay=0, max_delay=0)
+    batcher = AutoBatcher(client, window=0.01, max_size=50, max_bytes=200, policy=policy)
+    handler = CommandHandler(client, auto_batcher=batcher, coalesce=False)
+
+    commands = [Command(method='crm.product.get', params={'id': i, 'name': 'x' * 50}) for i in range(4)]
+    commands.append(Command(method='crm.deal.get', params={'id': 1}))
+
+    responses = await asyncio.gather(*[handler.default(command) for command in commands])
+
+    # temporary error of sub request is retried by next batch
+    assert responses[4][0].status_code == 200
+    assert responses[4][0].result == [{'result': {'id': 1}}]
+    assert [call['method'] for calls in client.calls for call in calls.values()].count('crm.deal.get') == 2
+
+    # batches are split by encoded size
+    assert len(client.calls) > 2
+    for calls in client.calls:
+        assert len(calls) == 1 or sum(
+            get_batch_item_size(name, prepare_call(name, call)) for name, call in calls.items()
+        ) <= 200
+    for i in range(4):
+        assert responses[i][0].result == [{'result': {'id': i, 'name': 'x' * 50}}]
+
+
+class ContextAutoBatchBitrix24(FakeAutoBatchBitrix24):
+    """
+    Every request of first batch gets QUERY_LIMIT_EXCEEDED, context of batch requests is saved
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.contexts = []
+
+    async def call_batch(self, calls, halt_on_error=False):
+        self.contexts.append((current_priority.get(), current_flow.get(), current_retry_budget.get()))
+        response = await super().call_batch(calls, halt_on_error)
+        if len(self.calls) == 1:
+            batch_result = response.data['result']
+            for name in calls:
+                del batch_result['result'][name]
+                batch_result['result_error'][name] = {'error': 'QUERY_LIMIT_EXCEEDED', 'error_description': 'Too many'}
+        return response
+
+
+@pytest.mark.asyncio
+async def test_auto_batch_context():
+    client = ContextAutoBatchBitrix24()
+    policy = RetryPolicy(max_count=3, base_delay=0, max_delay=0)
+    batcher = AutoBatcher(client, window=0.01, max_size=50, policy=policy)
+
+    async def call(priority, flow, budget):
+        current_priority.set(priority)
+        current_flow.set(flow)
+        current_retry_budget.set(budget)
+        return await batcher.call('crm.product.get', {'id': priority})
+
+    budgets = [RetryBudget(0), RetryBudget(1)]
+    responses = await asyncio.gather(call(1, 'export', budgets[0]), call(5, 'ui', budgets[1]))
+
+    # batch request has the highest priority and its flow, whole batch retries are not charged to one command
+    assert client.contexts[0] == (5, 'ui', None)
+
+    # each request retry is charged to own command
+    assert responses[0].data == {'error': 'QUERY_LIMIT_EXCEEDED', 'error_description': 'Too many'}
+    assert responses[1].data == {'result': {'id': 5}}
+    assert [budget.left for budget in budgets] == [0, 0]
+    assert [len(calls) for calls in client.calls] == [2, 1]
+
+@pytest.mark.asyncio
+async def test_retry_policy():
+    policy = RetryPolicy(max_count=5, base_delay=0, max_delay=2)
+
+    assert policy.should_retry(Response(status=None))
+    assert policy.should_retry(fake_response({}, status=503))
+    assert policy.should_retry(fake_response({'error': 'QUERY_LIMIT_EXCEEDED'}, status=400))
+    assert not policy.should_retry(fake_response({'error': 'ERROR_CORE'}, status=400))
+    assert not policy.should_retry(fake_response({'result': []}))
+
+    assert policy.get_delay(3, fake_response({}, headers={'Retry-After': '1.5'})) == 1.5
+    assert policy.get_delay(3, fake_response({}, headers={'Retry-After': '120'})) == 2
+    assert 0 <= RetryPolicy(base_delay=0.5, max_delay=30).get_delay(2) <= 2
+
+    responses = [fake_response({}, status=503), Response(status=None), fake_response({'result': 1})]
+
+    async def call():
+        return responses.pop(0)
+
+    response = await retry(call, policy=policy)
+    assert response.status == 200
+
+    # budget is shared by requests of command
+    budget = RetryBudget(1)
+    responses = [fake_response({}, status=503)] * 4
+
+    response = await retry(call, policy=policy, budget=budget)
+    assert response.status == 503
+    assert len(responses) == 2
+    assert budget.left == 0
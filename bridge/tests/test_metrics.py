@@ -0,0 +1,104 @@
+import pytest
+
+from bridge.utils.bitrix24.utils import Response
+from bridge.utils.commands.cache import ResponseCache
+from bridge.utils.commands.handlers import CommandHandler
+from bridge.utils.metrics import Counter, Gauge, Histogram, LabelValues, Registry, COMMAND_DURATION, REGISTRY
+
+
+def test_registry_render():
+    registry = Registry()
+    requests = Counter('requests_total', 'Requests', ('status',), registry=registry)
+    level = Gauge('level', 'Level', registry=registry)
+    latency = Histogram('latency_seconds', 'Latency', ('method',), buckets=(0.1, 1), registry=registry)
+
+    requests.labels('200').inc()
+    requests.labels('200').inc(2)
+    requests.labels('a"b').inc()
+    level.labels().set_function(lambda: 2.5)
+    for value in (0.05, 0.1, 0.5, 3):
+        latency.labels('GET').observe(value)
+
+    assert registry.render() == '\n'.join([
+        '# HELP requests_total Requests',
+        '# TYPE requests_total counter',
+        'requests_total{status="200"} 3',
+        'requests_total{status="a\\"b"} 1',
+        '# HELP level Level',
+        '# TYPE level gauge',
+        'level 2.5',
+        '# HELP latency_seconds Latency',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{method="GET",le="0.1"} 2',
+        'latency_seconds_bucket{method="GET",le="1"} 3',
+        'latency_seconds_bucket{method="GET",le="+Inf"} 4',
+        'latency_seconds_sum{method="GET"} 3.65',
+        'latency_seconds_count{method="GET"} 4',
+    ]) + '\n'
+
+    with pytest.raises(ValueError):
+        Counter('requests_total', 'Requests', registry=registry)
+    with pytest.raises(ValueError):
+        requests.labels()
+
+
+class FakeBitrix24:
+    PAGE_SIZE = 50
+
+    async def call_method(self, method, params=None):
+        return Response({'result': {}}, status=200)
+
+
+@pytest.mark.asyncio
+async def test_dispatch_metrics():
+    handler = CommandHandler(FakeBitrix24(), coalesce=False)
+    duration = COMMAND_DURATION.labels('default', 'crm.metrics.get')
+    count = duration.count
+
+    await handler.dispatch({'method': 'crm.metrics.get', 'params': {}})
+
+    assert duration.count == count + 1
+
+
+def test_label_values():
+    allowed = LabelValues(['crm.deal.list', 'CRM.deal.get'])
+    assert allowed('crm.deal.list') == 'crm.deal.list'
+    assert allowed('crm.Deal.Get') == 'crm.deal.get'
+    assert allowed('crm.lead.list') == 'other'
+
+    first = LabelValues(max_count=2)
+    assert first('crm.deal.list') == 'crm.deal.list'
+    assert first('crm.deal.get; drop') == 'other'
+    assert first(None) == 'other'
+    assert first('crm.deal.get') == 'crm.deal.get'
+    assert first('crm.lead.list') == 'other'
+    assert first('crm.deal.list') == 'crm.deal.list'
+
+
+@pytest.mark.asyncio
+async def test_dispatch_metrics_bounded_labels():
+    handler = CommandHandler(FakeBitrix24(), coalesce=False)
+    duration = COMMAND_DURATION.labels('default', 'other')
+    count = duration.count
+
+    await handler.dispatch({'method': 'crm.deal.get\n' + 'x' * 1000, 'params': {}})
+    await handler.dispatch({'method': 'crm.deal.get', 'action': 'unknown_action', 'params': {}})
+
+    assert duration.count == count + 1
+    assert 'x' * 1000 not in REGISTRY.render()
+    assert 'unknown_action' not in REGISTRY.render()
+
+
+def test_cache_metrics():
+    cache = ResponseCache(ttl={'get': 60}, max_size=100, metrics_key='metrics.bitrix24.ru')
+
+    cache.get('crm.product.get', {'id': 1})
+    cache.set('crm.product.get', {'id': 1}, 'product_1', size=10)
+    cache.get('crm.product.get', {'id': 1})
+
+    rendered = REGISTRY.render()
+    assert 'bridge_cache_hits_total{key="metrics.bitrix24.ru"} 1' in rendered
+    assert 'bridge_cache_misses_total{key="metrics.bitrix24.ru"} 1' in rendered
+    assert 'bridge_cache_evictions_total{key="metrics.bitrix24.ru"} 0' in rendered
+    assert 'bridge_cache_size_bytes{key="metrics.bitrix24.ru"} 10' in rendered
+    assert 'bridge_cache_entries{key="metrics.bitrix24.ru"} 1' in rendered
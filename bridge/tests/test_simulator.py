@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestServer
+
+from bridge.utils.bench import run_workload, list_commands, batch_commands, default_commands, percentile
+from bridge.utils.bitrix24.drivers import HttpDriver, LimitedHttpDriver
+from bridge.utils.bitrix24.simulator import Bitrix24Simulator, parse_query, resolve_macros
+from bridge.utils.commands.handlers import CommandHandler
+
+
+def test_parse_query():
+    assert parse_query("filter[%3EID]=10&select[0]=ID&select[1]=NAME&start=-1") == {
+        "filter": {">ID": "10"},
+        "select": ["ID", "NAME"],
+        "start": "-1",
+    }
+
+
+def test_resolve_macros():
+    results = {'deal': 10, 'list': [{'ID': '7', 'NAME': 'a b'}]}
+    params = parse_query(
+        "id=%24result%5Bdeal%5D&filter[%3EID]=$result[list][0][ID]&fields[TITLE]=deal $result[deal] $result[list][0][NAME]"
+        "&fields[ITEMS]=$result[list]&fields[OTHER]=$result[other]&fields[MISSING]=$result[list][5][ID]"
+    )
+
+    assert resolve_macros(params, results) == {
+        'id': 10,
+        'filter': {'>ID': '7'},
+        'fields': {
+            'TITLE': 'deal 10 a b',
+            'ITEMS': [{'ID': '7', 'NAME': 'a b'}],
+            # unknown results are left as is
+            'OTHER': '$result[other]',
+            'MISSING': '$result[list][5][ID]',
+        },
+    }
+
+
+def test_simulator_batch_macros():
+    simulator = Bitrix24Simulator({'crm.product': 120})
+
+    data = simulator.batch({'cmd': {
+        'page': 'crm.product.list?order[ID]=ASC&start=-1',
+        'next': 'crm.product.list?order[ID]=ASC&start=-1&filter[%3EID]=%24result%5Bpage%5D%5B49%5D%5BID%5D',
+        'name': 'crm.product.get?id=$result[next][0][ID]',
+    }})['result']
+
+    assert data['result_error'] == {}
+    assert data['result']['next'][0]['ID'] == '51'
+    assert data['result']['name'] == {'ID': '51', 'NAME': 'crm.product 51'}
+
+
+def test_percentile():
+    values = [i / 100 for i in range(1, 101)]
+    assert percentile(values, 50) == 0.5
+    assert percentile(values, 99) == 0.99
+    assert percentile([], 50) == 0
+
+
+@pytest.mark.asyncio
+async def test_simulator_throttling():
+    simulator = Bitrix24Simulator({'crm.product': 10}, bucket_size=5, leak_rate=1)
+
+    async with TestServer(simulator.app()) as server:
+        client = simulator.client(f"{server.host}:{server.port}", driver=HttpDriver)
+        responses = await asyncio.gather(*[client.call_method('crm.product.get', {'id': 1}) for _ in range(8)])
+        await client.close()
+
+    assert [response.status for response in responses].count(200) == 5
+    assert {response.data.get('error') for response in responses if response.status != 200} == {'QUERY_LIMIT_EXCEEDED'}
+    assert simulator.stats() == {'requests': 8, 'throttled': 3}
+
+
+@pytest.mark.asyncio
+async def test_simulator_bench():
+    """
+    CommandHandler workloads against simulator,
+    client limiter is stricter than portal limit to absorb jitter (client and portal share event loop,
+    so GC pause delivers burst of requests), nothing is throttled
+    """
+    simulator = Bitrix24Simulator({'crm.product': 1000}, bucket_size=50, leak_rate=500)
+
+    async with TestServer(simulator.app()) as server:
+        client = simulator.client(
+            f"{server.host}:{server.port}",
+            driver=LimitedHttpDriver,
+            driver_options={'bucket_size': 20, 'leak_rate': 400},
+        )
+        handler = CommandHandler(client, coalesce=False)
+
+        responses = await handler.dispatch(list_commands(1, action='list')[0])
+        assert [item['ID'] for item in responses[0].result] == [str(i) for i in range(1, 1001)]
+
+        responses = await handler.dispatch(list_commands(1, action='keyset')[0])
+        assert len(responses[0].result) == 1000
+
+        results = [
+            await run_workload('list', handler.dispatch, list_commands(5), stats=simulator.stats),
+            await run_workload('keyset', handler.dispatch, list_commands(5, action='keyset'), stats=simulator.stats),
+            await run_workload('batch', handler.dispatch, batch_commands(10, size=120), stats=simulator.stats),
+            await run_workload('default', handler.dispatch, default_commands(100), stats=simulator.stats),
+        ]
+        await client.close()
+
+    for result in results:
+        assert len(result.latencies) == result.commands
+        assert result.errors == 0
+        assert result.throttled == 0
+
+    by_name = {result.name: result for result in results}
+    # first page + one batch of 19 pages
+    assert by_name['list'].requests_per_command == 2
+    # 120 sub commands: 3 batch requests
+    assert by_name['batch'].requests_per_command == 3
+    assert by_name['default'].requests_per_command == 1
@@ -7,6 +7,9 @@ import ujson
 from aio_pika import ExchangeType
 
 from bridge.conf import settings
+from bridge.utils.amqp.chunks import chunk_messages
+from bridge.utils.amqp.compression import compress, get_codec
+from bridge.utils.amqp.serializers import get_serializer, JSONSerializer
 
 
 class MessageProducer(ABC):
@@ -20,19 +23,186 @@ class MessageProducer(ABC):
         raise NotImplemented
 
     @abstractmethod
-    async def send(self, message):
+    async def send(self, message, content_type=None):
         raise NotImplemented
 
+    async def flush(self):
+        """
+        Publish messages waiting in send buffer, used by producers with send buffer
+        Messages taken by concurrent flush may be not published yet, await futures returned by send() for them
+        """
+
     class Meta:
         abstract = True
 
 
-class RabbitMQProducer(MessageProducer):
+class PublishBuffer:
+    """
+    Send buffer for pipelined publishing
+
+    Messages are collected and published by groups, when buffer size reached or flush interval passed.
+    All messages of group are published without waiting each other,
+    with publisher confirms whole group awaits confirms in parallel
+    """
+
+    def __init__(self, publish: typing.Callable[[aio_pika.Message, str], typing.Awaitable],
+                 max_size: int, flush_interval: float, loop=None):
+        """
+        :param publish: async function(message, routing_key)
+        :param max_size: max count of messages in buffer
+        :param flush_interval: max seconds message waits in buffer
+        :param loop: event loop
+        """
+        self._publish = publish
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+
+        self._messages: typing.List[typing.Tuple[aio_pika.Message, str, asyncio.Future]] = []
+        self._timer: typing.Optional[asyncio.TimerHandle] = None
+
+    def __len__(self):
+        return len(self._messages)
+
+    async def put(self, message: aio_pika.Message, routing_key: str) -> asyncio.Future:
+        """
+        Add message to buffer
+        :param message:
+        :param routing_key:
+        :return: future, resolved when message is published (and confirmed)
+        """
+        future = self.loop.create_future()
+        self._messages.append((message, routing_key, future))
+
+        if len(self._messages) >= self.max_size:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(self.flush_interval, self._flush_later)
+
+        return future
+
+    def _flush_later(self):
+        self._timer = None
+        asyncio.ensure_future(self.flush(), loop=self.loop)
+
+    async def flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        messages, self._messages = self._messages, []
+        if not messages:
+            return
+
+        results = await asyncio.gather(
+            *[self._publish(message, routing_key) for message, routing_key, _ in messages],
+            return_exceptions=True
+        )
+
+        for (_, _, future), result in zip(messages, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class RabbitMQPublisherMixin:
+    """
+    Publishing shared by RabbitMQProducer and RabbitMQClient:
+    serialization by content type, compression, chunks of large messages and send buffer
+
+    Class should have loop, routing_key, connection, exchange and connect()
+    """
+    _json_dumps = ujson.dumps
+
+    def _init_publisher(self, publisher_confirms=None, buffer_size=None, flush_interval=None,
+                        compression=None, compression_threshold=None, compression_level=None,
+                        content_type=None, max_message_size=None):
+        """
+        Publishing settings, params are described in RabbitMQClient
+        """
+        self.publisher_confirms = settings.RABBITMQ_PUBLISHER_CONFIRMS \
+            if publisher_confirms is None else publisher_confirms
+        self.compression = settings.RABBITMQ_COMPRESSION if compression is None else compression
+        if self.compression:
+            get_codec(self.compression)
+        self.compression_threshold = settings.RABBITMQ_COMPRESSION_THRESHOLD \
+            if compression_threshold is None else compression_threshold
+        self.compression_level = compression_level or settings.RABBITMQ_COMPRESSION_LEVEL
+        self.content_type = get_serializer(content_type or settings.RABBITMQ_CONTENT_TYPE).content_type
+        self.max_message_size = settings.RABBITMQ_MAX_MESSAGE_SIZE if max_message_size is None else max_message_size
+
+        buffer_size = settings.RABBITMQ_PUBLISH_BUFFER_SIZE if buffer_size is None else buffer_size
+        self.buffer = PublishBuffer(
+            publish=self.publish,
+            max_size=buffer_size,
+            flush_interval=flush_interval or settings.RABBITMQ_PUBLISH_FLUSH_INTERVAL,
+            loop=self.loop,
+        ) if buffer_size else None
+
+    def serialize(self, message: dict, content_type: typing.Optional[str] = None) -> bytes:
+        """
+        :param message:
+        :param content_type: serializer content type, JSON is serialized by _json_dumps
+        :return:
+        """
+        serializer = get_serializer(content_type)
+        if isinstance(serializer, JSONSerializer):
+            return self._json_dumps(message).encode()
+        return serializer.dumps(message)
+
+    async def publish(self, message: aio_pika.Message, routing_key: str):
+        if self.connection is None or self.exchange is None:
+            await self.connect()
+
+        return await self.exchange.publish(message, routing_key=routing_key)
+
+    async def send(self, message: dict, content_type: typing.Optional[str] = None):
+        """
+        Publish message, if send buffer is used, message is only added to buffer
+        Message over max_message_size is published as chunks, see bridge.utils.amqp.chunks
+        :param message:
+        :param content_type: format of message, by default client content_type
+        :return: publish result or future, resolved when message (all chunks) is published from buffer
+        """
+        content_type = content_type or self.content_type
+        body, content_encoding = self.serialize(message, content_type), None
+        if self.compression and len(body) >= self.compression_threshold:
+            # large body is compressed in thread, so event loop is not blocked
+            body, content_encoding = await self.loop.run_in_executor(
+                None, compress, body, self.compression, 0, self.compression_level
+            )
+
+        amqp_messages = chunk_messages(
+            body, self.max_message_size, content_type=content_type, content_encoding=content_encoding
+        )
+
+        if self.buffer is None:
+            result = None
+            for amqp_message in amqp_messages:
+                result = await self.publish(amqp_message, self.routing_key)
+            return result
+
+        futures = [await self.buffer.put(amqp_message, self.routing_key) for amqp_message in amqp_messages]
+        return futures[0] if len(futures) == 1 else asyncio.gather(*futures)
+
+    async def flush(self):
+        if self.buffer is not None:
+            await self.buffer.flush()
+
+
+class RabbitMQProducer(RabbitMQPublisherMixin, MessageProducer):
 
     def __init__(self, connection_url=None, *,
                  host=None, port=None, user=None, password=None, routing_key=None,
                  exchange=None, exchange_durable=None, exchange_type=None,
-                 virtual_host=None, loop=None):
+                 virtual_host=None, publisher_confirms=None, buffer_size=None, flush_interval=None,
+                 compression=None, compression_threshold=None, compression_level=None, content_type=None,
+                 max_message_size=None, loop=None):
         """
         Realisation of Message Producer for RabbitMQ
         Required connection_url or params
@@ -46,6 +216,14 @@ class RabbitMQProducer(MessageProducer):
         :param exchange_durable: bool
         :param exchange_type: ExchangeType
         :param virtual_host: str
+        :param publisher_confirms: bool - wait broker confirm for each published message
+        :param buffer_size: int - send buffer size, 0 - publish each message immediately
+        :param flush_interval: float - max seconds message waits in send buffer
+        :param compression: str - gzip or deflate, empty - send messages without compression
+        :param compression_threshold: int - min size in bytes of compressed message
+        :param compression_level: int - 1 (fast) - 9 (small)
+        :param content_type: str - default format of sent messages, e.g. application/json, application/msgpack
+        :param max_message_size: int - max body size in bytes, larger message is sent by chunks, 0 - without limit
         :param loop: event loop
         """
         self.connection_url = connection_url or settings.RABBITMQ_URL
@@ -68,6 +246,12 @@ class RabbitMQProducer(MessageProducer):
         self.channel = None
         self.exchange = None
 
+        self._init_publisher(
+            publisher_confirms=publisher_confirms, buffer_size=buffer_size, flush_interval=flush_interval,
+            compression=compression, compression_threshold=compression_threshold,
+            compression_level=compression_level, content_type=content_type, max_message_size=max_message_size,
+        )
+
     async def connect(self):
         if self.connection is None or self.connection.is_closed:
             if self.connection_url:
@@ -79,7 +263,7 @@ class RabbitMQProducer(MessageProducer):
                     virtualhost=self.virtual_host,
                     loop=self.loop,
                 )
-            self.channel = await self.connection.channel()
+            self.channel = await self.connection.channel(publisher_confirms=self.publisher_confirms)
             self.exchange = await self.channel.declare_exchange(
                 self.exchange_name, auto_delete=False, type=self.exchange_type,
                 durable=self.exchange_durable
@@ -87,6 +271,7 @@ class RabbitMQProducer(MessageProducer):
         return self.connection
 
     async def close(self):
+        await self.flush()
         if self.connection and self.connection.is_open:
             await self.connection.close()
             await self.channel.close()
@@ -101,18 +286,6 @@ class RabbitMQProducer(MessageProducer):
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await self.close()
 
-    async def send(self, message: dict):
-        if self.connection is None or self.exchange is None:
-            await self.connect()
-
-        body = ujson.dumps(message).encode()
-
-        response = await self.exchange.publish(
-            aio_pika.Message(body=body, content_type='application/json'),
-            routing_key=self.routing_key
-        )
-        return response
-
 
 class MessageConsumer(ABC):
 
@@ -136,7 +309,7 @@ class RabbitMQConsumer(MessageConsumer):
 
     def __init__(self, connection_url=None, *,
                  host=None, port=None, user=None, password=None, queue=None, queue_durable=None,
-                 exchange=None, virtual_host=None, loop=None):
+                 exchange=None, virtual_host=None, prefetch_count=None, loop=None):
         """
         Realisation of Message Producer for RabbitMQ
         Required connection_url or params
@@ -149,6 +322,7 @@ class RabbitMQConsumer(MessageConsumer):
         :param queue_durable: str
         :param exchange: str
         :param virtual_host: str
+        :param prefetch_count: int - max count of unacknowledged messages
         :param loop: event loop
         """
         self.connection_url = connection_url or settings.RABBITMQ_URL
@@ -160,6 +334,7 @@ class RabbitMQConsumer(MessageConsumer):
         self.password = password or settings.RABBITMQ_PASS
         self.exchange_name = exchange or settings.RABBITMQ_EXCHANGE
         self.queue_durable = queue_durable or settings.RABBITMQ_QUEUE_DURABLE
+        self.prefetch_count = prefetch_count or settings.RABBITMQ_PREFETCH_COUNT
         if loop is None:
             loop = asyncio.get_event_loop()
         self.loop = loop
@@ -195,6 +370,7 @@ class RabbitMQConsumer(MessageConsumer):
         connection = await self.connect()
 
         channel = await connection.channel()
+        await channel.set_qos(prefetch_count=self.prefetch_count)
 
         queue = await channel.declare_queue(
             self.queue, auto_delete=False, durable=self.queue_durable
@@ -207,12 +383,15 @@ class MessageClient(MessageProducer, MessageConsumer, ABC):
         abstract = True
 
 
-class RabbitMQClient(MessageClient):
+class RabbitMQClient(RabbitMQPublisherMixin, MessageClient):
 
     def __init__(self, connection_url=None, *,
                  host=None, port=None, user=None, password=None, queue=None, queue_durable=None,
                  routing_key=None,
-                 exchange=None, exchange_type=None, exchange_durable=None, virtual_host=None, loop=None):
+                 exchange=None, exchange_type=None, exchange_durable=None, virtual_host=None,
+                 prefetch_count=None, publisher_confirms=None, buffer_size=None, flush_interval=None,
+                 max_priority=None, compression=None, compression_threshold=None, compression_level=None,
+                 content_type=None, max_message_size=None, loop=None):
         """
         Realisation of Message Producer for RabbitMQ
         Required connection_url or params
@@ -225,6 +404,16 @@ class RabbitMQClient(MessageClient):
         :param queue_durable: str
         :param exchange: str
         :param virtual_host: str
+        :param prefetch_count: int - max count of unacknowledged command messages
+        :param publisher_confirms: bool - wait broker confirm for each published message
+        :param buffer_size: int - send buffer size, 0 - publish each message immediately
+        :param flush_interval: float - max seconds message waits in send buffer
+        :param max_priority: int - x-max-priority of command queue, 0 - queue without priorities
+        :param compression: str - gzip or deflate, empty - send messages without compression
+        :param compression_threshold: int - min size in bytes of compressed message
+        :param compression_level: int - 1 (fast) - 9 (small)
+        :param content_type: str - default format of sent messages, e.g. application/json, application/msgpack
+        :param max_message_size: int - max body size in bytes, larger message is sent by chunks, 0 - without limit
         :param loop: event loop
         """
         self.connection_url = connection_url or settings.RABBITMQ_URL
@@ -243,6 +432,8 @@ class RabbitMQClient(MessageClient):
         )
 
         self.routing_key = routing_key or settings.RABBITMQ_ROUTING_KEY
+        self.prefetch_count = prefetch_count or settings.RABBITMQ_PREFETCH_COUNT
+        self.max_priority = settings.RABBITMQ_COMMAND_QUEUE_MAX_PRIORITY if max_priority is None else max_priority
 
         if loop is None:
             loop = asyncio.get_event_loop()
@@ -252,6 +443,12 @@ class RabbitMQClient(MessageClient):
         self.channel = None
         self.exchange = None
 
+        self._init_publisher(
+            publisher_confirms=publisher_confirms, buffer_size=buffer_size, flush_interval=flush_interval,
+            compression=compression, compression_threshold=compression_threshold,
+            compression_level=compression_level, content_type=content_type, max_message_size=max_message_size,
+        )
+
     async def connect(self):
         if self.connection is None or self.connection.is_closed:
             if self.connection_url:
@@ -263,12 +460,12 @@ class RabbitMQClient(MessageClient):
                     virtualhost=self.virtual_host,
                     loop=self.loop,
                 )
-                self.channel = await self.connection.channel()
+            self.channel = await self.connection.channel(publisher_confirms=self.publisher_confirms)
 
-                self.exchange = await self.channel.declare_exchange(
-                    self.exchange_name, auto_delete=False, type=self.exchange_type,
-                    durable=self.exchange_durable
-                )
+            self.exchange = await self.channel.declare_exchange(
+                self.exchange_name, auto_delete=False, type=self.exchange_type,
+                durable=self.exchange_durable
+            )
         return self.connection
 
     async def get_connection(self):
@@ -281,15 +478,16 @@ class RabbitMQClient(MessageClient):
         if not self.connection or self.connection.is_closed:
             await self.connect()
 
-        if self.channel or self.channel.is_closed:
+        if not self.channel or self.channel.is_closed:
             """
             If connection is active, but channel closed
             """
-            self.channel = await self.connection.channel()
+            self.channel = await self.connection.channel(publisher_confirms=self.publisher_confirms)
 
         return self.channel
 
     async def close(self):
+        await self.flush()
         if self.connection and self.connection.is_open:
             await self.connection.close()
             await self.channel.close()
@@ -304,18 +502,6 @@ class RabbitMQClient(MessageClient):
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await self.close()
 
-    async def send(self, message: dict):
-        if self.connection is None or self.exchange is None:
-            await self.connect()
-
-        body = ujson.dumps(message).encode()
-
-        response = await self.exchange.publish(
-            aio_pika.Message(body=body, content_type='application/json'),
-            routing_key=self.routing_key
-        )
-        return response
-
     async def receive(self, callback):
         """
         Add listener on queue
@@ -323,8 +509,10 @@ class RabbitMQClient(MessageClient):
         :return:
         """
         channel = await self.get_channel()
+        await channel.set_qos(prefetch_count=self.prefetch_count)
 
         queue = await channel.declare_queue(
-            self.queue, auto_delete=False, durable=self.queue_durable
+            self.queue, auto_delete=False, durable=self.queue_durable,
+            arguments={'x-max-priority': self.max_priority} if self.max_priority else None,
         )
         return await queue.consume(callback)
@@ -0,0 +1,134 @@
+"""
+Chunked messages: body over size ceiling is published as ordered chunk messages
+
+Chunks share correlation_id, content_type and content_encoding of whole body,
+headers x-chunk-index (from 0) and x-chunk-count define the order.
+Body is split after serialization and compression, so chunks are joined before decoding.
+"""
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import aio_pika
+
+from bridge.utils.amqp.compression import decompress
+from bridge.utils.amqp.serializers import get_serializer
+
+CHUNK_INDEX_HEADER = 'x-chunk-index'
+CHUNK_COUNT_HEADER = 'x-chunk-count'
+
+
+def split_body(body: bytes, max_size: int) -> List[bytes]:
+    return [body[offset: offset + max_size] for offset in range(0, len(body), max_size)] or [body]
+
+
+def chunk_messages(body: bytes, max_size: int, **properties) -> List[aio_pika.Message]:
+    """
+    Messages of body, single message if body is not over max_size
+    :param body: serialized (and compressed) message
+    :param max_size: max body size of one message in bytes, 0 - without limit
+    :param properties: aio_pika.Message properties, e.g. content_type
+    :return:
+    """
+    if not max_size or len(body) <= max_size:
+        return [aio_pika.Message(body=body, **properties)]
+
+    chunks = split_body(body, max_size)
+    correlation_id = uuid.uuid4().hex
+    return [
+        aio_pika.Message(
+            body=chunk,
+            correlation_id=correlation_id,
+            headers={CHUNK_INDEX_HEADER: index, CHUNK_COUNT_HEADER: len(chunks)},
+            **properties
+        )
+        for index, chunk in enumerate(chunks)
+    ]
+
+
+def decode_body(body: bytes, content_type: Optional[str] = None, content_encoding: Optional[str] = None) -> Any:
+    """
+    Decompress and deserialize message body
+    """
+    return get_serializer(content_type).loads(decompress(body, content_encoding))
+
+
+class ChunkAssembler:
+    """
+    Reassemble chunked messages on consumer side
+
+        assembler = ChunkAssembler()
+
+        async def on_message(message: aio_pika.IncomingMessage):
+            async with message.process():
+                data = assembler.feed(message)
+                if data is not None:
+                    process(data)
+
+    Chunks may arrive in any order and interleaved with other messages,
+    incomplete messages are dropped after ttl seconds or when there are more than max_pending of them.
+    """
+
+    def __init__(self, ttl: float = 600, max_pending: int = 100):
+        """
+        :param ttl: seconds to wait the rest chunks of message
+        :param max_pending: max count of incomplete messages
+        """
+        self.ttl = ttl
+        self.max_pending = max_pending
+        # correlation_id -> (first chunk time, chunks count, index -> chunk)
+        self._pending: 'OrderedDict[str, Tuple[float, int, Dict[int, bytes]]]' = OrderedDict()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def feed(self, message) -> Optional[Any]:
+        """
+        Add message
+        :param message: aio_pika.IncomingMessage
+        :return: decoded data of whole message or None if chunks of message are not complete yet
+        """
+        headers = message.headers or {}
+        if headers.get(CHUNK_COUNT_HEADER) is None:
+            body = message.body
+        else:
+            body = self.add_chunk(
+                message.correlation_id, int(headers[CHUNK_INDEX_HEADER]), int(headers[CHUNK_COUNT_HEADER]),
+                message.body,
+            )
+            if body is None:
+                return None
+
+        return decode_body(body, message.content_type, message.content_encoding)
+
+    def add_chunk(self, correlation_id: str, index: int, count: int, chunk: bytes) -> Optional[bytes]:
+        """
+        :return: joined body if all chunks received, else None
+        """
+        self._expire()
+
+        pending = self._pending.get(correlation_id)
+        if pending is None:
+            pending = self._pending[correlation_id] = (time.monotonic(), count, {})
+            while len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+                self.dropped += 1
+
+        _, count, chunks = pending
+        chunks[index] = chunk
+        if len(chunks) < count:
+            return None
+
+        del self._pending[correlation_id]
+        return b''.join(chunks[i] for i in range(count))
+
+    def _expire(self) -> None:
+        expired_at = time.monotonic() - self.ttl
+        while self._pending:
+            correlation_id, (created_at, _, _) = next(iter(self._pending.items()))
+            if created_at > expired_at:
+                break
+            del self._pending[correlation_id]
+            self.dropped += 1
@@ -0,0 +1,56 @@
+"""
+Compression of AMQP message body, content_encoding property names the algorithm
+"""
+import gzip
+import zlib
+from typing import Callable, Dict, Optional, Tuple
+
+# content_encoding -> (compress(data, level), decompress(data))
+CODECS: Dict[str, Tuple[Callable[[bytes, int], bytes], Callable[[bytes], bytes]]] = {
+    'gzip': (lambda data, level: gzip.compress(data, compresslevel=level), gzip.decompress),
+    'deflate': (zlib.compress, zlib.decompress),
+}
+
+
+class UnsupportedEncoding(ValueError):
+    pass
+
+
+def get_codec(encoding: str):
+    try:
+        return CODECS[encoding.lower()]
+    except KeyError:
+        raise UnsupportedEncoding(f"Unsupported content encoding: {encoding}, supported: {', '.join(CODECS)}")
+
+
+def compress(body: bytes, encoding: Optional[str], threshold: int = 0, level: int = 1
+             ) -> Tuple[bytes, Optional[str]]:
+    """
+    Compress body, if it is not less than threshold
+    :param body: serialized message
+    :param encoding: gzip or deflate, empty - without compression
+    :param threshold: min body size in bytes to compress
+    :param level: compression level 1 (fast) - 9 (small)
+    :return: tuple(body, content_encoding or None if body is not compressed)
+    """
+    if not encoding or len(body) < threshold:
+        return body, None
+
+    compress_func, _ = get_codec(encoding)
+    return compress_func(body, level), encoding.lower()
+
+
+def decompress(body: bytes, content_encoding: Optional[str]) -> bytes:
+    """
+    Decompress body by content_encoding, body with other encodings (e.g. charset) is returned as is
+    :param body: message body
+    :param content_encoding: content_encoding property of message
+    :return:
+    """
+    if not content_encoding:
+        return body
+
+    codec = CODECS.get(content_encoding.lower())
+    if codec is None:
+        return body
+    return codec[1](body)
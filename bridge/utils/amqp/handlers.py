@@ -1,13 +1,21 @@
+import asyncio
 import json
-from typing import Dict, Union, Any, List
+import time
+from typing import Dict, Union, Any, List, Optional
 
 import aio_pika
 import ujson
 
+from bridge.conf import settings
 from bridge.extensions import ext
 from bridge.utils.amqp.amqp import MessageClient
-from bridge.utils.commands import CommandResponse, ResponseModem
+from bridge.utils.amqp.compression import decompress
+from bridge.utils.amqp.serializers import get_serializer, JSONSerializer, UnsupportedContentType
+from bridge.utils.bitrix24.limiter import current_priority
+from bridge.utils.commands import Command, CommandResponse, ResponseModem
 from bridge.utils.commands.handlers import BaseCommandHandler
+from bridge.utils.commands.utils import get_priority
+from bridge.utils.metrics import AMQP_COMMAND_LAG, AMQP_COMMANDS_IN_FLIGHT
 
 
 class AbstractHandler(object):
@@ -19,43 +27,180 @@ class AbstractHandler(object):
     async def handle(self, message) -> None:
         raise NotImplementedError
 
-    async def json(self, message: Union[str, bytes]) -> Any:
+    async def json(self, message: Union[str, bytes], content_encoding: Optional[str] = None) -> Any:
         """
-        Parse JSON from string or bytes
+        Parse JSON from string or bytes, compressed message (gzip, deflate) is decompressed
 
         @override _json_loads to change processor
 
         :param message:
+        :param content_encoding: content_encoding property of AMQP message
         :return:
         """
+        if content_encoding and isinstance(message, bytes):
+            message = decompress(message, content_encoding)
         return self._json_loads(message)
 
+    async def decode(self, message) -> Any:
+        """
+        Parse message body by content_type (JSON by default) and content_encoding properties
+        :param message: aio_pika.IncomingMessage
+        :return:
+        :raise UnsupportedContentType:
+        """
+        content_encoding = getattr(message, 'content_encoding', None)
+        serializer = get_serializer(getattr(message, 'content_type', None))
+        if isinstance(serializer, JSONSerializer):
+            return await self.json(message.body, content_encoding)
+        return serializer.loads(decompress(message.body, content_encoding))
+
 
 class AMQPHandler(AbstractHandler):
     _json_loads = ujson.loads
 
-    def __init__(self, client: MessageClient, command_handler: BaseCommandHandler = None):
+    def __init__(self, client: MessageClient, command_handler: BaseCommandHandler = None,
+                 workers: Optional[int] = None, action_workers: Optional[Dict[str, int]] = None):
         """
         Handle command message from RabbitMQ queue, start process and send result back
         :param client: amqp.MessageClient
+        :param command_handler:
+        :param workers: max count of commands processed in parallel
+        :param action_workers: max count of commands processed in parallel for action, e.g. {"list": 2}
         """
         self.client = client
         self.command_handler = command_handler or ext.command_handler
 
+        self._workers = asyncio.Semaphore(workers or settings.COMMAND_WORKERS)
+        self._action_workers: Dict[str, asyncio.Semaphore] = {
+            action: asyncio.Semaphore(count)
+            for action, count in (action_workers or settings.COMMAND_ACTION_WORKERS).items()
+        }
+
     async def handle(self, message: aio_pika.IncomingMessage) -> None:
+        consumed_at = time.monotonic()
+
         async with message.process() as msg:
-            data = await self.json(msg.body)
+            data = await self.decode(msg)
             ext.logger.info(data)
 
-            response: List[CommandResponse] = await self.command_handler(data)
+            action = data.get('action') or 'default'
+            # meta.priority overrides priority of message
+            priority = get_priority(data.get('meta'), getattr(msg, 'priority', None))
+            priority_token = current_priority.set(priority) if priority is not None else None
+
+            in_flight = AMQP_COMMANDS_IN_FLIGHT.labels(action)
+            in_flight.inc()
+            try:
+                # wait action limit first, so command waiting for action not hold worker
+                action_workers = self._action_workers.get(action)
+                if action_workers is None:
+                    async with self._workers:
+                        await self.process(data)
+                else:
+                    async with action_workers, self._workers:
+                        await self.process(data)
+            finally:
+                if priority_token is not None:
+                    current_priority.reset(priority_token)
+                in_flight.dec()
+                AMQP_COMMAND_LAG.labels(action).observe(time.monotonic() - consumed_at)
+
+    async def process(self, data: Dict) -> None:
+        """
+        Process command and send result
+        :param data: command data
+        :return:
+        """
+        entity: str = data.get('method').rsplit('.', 1)[0] if 'method' in data else 'default'
 
-            entity: str = data.get('method').rsplit('.', 1)[0] if 'method' in data else 'default'
+        meta = data.get('meta')
+        if isinstance(meta, dict) and meta.get('stream'):
+            await self.handle_stream(data, entity)
+            return
 
-            response_data = {
-                "entity": entity,
-                "result": ResponseModem(response)
-            }
+        response: List[CommandResponse] = await self.command_handler(data)
+
+        response_data = {
+            "entity": entity,
+            "result": ResponseModem(response)
+        }
+
+        published = await self.client.send(
+            response_data, content_type=self.get_reply_content_type(data)
+        )
+        await self.wait_published([published])
 
-            await self.client.send(
-                response_data
-            )
+    async def wait_published(self, results: List[Any]) -> None:
+        """
+        Wait publishing of command results, so command is acked after its results are published.
+        Buffered messages are published when buffer is full or flush interval passed,
+        together with results of other commands
+        :param results: values returned by client.send(), futures of buffered messages
+        :raise: publish error
+        """
+        futures = [result for result in results if asyncio.isfuture(result)]
+        if futures:
+            await asyncio.gather(*futures)
+
+    @staticmethod
+    def get_reply_content_type(data: Dict) -> Optional[str]:
+        """
+        Format of result requested by meta.accept, None - client default format
+        :param data: command data
+        :return:
+        """
+        meta = data.get('meta')
+        accept = meta.get('accept') if isinstance(meta, dict) else None
+        if not accept:
+            return None
+
+        try:
+            return get_serializer(accept).content_type
+        except UnsupportedContentType as e:
+            ext.logger.error(f"Error on reply format, default is used: {str(e)}")
+            return None
+
+    async def handle_stream(self, data: Dict, entity: str) -> None:
+        """
+        Publish each page of command result as separate message as soon as it arrives
+
+        Every message has "stream" info: seq - message number, offset - number of records sent before,
+        done - last message marker, last message has empty result and total records count
+        :param data: command data
+        :param entity:
+        :return:
+        """
+        seq = 0
+        offset = 0
+        error = None
+        content_type = self.get_reply_content_type(data)
+        published = []
+
+        try:
+            async for response in self.command_handler.stream(data):
+                published.append(await self.client.send({
+                    "entity": entity,
+                    "result": ResponseModem(response),
+                    "stream": {
+                        "seq": seq,
+                        "offset": offset,
+                        "done": False,
+                    }
+                }, content_type=content_type))
+                seq += 1
+                offset += sum(len(unit.result) for unit in response)
+        except Exception as e:
+            ext.logger.error(f"Error on stream cmd: {str(e)}")
+            error = str(e)
+
+        published.append(await self.client.send({
+            "entity": entity,
+            "result": ResponseModem([CommandResponse(cmd=Command(**data), total=offset)]),
+            "stream": {
+                "seq": seq,
+                "offset": offset,
+                "done": True,
+                "error": error,
+            }
+        }, content_type=content_type))
+        await self.wait_published(published)
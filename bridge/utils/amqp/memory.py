@@ -0,0 +1,84 @@
+import asyncio
+import typing
+
+from bridge.utils.amqp.amqp import MessageClient
+from bridge.utils.amqp.serializers import get_serializer
+
+
+class MemoryMessage:
+    """
+    Incoming message of MemoryBroker, same interface as aio_pika.IncomingMessage used by handlers
+    """
+
+    def __init__(self, body: bytes, headers: typing.Optional[typing.Dict] = None, **properties):
+        self.body = body
+        self.headers = headers or {}
+        self.content_type = properties.pop('content_type', 'application/json')
+        self.content_encoding = properties.pop('content_encoding', None)
+        self.priority = properties.pop('priority', None)
+        self.correlation_id = properties.pop('correlation_id', None)
+        for name, value in properties.items():
+            setattr(self, name, value)
+
+    def process(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class MemoryBroker(MessageClient):
+    """
+    In-process stand-in of RabbitMQ for benchmarks and tests
+
+    Commands published by publish_command() are delivered to consumer callback (AMQPHandler.handle)
+    with prefetch limit as on RabbitMQ channel, messages sent by handler are passed to on_message.
+    Messages are serialized by their content type as on real broker, so serialization cost is measured.
+    """
+
+    def __init__(self, on_message: typing.Callable[[typing.Dict], None], prefetch_count: int = 20):
+        """
+        :param on_message: callback for each message sent by handler
+        :param prefetch_count: max count of commands delivered to consumer and not processed yet
+        """
+        self.on_message = on_message
+        self.prefetch_count = prefetch_count
+
+        self._callback: typing.Optional[typing.Callable] = None
+        self._prefetch = asyncio.Semaphore(prefetch_count)
+        self._tasks: typing.Set[asyncio.Future] = set()
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def receive(self, callback):
+        self._callback = callback
+
+    async def publish_command(self, data: typing.Dict, **properties) -> None:
+        """
+        Publish command and deliver it to consumer, waits while prefetch limit is reached
+        """
+        body = get_serializer(properties.get('content_type')).dumps(data)
+        message = MemoryMessage(body, **properties)
+
+        await self._prefetch.acquire()
+        task = asyncio.ensure_future(self._deliver(message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, message: MemoryMessage) -> None:
+        try:
+            await self._callback(message)
+        finally:
+            self._prefetch.release()
+
+    async def send(self, message: typing.Dict, content_type: typing.Optional[str] = None):
+        serializer = get_serializer(content_type)
+        self.on_message(serializer.loads(serializer.dumps(message)))
@@ -0,0 +1,176 @@
+"""
+Serializers of AMQP messages, selected by content_type property
+
+application/json - default
+application/msgpack - compact binary format, requires msgpack package
+application/vnd.bridge.columnar+json, application/vnd.bridge.columnar+msgpack - lists of records
+with the same fields are written as {"$columns": [field, ...], "$rows": [[value, ...], ...]},
+so field names are written once per list instead of once per record,
+keys of other dicts starting with "$" are escaped by one more "$" (e.g. "$rows" -> "$$rows")
+"""
+from typing import Any, Dict, List, Optional
+
+import ujson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+COLUMNAR_JSON_CONTENT_TYPE = 'application/vnd.bridge.columnar+json'
+COLUMNAR_MSGPACK_CONTENT_TYPE = 'application/vnd.bridge.columnar+msgpack'
+
+COLUMNS_KEY = '$columns'
+ROWS_KEY = '$rows'
+ESCAPE_PREFIX = '$'
+
+
+class UnsupportedContentType(ValueError):
+    pass
+
+
+class Serializer:
+    content_type = ''
+
+    def dumps(self, data: Any) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+
+class JSONSerializer(Serializer):
+    content_type = JSON_CONTENT_TYPE
+    _json_dumps = ujson.dumps
+    _json_loads = ujson.loads
+
+    def dumps(self, data: Any) -> bytes:
+        return self._json_dumps(data).encode()
+
+    def loads(self, data: bytes) -> Any:
+        return self._json_loads(data)
+
+
+class MsgPackSerializer(Serializer):
+    content_type = MSGPACK_CONTENT_TYPE
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("MsgPackSerializer requires msgpack package")
+
+    def dumps(self, data: Any) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+
+def to_columns(data: Any) -> Any:
+    """
+    Replace lists of dicts with the same keys by columnar form,
+    escape "$" keys of dicts, so they aren't mixed up with columnar form
+    """
+    if isinstance(data, dict):
+        return {_escape_key(key): to_columns(value) for key, value in data.items()}
+
+    if isinstance(data, (list, tuple)):
+        if len(data) > 1 and isinstance(data[0], dict):
+            columns = list(data[0])
+            keys = set(columns)
+            if all(isinstance(item, dict) and len(item) == len(keys) and keys.issuperset(item) for item in data):
+                return {
+                    COLUMNS_KEY: columns,
+                    ROWS_KEY: [[to_columns(item[key]) for key in columns] for item in data],
+                }
+        return [to_columns(item) for item in data]
+
+    return data
+
+
+def from_columns(data: Any) -> Any:
+    """
+    Reverse of to_columns
+    """
+    if isinstance(data, dict):
+        if len(data) == 2 and COLUMNS_KEY in data and ROWS_KEY in data:
+            columns = data[COLUMNS_KEY]
+            return [
+                dict(zip(columns, [from_columns(value) for value in row]))
+                for row in data[ROWS_KEY]
+            ]
+        return {_unescape_key(key): from_columns(value) for key, value in data.items()}
+
+    if isinstance(data, list):
+        return [from_columns(item) for item in data]
+
+    return data
+
+
+def _escape_key(key: Any) -> Any:
+    if isinstance(key, str) and key.startswith(ESCAPE_PREFIX):
+        return ESCAPE_PREFIX + key
+    return key
+
+
+def _unescape_key(key: Any) -> Any:
+    if isinstance(key, str) and key.startswith(ESCAPE_PREFIX):
+        return key[len(ESCAPE_PREFIX):]
+    return key
+
+
+class ColumnarSerializer(Serializer):
+    """
+    Columnar lists over other serializer
+    """
+
+    def __init__(self, base: Serializer, content_type: str):
+        self.base = base
+        self.content_type = content_type
+
+    def dumps(self, data: Any) -> bytes:
+        return self.base.dumps(to_columns(data))
+
+    def loads(self, data: bytes) -> Any:
+        return from_columns(self.base.loads(data))
+
+
+SERIALIZERS: Dict[str, Serializer] = {}
+
+
+def register(serializer: Serializer, *aliases: str) -> None:
+    """
+    Register serializer for its content_type and aliases, replaces serializer of the same content type
+    """
+    for content_type in (serializer.content_type,) + aliases:
+        SERIALIZERS[content_type.lower()] = serializer
+
+
+def get_serializer(content_type: Optional[str] = None) -> Serializer:
+    """
+    Serializer of content type, parameters (e.g. "; charset=utf-8") are ignored
+    :param content_type: empty - JSON
+    :return:
+    :raise UnsupportedContentType:
+    """
+    if not content_type:
+        return SERIALIZERS[JSON_CONTENT_TYPE]
+
+    serializer = SERIALIZERS.get(content_type.split(';', 1)[0].strip().lower())
+    if serializer is None:
+        raise UnsupportedContentType(
+            f"Unsupported content type: {content_type}, supported: {', '.join(supported_content_types())}"
+        )
+    return serializer
+
+
+def supported_content_types() -> List[str]:
+    return list(SERIALIZERS)
+
+
+register(JSONSerializer(), 'text/json')
+register(ColumnarSerializer(SERIALIZERS[JSON_CONTENT_TYPE], COLUMNAR_JSON_CONTENT_TYPE))
+if msgpack is not None:
+    register(MsgPackSerializer(), 'application/x-msgpack')
+    register(ColumnarSerializer(SERIALIZERS[MSGPACK_CONTENT_TYPE], COLUMNAR_MSGPACK_CONTENT_TYPE))
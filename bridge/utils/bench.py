@@ -0,0 +1,411 @@
+"""
+Throughput benchmark of command processing
+
+Workloads are lists of command dicts (as in AMQP message), they are dispatched with limited concurrency,
+result reports commands/s, upstream requests per command and latency percentiles.
+"""
+import asyncio
+import math
+import random
+import time
+import timeit
+from typing import Dict, List, Callable, Awaitable, Optional, Any
+
+import aio_pika
+import ujson
+from aiohttp.test_utils import TestServer
+
+from bridge.conf import settings
+from bridge.utils.amqp.amqp import RabbitMQClient
+from bridge.utils.amqp.chunks import ChunkAssembler
+from bridge.utils.amqp.handlers import AMQPHandler
+from bridge.utils.amqp.memory import MemoryBroker
+from bridge.utils.bitrix24.simulator import Bitrix24Simulator
+from bridge.utils.bitrix24.utils import prepare_batch, prepare_list_calls
+from bridge.utils.commands.handlers import CommandHandler
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    Nearest-rank percentile
+    :param values:
+    :param p: 0..100
+    :return: 0 for empty values
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+class BenchResult:
+    def __init__(self, name: str, commands: int, seconds: float, latencies: List[float],
+                 errors: int = 0, upstream_requests: int = 0, throttled: int = 0):
+        """
+        :param name: workload name
+        :param commands: count of processed commands
+        :param seconds: wall time of workload
+        :param latencies: seconds of each command
+        :param errors: count of failed commands
+        :param upstream_requests: count of requests to Bitrix24
+        :param throttled: count of requests rejected by Bitrix24 rate limit
+        """
+        self.name = name
+        self.commands = commands
+        self.seconds = seconds
+        self.latencies = latencies
+        self.errors = errors
+        self.upstream_requests = upstream_requests
+        self.throttled = throttled
+
+    @property
+    def rate(self) -> float:
+        return self.commands / self.seconds if self.seconds else 0.0
+
+    @property
+    def requests_per_command(self) -> float:
+        return self.upstream_requests / self.commands if self.commands else 0.0
+
+    def percentile(self, p: float) -> float:
+        return percentile(self.latencies, p)
+
+    def data(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'commands': self.commands,
+            'errors': self.errors,
+            'seconds': self.seconds,
+            'commands_per_second': self.rate,
+            'requests_per_command': self.requests_per_command,
+            'throttled': self.throttled,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }
+
+    def report(self) -> str:
+        return (
+            f"{self.name}: {self.commands} commands ({self.errors} errors) in {self.seconds:.2f} s, "
+            f"{self.rate:.1f} cmd/s, {self.requests_per_command:.2f} requests/cmd ({self.throttled} throttled), "
+            f"p50 {self.percentile(50) * 1000:.1f} ms, p99 {self.percentile(99) * 1000:.1f} ms"
+        )
+
+
+async def run_workload(name: str, dispatch: Callable[[Dict], Awaitable[Optional[Any]]], commands: List[Dict],
+                       concurrency: int = 10, stats: Optional[Callable[[], Dict[str, int]]] = None) -> BenchResult:
+    """
+    Dispatch commands with limited concurrency and measure each command
+    :param name: workload name
+    :param dispatch: e.g. CommandHandler.dispatch, None result is error
+    :param commands: command dicts
+    :param concurrency: max commands in parallel
+    :param stats: upstream counters, e.g. {"requests": 10, "throttled": 0}, difference is reported
+    :return:
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def process(command: Dict) -> None:
+        nonlocal errors
+        async with semaphore:
+            started_at = time.monotonic()
+            try:
+                response = await dispatch(command)
+            except Exception:
+                response = None
+            latencies.append(time.monotonic() - started_at)
+            if response is None:
+                errors += 1
+
+    before = stats() if stats else {}
+    started_at = time.monotonic()
+    await asyncio.gather(*[process(command) for command in commands])
+    seconds = time.monotonic() - started_at
+    after = stats() if stats else {}
+
+    return BenchResult(
+        name=name,
+        commands=len(commands),
+        seconds=seconds,
+        latencies=latencies,
+        errors=errors,
+        upstream_requests=after.get('requests', 0) - before.get('requests', 0),
+        throttled=after.get('throttled', 0) - before.get('throttled', 0),
+    )
+
+
+
+def run_encode_bench(calls_count: int = 50, filter_size: int = 1000, number: int = 10) -> Dict[str, float]:
+    """
+    Encoding of list() sub commands with big filter:
+    prepare_list_calls encodes common params once, prepare_batch encodes each sub command
+    :param calls_count: sub commands in batch
+    :param filter_size: count of IDs in filter
+    :param number: encodings of batch per measure, best of 3 measures is used
+    :return: ms per batch for each encoder
+    """
+    method = 'crm.product.list'
+    params = {
+        'filter': {'ID': list(range(filter_size)), 'ACTIVE': 'Y'},
+        'select': ['ID', 'NAME', 'PRICE', 'PROPERTY_*'],
+        'order': {'ID': 'ASC'},
+    }
+    starts = [i * 50 for i in range(1, calls_count + 1)]
+
+    def list_calls():
+        return prepare_list_calls(method, params, starts)
+
+    def batch():
+        return prepare_batch({str(start): (method, {**params, 'start': start}) for start in starts})
+
+    return {
+        name: min(timeit.repeat(func, number=number, repeat=3)) / number * 1000
+        for name, func in (('prepare_list_calls', list_calls), ('prepare_batch', batch))
+    }
+
+def list_commands(count: int, entity: str = 'crm.product', action: str = 'list') -> List[Dict]:
+    """
+    Load all entities, action list or keyset
+    """
+    return [
+        {'action': action, 'method': f"{entity}.list", 'params': {'select': ['ID', 'NAME']}}
+        for _ in range(count)
+    ]
+
+
+def batch_commands(count: int, size: int = 100, entity: str = 'crm.product', items_count: int = 1000) -> List[Dict]:
+    """
+    Batch of size get sub commands
+    """
+    return [
+        {
+            'action': 'batch',
+            'method': 'batch',
+            'params': {'cmd': {
+                f"cmd_{j}": f"{entity}.get?id={(i * size + j) % items_count + 1}" for j in range(size)
+            }},
+        }
+        for i in range(count)
+    ]
+
+
+def default_commands(count: int, entity: str = 'crm.product', items_count: int = 1000) -> List[Dict]:
+    """
+    Single get requests
+    """
+    return [
+        {'action': 'default', 'method': f"{entity}.get", 'params': {'id': i % items_count + 1}}
+        for i in range(count)
+    ]
+
+
+WORKLOADS = {
+    'list': list_commands,
+    'batch': batch_commands,
+    'default': default_commands,
+}
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    """
+    Workloads weights: "list=1,batch=2,default=7" -> {"list": 1, "batch": 2, "default": 7}
+    """
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.strip().partition('=')
+        if name not in WORKLOADS:
+            raise ValueError(f"Unknown workload: {name}, expected one of {list(WORKLOADS)}")
+        weights[name] = int(weight or 1)
+    return weights
+
+
+def mix_commands(mix: Dict[str, int], count: int, batch_size: int = 100, entity: str = 'crm.product',
+                 items_count: int = 1000, seed: int = 0) -> List[Dict]:
+    """
+    Commands of workloads in random order with weights
+    :param mix: workload -> weight
+    :param count: total count of commands
+    :param batch_size: sub commands in batch command
+    :param entity:
+    :param items_count: entity items count, ids of get commands
+    :param seed: random seed, same seed - same commands
+    """
+    names = random.Random(seed).choices(list(mix), weights=list(mix.values()), k=count)
+
+    pools = {
+        'list': iter(list_commands(names.count('list'), entity=entity)),
+        'batch': iter(batch_commands(names.count('batch'), size=batch_size, entity=entity, items_count=items_count)),
+        'default': iter(default_commands(names.count('default'), entity=entity, items_count=items_count)),
+    }
+    return [next(pools[name]) for name in names]
+
+
+class ResponseCollector:
+    """
+    Match published command results with waiting commands by meta.bench_id
+    """
+
+    def __init__(self):
+        self._waiters: Dict[str, asyncio.Future] = {}
+
+    def expect(self, bench_id: str) -> asyncio.Future:
+        future = asyncio.get_event_loop().create_future()
+        self._waiters[bench_id] = future
+        return future
+
+    def feed(self, message: Dict) -> None:
+        """
+        Process message sent by bridge: {"entity": ..., "result": [CommandResponse, ...]}
+        """
+        for unit in message.get('result') or []:
+            meta = unit.get('meta') if isinstance(unit, dict) else None
+            if not isinstance(meta, dict):
+                continue
+
+            future = self._waiters.pop(meta.get('bench_id'), None)
+            if future is not None and not future.done():
+                future.set_result(unit)
+
+
+async def run_publish_bench(name: str, publish: Callable[[Dict], Awaitable], collector: ResponseCollector,
+                            commands: List[Dict], rate: float = 0, timeout: float = 60,
+                            stats: Optional[Callable[[], Dict[str, int]]] = None) -> BenchResult:
+    """
+    Publish commands with fixed rate (open loop) and wait their results, latency is publish to result
+    :param name: bench name
+    :param publish: async function(command)
+    :param collector: collector fed by results consumer
+    :param commands: command dicts
+    :param rate: commands per second, 0 - publish all at once
+    :param timeout: seconds to wait result of command, after timeout command is error
+    :param stats: upstream counters, see run_workload
+    """
+    run_id = f"{time.time():.6f}"
+    latencies: List[float] = []
+    errors = 0
+
+    async def process(i: int, command: Dict) -> None:
+        nonlocal errors
+        bench_id = f"{run_id}-{i}"
+        command = {**command, 'meta': {**(command.get('meta') or {}), 'bench_id': bench_id}}
+
+        future = collector.expect(bench_id)
+        published_at = time.monotonic()
+        try:
+            await publish(command)
+            unit = await asyncio.wait_for(future, timeout)
+        except Exception:
+            errors += 1
+            return
+        latencies.append(time.monotonic() - published_at)
+
+        status_code = unit.get('status_code')
+        if status_code is None or status_code >= 400:
+            errors += 1
+
+    before = stats() if stats else {}
+    started_at = time.monotonic()
+
+    tasks = []
+    for i, command in enumerate(commands):
+        if rate:
+            delay = started_at + i / rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(process(i, command)))
+    await asyncio.gather(*tasks)
+
+    seconds = time.monotonic() - started_at
+    after = stats() if stats else {}
+
+    return BenchResult(
+        name=name,
+        commands=len(commands),
+        seconds=seconds,
+        latencies=latencies,
+        errors=errors,
+        upstream_requests=after.get('requests', 0) - before.get('requests', 0),
+        throttled=after.get('throttled', 0) - before.get('throttled', 0),
+    )
+
+
+async def run_memory_bench(commands: List[Dict], rate: float = 0, timeout: float = 60,
+                           prefetch_count: Optional[int] = None, workers: Optional[int] = None,
+                           bucket_size: Optional[int] = None, leak_rate: Optional[float] = None,
+                           entities: Optional[Dict[str, int]] = None, latency: float = 0) -> BenchResult:
+    """
+    Whole AMQP path in process: MemoryBroker -> AMQPHandler -> CommandHandler -> Bitrix24Simulator
+    :param commands: command dicts
+    :param rate: commands per second, 0 - publish all at once
+    :param timeout: seconds to wait result of command
+    :param prefetch_count: by default RABBITMQ_PREFETCH_COUNT
+    :param workers: by default COMMAND_WORKERS
+    :param bucket_size: portal and client limiter burst, by default REQUESTS_BUCKET_SIZE
+    :param leak_rate: portal and client limiter rate, by default REQUESTS_LEAK_RATE
+    :param entities: simulator entities, entity -> items count
+    :param latency: simulator latency of request, seconds
+    """
+    bucket_size = bucket_size or settings.REQUESTS_BUCKET_SIZE
+    leak_rate = leak_rate or settings.REQUESTS_LEAK_RATE
+
+    simulator = Bitrix24Simulator(entities or {'crm.product': 1000}, bucket_size=bucket_size,
+                                  leak_rate=leak_rate, latency=latency)
+
+    async with TestServer(simulator.app()) as server:
+        bx_client = simulator.client(
+            f"{server.host}:{server.port}",
+            driver_options={'bucket_size': bucket_size, 'leak_rate': leak_rate},
+        )
+
+        collector = ResponseCollector()
+        broker = MemoryBroker(collector.feed, prefetch_count=prefetch_count or settings.RABBITMQ_PREFETCH_COUNT)
+        handler = AMQPHandler(client=broker, command_handler=CommandHandler(bx_client), workers=workers)
+        await broker.receive(handler.handle)
+
+        try:
+            return await run_publish_bench(
+                'memory', broker.publish_command, collector, commands,
+                rate=rate, timeout=timeout, stats=simulator.stats,
+            )
+        finally:
+            await broker.close()
+            await bx_client.close()
+
+
+async def run_rabbitmq_bench(commands: List[Dict], rate: float = 0, timeout: float = 60) -> BenchResult:
+    """
+    Publish commands to RABBITMQ_COMMAND_QUEUE and consume results from own exclusive queue bound to results exchange,
+    commands are processed by running bridge. RABBITMQ_MESSAGE_QUEUE and its consumers are not touched,
+    they get bench results too.
+    :param commands: command dicts
+    :param rate: commands per second, 0 - publish all at once
+    :param timeout: seconds to wait result of command
+    """
+    client = RabbitMQClient(publisher_confirms=False, buffer_size=0)
+    await client.connect()
+
+    collector = ResponseCollector()
+    assembler = ChunkAssembler()
+
+    async def on_result(message: aio_pika.IncomingMessage) -> None:
+        async with message.process():
+            data = assembler.feed(message)
+            if data is not None:
+                collector.feed(data)
+
+    # server named queue, deleted with connection
+    queue = await client.channel.declare_queue(exclusive=True, auto_delete=True)
+    await queue.bind(client.exchange, routing_key=client.routing_key)
+    await queue.consume(on_result)
+
+    async def publish(command: Dict) -> None:
+        await client.channel.default_exchange.publish(
+            aio_pika.Message(ujson.dumps(command).encode(), content_type='application/json'),
+            routing_key=settings.RABBITMQ_COMMAND_QUEUE,
+        )
+
+    try:
+        return await run_publish_bench('rabbitmq', publish, collector, commands, rate=rate, timeout=timeout)
+    finally:
+        await client.close()
@@ -1,5 +1,6 @@
 # import asyncio
 import asyncio
+import time
 import warnings
 from typing import Optional, Dict, Coroutine
 from urllib.parse import urlencode
@@ -7,9 +8,14 @@ from urllib.parse import urlencode
 import aiohttp
 import ujson
 
+from bridge.conf import settings
 from bridge.utils.bitrix24.drivers import LimitedHttpDriver, HttpDriver
+from bridge.utils.bitrix24.mixin import LimitRateDriverMixin
 from .exceptions import *
-from .utils import prepare_batch
+from .tokens import BaseTokenStore
+from .utils import prepare_batch, Response
+
+HTTP_UNAUTHORIZED = 401
 
 
 class Request(object):
@@ -94,6 +100,12 @@ class Bitrix24(object):
                  loop=None,
                  driver: Optional[HttpDriver] = None,
                  use_webhook: bool = False,
+                 member_id: Optional[str] = None,
+                 session: Optional[aiohttp.ClientSession] = None,
+                 driver_options: Optional[Dict] = None,
+                 expires_at: Optional[float] = None,
+                 token_store: Optional[BaseTokenStore] = None,
+                 refresh_margin: Optional[float] = None,
                  ):
         """
         Api for Bitrix24
@@ -115,6 +127,12 @@ class Bitrix24(object):
         :param loop:
         :param driver:
         :param use_webhook:
+        :param member_id: portal id, sent by Bitrix24 on application install
+        :param session: shared aiohttp session, e.g. for pool of portals
+        :param driver_options: extra driver kwargs, e.g. bucket_size, leak_rate
+        :param expires_at: unix time of access token expiration, by default now + expires_in if access_token is set
+        :param token_store: persistent storage of tokens
+        :param refresh_margin: seconds before expires_at, when access token is refreshed
         """
         if not loop:
             """
@@ -124,14 +142,6 @@ class Bitrix24(object):
             loop = asyncio.get_event_loop()
         self._loop = loop
 
-        if not driver:
-            driver = LimitedHttpDriver
-
-        self.driver = driver(
-            # loop=loop,
-            json_serialize=ujson.dumps
-        )
-
         self.access_token = access_token
         self.client_id = client_id
 
@@ -154,6 +164,21 @@ class Bitrix24(object):
                 domain = domain.split('://')[1]
 
         self.domain = domain
+
+        if not driver:
+            driver = LimitedHttpDriver
+
+        driver_options = dict(driver_options or {})
+        if issubclass(driver, LimitRateDriverMixin):
+            # Bitrix24 limits requests per portal
+            driver_options.setdefault('rate_limit_key', domain)
+
+        self.driver = driver(
+            # loop=loop,
+            session=session,
+            json_serialize=ujson.dumps,
+            **driver_options
+        )
         self.expires_in = expires_in  # Tokens expire in 1 hour by default
         self.refresh_token = refresh_token
         self.scope = scope  # The default value means all available scopes
@@ -181,6 +206,17 @@ class Bitrix24(object):
 
         self.server_domain = server_domain
 
+        self.member_id = member_id
+
+        if expires_at is None and access_token:
+            expires_at = time.time() + expires_in
+        self.expires_at = expires_at
+        self.token_store = token_store
+        self.refresh_margin = settings.BITRIX24_TOKEN_REFRESH_MARGIN if refresh_margin is None else refresh_margin
+
+        # single flight refresh of tokens
+        self._refreshing: Optional[asyncio.Future] = None
+
     async def __aenter__(self):
         return self
 
@@ -211,6 +247,13 @@ class Bitrix24(object):
             'refresh_token': self.refresh_token
         }
 
+    @property
+    def token_key(self) -> str:
+        """
+        Key of portal tokens in token store
+        """
+        return self.member_id or self.domain
+
     def register_code(self, code):
         """
         Callback function for getting code
@@ -268,10 +311,10 @@ class Bitrix24(object):
         """
         url = self._resolve_oauth_endpoint('token')
         try:
-            response = await self.driver.get(url, params=query)
-        except aiohttp.ClientError:
-            response = {}
-        return response
+            response: Response = await self.driver.get(url, params=query)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return {}
+        return response.data
 
     async def request_tokens(self, code: Optional[str] = None, **extra_query) -> None:
         """
@@ -289,14 +332,15 @@ class Bitrix24(object):
             'scope': self.scope
         })
         result: Dict = await self._request_tokens(query)
-        self.access_token = result.get('access_token')
+        if not result.get('access_token'):
+            return
+
         self.client_endpoint = result.get('client_endpoint')
-        self.domain = result.get('domain')
-        self.expires_in = result.get('expires_in')
-        self.refresh_token = result.get('refresh_token')
+        self.domain = result.get('domain') or self.domain
         self.scope = result.get('scope')
         self.server_endpoint = result.get('server_endpoint')
         self.user_id = result.get('user_id')
+        await self._update_tokens(result)
 
     async def refresh_tokens(self, **extra_query) -> None:
         """
@@ -311,8 +355,101 @@ class Bitrix24(object):
             'refresh_token': self.refresh_token
         })
         result: Dict = await self._request_tokens(query)
-        self.access_token = result.get('access_token')
-        self.refresh_token = result.get('refresh_token')
+        if not result.get('access_token'):
+            return
+
+        await self._update_tokens(result)
+
+    async def _update_tokens(self, result: Dict) -> None:
+        """
+        Set tokens from OAuth response and save them to token store
+        :param result: OAuth response
+        """
+        self.access_token = result['access_token']
+        self.refresh_token = result.get('refresh_token') or self.refresh_token
+        self.expires_in = int(result.get('expires_in') or self.expires_in)
+        self.expires_at = time.time() + self.expires_in
+
+        if self.token_store is not None:
+            await self.token_store.save(self.token_key, {
+                'access_token': self.access_token,
+                'refresh_token': self.refresh_token,
+                'expires_at': self.expires_at,
+                'client_endpoint': self.client_endpoint,
+            })
+
+    async def load_tokens(self) -> bool:
+        """
+        Load tokens saved in token store, e.g. after restart
+        :return: True if tokens were loaded
+        """
+        if self.token_store is None:
+            return False
+
+        tokens = await self.token_store.load(self.token_key)
+        if not tokens or not tokens.get('access_token'):
+            return False
+
+        self._set_stored_tokens(tokens)
+        return True
+
+    def _set_stored_tokens(self, tokens: Dict) -> None:
+        self.access_token = tokens['access_token']
+        self.refresh_token = tokens.get('refresh_token') or self.refresh_token
+        self.expires_at = tokens.get('expires_at')
+        self.client_endpoint = tokens.get('client_endpoint') or self.client_endpoint
+
+    def token_expiring(self) -> bool:
+        """
+        Access token expires in refresh_margin seconds
+        """
+        return self.expires_at is not None and self.expires_at - self.refresh_margin <= time.time()
+
+    async def ensure_tokens(self, expired_token: Optional[str] = None) -> None:
+        """
+        Refresh access token if it is expiring or expired_token is rejected by portal.
+        Concurrent callers wait one refresh request
+        :param expired_token: access token, which was rejected, skip refresh if it already was replaced
+        """
+        if not self.refresh_token:
+            return
+
+        if expired_token is not None:
+            if expired_token != self.access_token:
+                return
+        elif not self.token_expiring():
+            return
+
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._refresh_shared_tokens())
+
+            def done(_):
+                self._refreshing = None
+
+            self._refreshing.add_done_callback(done)
+
+        await asyncio.shield(self._refreshing)
+
+    async def _refresh_shared_tokens(self) -> None:
+        """
+        Refresh tokens under lock of token store, tokens already refreshed by other process are loaded instead,
+        refresh token is single use and the old one is rejected by portal
+        """
+        if self.token_store is None:
+            await self.refresh_tokens()
+            return
+
+        async with self.token_store.lock(self.token_key):
+            tokens = await self.token_store.load(self.token_key)
+            if (
+                    tokens and tokens.get('access_token')
+                    and tokens['access_token'] != self.access_token
+                    and (tokens.get('expires_at') or 0) > (self.expires_at or 0)
+            ):
+                self._set_stored_tokens(tokens)
+                return
+
+            await self.refresh_tokens()
 
     def resolve_authorize_endpoint(self, **extra_query) -> str:
         """
@@ -330,13 +467,13 @@ class Bitrix24(object):
         endpoint = self._resolve_oauth_endpoint('authorize', query=query)
         return endpoint
 
-    async def call_method(self, method: str, params: Optional[Dict] = None) -> aiohttp.ClientResponse:
+    async def call_method(self, method: str, params: Optional[Dict] = None) -> Response:
         """
         Requests any Bitrix24 method with/out parameters. See:
         https://training.bitrix24.com/rest_help/js_library/rest/callMethod.php
         :param method: str Dot-noted method name
         :param params: dict Request parameters
-        :return: aiohttp.ClientResponse
+        :return: Response
         """
 
         if self.use_webhook:
@@ -345,65 +482,80 @@ class Bitrix24(object):
             """
             return await self.call_webhook(method=method, params=params)
 
+        await self.ensure_tokens()
+
         url: str = self._resolve_call_url(method)
+        access_token = self.access_token
+        response = await self._post(url, params, access_token)
+
+        if response.status == HTTP_UNAUTHORIZED and response.data.get('error') == 'expired_token':
+            """
+            Token expired earlier than expected, e.g. was loaded from stale settings
+            """
+            await self.ensure_tokens(expired_token=access_token)
+            if self.access_token != access_token:
+                response = await self._post(url, params, self.access_token)
+
+        return response
+
+    async def _post(self, url: str, params: Optional[Dict], access_token: Optional[str]) -> Response:
         query = {
-            'auth': self.access_token
+            'auth': access_token
         }
         try:
-            response: aiohttp.ClientResponse = await self.driver.post(url, json=params, params=query)
-        except aiohttp.ClientError:
-            response = {}
-        result = response
-        return result
+            response: Response = await self.driver.post(url, json=params, params=query)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            response = Response(url=url, status=None)
+        return response
 
-    async def call_batch(self, calls: Dict, halt_on_error: bool = False) -> aiohttp.ClientResponse:
+    async def call_batch(self, calls: Dict, halt_on_error: bool = False) -> Response:
         """
         Groups many single methods into a request. Can include macros
         to access the results of the previous calls in the batch. See:
         https://training.bitrix24.com/rest_help/js_library/rest/callBatch.php
         :param calls: dict Sub-methods with params
         :param halt_on_error: bool Halt on error
-        :return: aiohttp.ClientResponse
+        :return: Response
         """
-        result: aiohttp.ClientResponse = await self.call_method('batch', {
+        result: Response = await self.call_method('batch', {
             'cmd': prepare_batch(calls),
             'halt': halt_on_error
         })
         return result
 
-    async def call_bind(self, event: str, handler: str, auth_type=None) -> aiohttp.ClientResponse:
+    async def call_bind(self, event: str, handler: str, auth_type=None) -> Response:
         """
         Installs a new event handler. See:
         https://training.bitrix24.com/rest_help/general/event_bind.php
         :param event: str Event name
         :param handler: str Handler URL
         :param auth_type: int User ID
-        :return: aiohttp.ClientResponse
+        :return: Response
         """
-        result: aiohttp.ClientResponse = await self.call_method('event.bind', {
+        result: Response = await self.call_method('event.bind', {
             'auth_type': auth_type or self.user_id,
             'event': event,
             'handler': handler
         })
         return result
 
-    async def call_unbind(self, event: str, handler: str, auth_type=None) -> aiohttp.ClientResponse:
+    async def call_unbind(self, event: str, handler: str, auth_type=None) -> Response:
         """
         Uninstalls a previously installed event handler. See:
         https://training.bitrix24.com/rest_help/general/event_unbind.php
         :param event: str Event name
         :param handler: str Handler URL
         :param auth_type: int User ID
-        :return: aiohttp.ClientResponse
+        :return: Response
         """
-        result: aiohttp.ClientResponse = await self.call_method('event.unbind', {
+        result: Response = await self.call_method('event.unbind', {
             'auth_type': auth_type or self.user_id,
             'event': event,
             'handler': handler
         })
         return result
 
-    async def call_webhook(self, method: str, params: Dict = None, code: Optional[str] = None) -> aiohttp.ClientResponse:
+    async def call_webhook(self, method: str, params: Dict = None, code: Optional[str] = None) -> Response:
         """
         Call a simplified version of rest-events and rest-teams that does not
         require a program to write.
@@ -411,14 +563,14 @@ class Bitrix24(object):
         :param method:
         :param code:
         :param params:
-        :return: aiohttp.ClientResponse
+        :return: Response
         """
         endpoint = self._resolve_webhook_endpoint(code)
         url = self._resolve_call_url(method, endpoint=endpoint)
 
         try:
-            response: aiohttp.ClientResponse = await self.driver.post(url, json=params)
-        except aiohttp.ClientError as e:
-            response = {}
+            response: Response = await self.driver.post(url, json=params)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            response = Response(url=url, status=None)
 
         return response
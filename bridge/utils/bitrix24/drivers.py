@@ -1,5 +1,9 @@
+import json
+import time
+
 import aiohttp
 
+from bridge.utils.metrics import HTTP_REQUEST_DURATION, HTTP_RESPONSES
 from .utils import resolve_response, Response
 from .mixin import LimitRateDriverMixin
 
@@ -50,45 +54,53 @@ class HttpDriver(BaseDriver):
         In Basic realisation session=aiohttp.ClientSession
         :param timeout:
         :param loop: required if api used not in main thread
-        :param session: if try optimize and reuse connections
+        :param session: if try optimize and reuse connections, shared session is not closed by driver
         :param auth:
         :param json_serialize: json.dumps function
         """
         super().__init__(timeout, loop)
         if not session:
-            self.session = aiohttp.ClientSession(loop=loop, auth=auth, json_serialize=json_serialize)
+            self.session = aiohttp.ClientSession(loop=loop, auth=auth, json_serialize=json_serialize or json.dumps)
+            self._own_session = True
         else:
             self.session = session
-
-    async def get(self, url, timeout=None, *args, **kwargs):
-        async with self.session.get(url, timeout=timeout or self.timeout, *args, **kwargs) as response:
-            await resolve_response(response)
-            return response
-
-    async def post(self, url, timeout=None, *args, **kwargs):
-        async with self.session.post(url, timeout=timeout or self.timeout, *args, **kwargs) as response:
-            """
-            Process response body before release response: ClientResponse 
-            """
-            await resolve_response(response)
-            return response
-
-    async def put(self, url, timeout=None, *args, **kwargs):
-        async with self.session.get(url, timeout=timeout or self.timeout, *args, **kwargs) as response:
-            await resolve_response(response)
-            return response
-
-    async def delete(self, url, timeout=None, *args, **kwargs):
-        async with self.session.get(url, timeout=timeout or self.timeout, *args, **kwargs) as response:
-            await resolve_response(response)
-            return response
+            self._own_session = False
+        self._closed = False
+
+    async def get(self, url, timeout=None, *args, **kwargs) -> Response:
+        return await self._request('GET', url, timeout, *args, **kwargs)
+
+    async def post(self, url, timeout=None, *args, **kwargs) -> Response:
+        return await self._request('POST', url, timeout, *args, **kwargs)
+
+    async def put(self, url, timeout=None, *args, **kwargs) -> Response:
+        return await self._request('PUT', url, timeout, *args, **kwargs)
+
+    async def delete(self, url, timeout=None, *args, **kwargs) -> Response:
+        return await self._request('DELETE', url, timeout, *args, **kwargs)
+
+    async def _request(self, method, url, timeout=None, *args, **kwargs) -> Response:
+        started_at = time.monotonic()
+        status = 'error'
+        try:
+            async with self.session.request(method, url, timeout=timeout or self.timeout, *args, **kwargs) as response:
+                """
+                Process response body before release response: ClientResponse 
+                """
+                status = response.status
+                return await resolve_response(response)
+        finally:
+            HTTP_REQUEST_DURATION.labels(method).observe(time.monotonic() - started_at)
+            HTTP_RESPONSES.labels(str(status)).inc()
 
     async def close(self):
-        await self.session.close()
+        self._closed = True
+        if self._own_session:
+            await self.session.close()
 
     @property
     def closed(self):
-        return self.session.closed
+        return self._closed or self.session.closed
 
 
 class LimitedHttpDriver(LimitRateDriverMixin, HttpDriver):
@@ -8,3 +8,7 @@ class IncorrectTransportType(Bitrix24BaseException):
 
 class IncorrectCall(Bitrix24BaseException):
     pass
+
+
+class UnknownPortal(Bitrix24BaseException):
+    pass
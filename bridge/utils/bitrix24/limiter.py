@@ -0,0 +1,331 @@
+import asyncio
+import heapq
+import itertools
+import mmap
+import os
+import struct
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Dict, List
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# priority of requests made in current context (command), greater value - served earlier
+current_priority: 'ContextVar[int]' = ContextVar('current_priority', default=0)
+# fair share flow of requests made in current context, e.g. entity or producer of command
+current_flow: 'ContextVar[str]' = ContextVar('current_flow', default='default')
+
+
+class Flow:
+    """
+    Waiters of one fair share flow
+    """
+    __slots__ = ('name', 'weight', 'deficit', 'waiters')
+
+    def __init__(self, name: str, weight: float):
+        self.name = name
+        self.weight = weight
+        self.deficit = 0.0
+        # heap of (rank, seq, future), cancelled futures are removed lazily
+        self.waiters: List = []
+
+
+class LeakyBucket:
+    """
+    Leaky bucket rate limiter, same model as used by Bitrix24 portals
+
+    Every request adds one unit to the bucket, the bucket leaks with constant rate
+    (`leak_rate` units per second). While bucket level + 1 <= capacity request is allowed
+    immediately, otherwise the caller waits exactly until enough units leaked.
+
+    Waiters are woken up by single timer, no polling.
+    Waiters are grouped by flows (e.g. entity or producer of command), free slots are shared by flows
+    with deficit round robin: every round flow gets `weight` slots, unused fraction is carried to the next round.
+    Inside flow the highest priority is served first, FIFO within one priority.
+    Priority of waiter grows by `aging` per second of waiting, so low priority requests are not starved.
+    """
+
+    def __init__(self, capacity: int, leak_rate: float, loop=None, aging: float = 0,
+                 weights: Optional[Dict[str, float]] = None):
+        """
+        :param capacity: bucket size, max burst of requests
+        :param leak_rate: requests per second, which bucket releases
+        :param loop: event loop
+        :param aging: priority points, which waiter gains per second of waiting, 0 - strict priority
+        :param weights: flow -> share of slots under contention, other flows have weight 1
+        """
+        if capacity < 1:
+            raise ValueError("capacity should be >= 1")
+        if leak_rate <= 0:
+            raise ValueError("leak_rate should be > 0")
+        if aging < 0:
+            raise ValueError("aging should be >= 0")
+        if any(weight <= 0 for weight in (weights or {}).values()):
+            raise ValueError("flow weight should be > 0")
+
+        self.capacity = capacity
+        self.leak_rate = leak_rate
+        self.aging = aging
+        self.weights = dict(weights or {})
+        self._loop = loop
+
+        self._level = 0.0
+        self._updated_at = self._time()
+
+        # flows with waiters, round robin order
+        self._flows: Dict[str, Flow] = {}
+        self._active = deque()
+        self._waiting = 0
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @staticmethod
+    def _time() -> float:
+        return time.monotonic()
+
+    def _get_loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    def _leak(self) -> None:
+        now = self._time()
+        self._level = max(0.0, self._level - max(0.0, now - self._updated_at) * self.leak_rate)
+        self._updated_at = now
+
+    def _try_acquire(self) -> bool:
+        self._leak()
+        if self._level + 1 <= self.capacity:
+            self._level += 1
+            return True
+        return False
+
+    def _release(self) -> None:
+        """
+        Give back one slot
+        """
+        self._level = max(0.0, self._level - 1)
+
+    def _delay(self) -> float:
+        """
+        Exact time in seconds until the next free slot
+        """
+        self._leak()
+        return max(0.0, (self._level + 1 - self.capacity) / self.leak_rate)
+
+    @property
+    def level(self) -> float:
+        """
+        Current bucket occupancy
+        """
+        self._leak()
+        return self._level
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    def locked(self) -> bool:
+        return bool(self._waiting) or self._delay() > 0
+
+    def _rank(self, priority: int) -> float:
+        """
+        Heap key of new waiter, less - served earlier
+
+        Effective priority of waiter is priority + aging * (now - enqueued_at),
+        all waiters age with the same speed, so their order doesn't change while waiting
+        and can be fixed on enqueue: -(priority - aging * enqueued_at)
+        """
+        if not self.aging:
+            return -priority
+        return self.aging * self._time() - priority
+
+    async def acquire(self, priority: Optional[int] = None, flow: Optional[str] = None) -> None:
+        """
+        Take one slot from bucket, wait for free slot if bucket is full
+        :param priority: greater value - served earlier, by default current_priority of context
+        :param flow: fair share flow, by default current_flow of context
+        """
+        if not self._waiting and self._try_acquire():
+            return
+
+        if priority is None:
+            priority = current_priority.get()
+        if flow is None:
+            flow = current_flow.get()
+
+        waiter = self._get_loop().create_future()
+        heapq.heappush(self._get_flow(flow).waiters, (self._rank(priority), next(self._seq), waiter))
+        self._waiting += 1
+        self._schedule()
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # slot was granted, but nobody use it - give it back
+                self._release()
+            else:
+                # waiter stays in flow heap until _wake_up pops it
+                waiter.cancel()
+                self._waiting -= 1
+            self._schedule()
+            raise
+
+    def _schedule(self) -> None:
+        if self._timer is not None or not self._waiting:
+            return
+        self._timer = self._get_loop().call_later(self._delay(), self._wake_up)
+
+    def _get_flow(self, name: str) -> Flow:
+        flow = self._flows.get(name)
+        if flow is None:
+            flow = self._flows[name] = Flow(name, self.weights.get(name, 1))
+            self._active.append(flow)
+        return flow
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        """
+        Pop waiter, which gets free slot: deficit round robin over flows, priority inside flow
+        :return: waiter or None if all waiters are cancelled
+        """
+        while self._active:
+            flow = self._active[0]
+
+            while flow.waiters and flow.waiters[0][-1].done():
+                heapq.heappop(flow.waiters)
+            if not flow.waiters:
+                # idle flow loses its deficit
+                self._active.popleft()
+                del self._flows[flow.name]
+                continue
+
+            if flow.deficit < 1:
+                # next round of flow
+                flow.deficit += flow.weight
+                if flow.deficit < 1:
+                    self._active.rotate(-1)
+                    continue
+
+            flow.deficit -= 1
+            if flow.deficit < 1:
+                self._active.rotate(-1)
+            return heapq.heappop(flow.waiters)[-1]
+
+        return None
+
+    def _wake_up(self) -> None:
+        self._timer = None
+
+        while self._active:
+            if not self._try_acquire():
+                break
+            waiter = self._next_waiter()
+            if waiter is None:
+                self._release()
+                break
+            self._waiting -= 1
+            waiter.set_result(None)
+
+        self._schedule()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        # waiting count is decreased by cancelled acquire() calls
+        flows, self._flows = self._flows, {}
+        self._active.clear()
+        for flow in flows.values():
+            for _, _, waiter in flow.waiters:
+                if not waiter.done():
+                    waiter.cancel()
+
+
+class SharedLeakyBucket(LeakyBucket):
+    """
+    Leaky bucket, which state is shared by processes of one host, e.g. gunicorn workers
+
+    Bucket level and last update time are stored in small mmap file,
+    every change is made under exclusive flock, so all processes together don't exceed the limit.
+    Waiters of one process are still woken up by single timer in fair share and priority order,
+    if other process took the slot first, timer is rescheduled.
+    """
+    _STATE = struct.Struct('dd')  # level, updated_at
+
+    def __init__(self, capacity: int, leak_rate: float, path: str, loop=None, aging: float = 0,
+                 weights: Optional[Dict[str, float]] = None):
+        """
+        :param capacity: bucket size, max burst of requests
+        :param leak_rate: requests per second, which bucket releases
+        :param path: state file, processes with the same path share one bucket
+        :param loop: event loop
+        :param aging: priority points, which waiter gains per second of waiting
+        :param weights: flow -> share of slots under contention
+        """
+        if fcntl is None:
+            raise RuntimeError("SharedLeakyBucket requires fcntl (posix only)")
+
+        super().__init__(capacity, leak_rate, loop, aging, weights)
+        self.path = path
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(self._fd).st_size < self._STATE.size:
+                # new file is filled by zeros: empty bucket
+                os.ftruncate(self._fd, self._STATE.size)
+            self._map = mmap.mmap(self._fd, self._STATE.size)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    @contextmanager
+    def _shared_state(self):
+        """
+        Load state from shared file, save it back if block succeeded
+        """
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            self._level, self._updated_at = self._STATE.unpack_from(self._map)
+            yield
+            self._STATE.pack_into(self._map, 0, self._level, self._updated_at)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _try_acquire(self) -> bool:
+        with self._shared_state():
+            return super()._try_acquire()
+
+    def _release(self) -> None:
+        with self._shared_state():
+            super()._release()
+
+    def _delay(self) -> float:
+        with self._shared_state():
+            return super()._delay()
+
+    @property
+    def level(self) -> float:
+        with self._shared_state():
+            self._leak()
+            return self._level
+
+    def close(self) -> None:
+        super().close()
+
+        if not self._map.closed:
+            self._map.close()
+            os.close(self._fd)
@@ -1,19 +1,26 @@
-import asyncio
+import os
+import time
+from typing import Dict
+from urllib.parse import quote
 
-from aio_counter import AioCounter
+from bridge.conf import settings
+from bridge.utils.metrics import RATE_LIMIT_WAIT, RATE_LIMIT_LEVEL, RATE_LIMIT_WAITING
+from .limiter import LeakyBucket, SharedLeakyBucket
 
 
 def wait_free_slot(func):
     """
     decorator for request function
-    1) try get slot from rpp queue or wait new free slot
-    2) if get slot from rpr, try get slot from parallel queue or wait free slot
+    try get slot from leaky bucket or wait exactly until next slot is free
     :param func:
     :return:
     """
 
     async def wrapper(self, *args, **kwargs):
-        await self._rate_limitter.inc(ttl=self.REQUEST_PERIOD)  # try get rpp slot
+        started_at = time.monotonic()
+        await self._rate_limiter.acquire()
+        self._rate_limit_wait.observe(time.monotonic() - started_at)
+
         response = await func(self, *args, **kwargs)
         return response
 
@@ -23,44 +30,65 @@ def wait_free_slot(func):
 class LimitRateDriverMixin:
     """
     Control request rate
+
+    Bitrix24 portals use leaky bucket algorithm: bucket with BUCKET_SIZE requests,
+    which leaks LEAK_RATE requests per second
     """
-    REQUEST_PER_PERIOD = 100  # not more 100 request per period
-    REQUEST_PERIOD = 20
+    BUCKET_SIZE = 50  # max burst of requests
+    LEAK_RATE = 2  # requests per second
 
     def __init__(self,
-                 request_per_preiod: int = None,
-                 requests_period: int = None,
+                 bucket_size: int = None,
+                 leak_rate: float = None,
+                 rate_limit_key: str = None,
+                 shared_dir: str = None,
+                 priority_aging: float = None,
+                 flow_weights: Dict[str, float] = None,
                  *args, **kwargs
                  ):
         """
-        _queue_parallel - control max parallel request
-        _queue_rps - control request per period
-        :param request_per_preiod:
-        :param requests_period:
-        :param max_parallel_request_count:
+        :param bucket_size: max burst of requests
+        :param leak_rate: requests per second after burst
+        :param rate_limit_key: name of shared bucket, e.g. portal domain
+        :param shared_dir: directory of shared buckets, if set, processes of host share limit by rate_limit_key
+        :param priority_aging: priority points, which waiting request gains per second
+        :param flow_weights: flow (entity or producer of command) -> share of requests under contention
         """
         super().__init__(*args, **kwargs)
 
-        self._rate_limitter = AioCounter(
-            max_count=request_per_preiod or self.REQUEST_PER_PERIOD,
-            start_count=0,
-            ttl=requests_period or self.REQUEST_PERIOD
-        )
-
-        self._tik = 2  # seconds
-        self._tak = 2  # seconds
-
-        self.task = asyncio.ensure_future(self.dispatcher(), loop=self._loop)
-
-    async def dispatcher(self):
-        while True:
-            await asyncio.sleep(self._tik, loop=self._loop)
-            if self._rate_limitter.full():
-                await asyncio.sleep(self._tak, loop=self._loop)
-                try:
-                    self._rate_limitter.dec_nowait()
-                except:
-                    pass
+        capacity = bucket_size or settings.REQUESTS_BUCKET_SIZE or self.BUCKET_SIZE
+        leak_rate = leak_rate or settings.REQUESTS_LEAK_RATE or self.LEAK_RATE
+        shared_dir = shared_dir or settings.REQUESTS_SHARED_DIR
+        aging = settings.REQUESTS_PRIORITY_AGING if priority_aging is None else priority_aging
+        weights = settings.REQUESTS_FLOW_WEIGHTS if flow_weights is None else flow_weights
+
+        if shared_dir:
+            self._rate_limiter = SharedLeakyBucket(
+                capacity=capacity,
+                leak_rate=leak_rate,
+                path=os.path.join(shared_dir, f"{quote(rate_limit_key or 'default', safe='')}.bucket"),
+                loop=self._loop,
+                aging=aging,
+                weights=weights,
+            )
+        else:
+            self._rate_limiter = LeakyBucket(
+                capacity=capacity,
+                leak_rate=leak_rate,
+                loop=self._loop,
+                aging=aging,
+                weights=weights,
+            )
+
+        self._rate_limit_key = rate_limit_key or 'default'
+        self._rate_limit_wait = RATE_LIMIT_WAIT.labels(self._rate_limit_key)
+        # collected on scrape, not on each request
+        self._rate_limit_gauges = [
+            (RATE_LIMIT_LEVEL, lambda: self._rate_limiter.level),
+            (RATE_LIMIT_WAITING, lambda: self._rate_limiter.waiting),
+        ]
+        for gauge, function in self._rate_limit_gauges:
+            gauge.labels(self._rate_limit_key).set_function(function)
 
     @wait_free_slot
     async def get(self, *args, **kwargs):
@@ -80,4 +108,11 @@ class LimitRateDriverMixin:
 
     async def close(self):
         await super().close()
-        self._rate_limitter.close()
+        self._rate_limiter.close()
+
+        for gauge, function in self._rate_limit_gauges:
+            if gauge.labels(self._rate_limit_key).function is function:
+                """
+                Gauge was not taken by new driver with the same key
+                """
+                gauge.remove(self._rate_limit_key)
@@ -0,0 +1,172 @@
+import asyncio
+from typing import Dict, Optional, Iterator, List, Set
+
+import aiohttp
+import ujson
+
+from .api import Bitrix24
+from .exceptions import UnknownPortal
+from .tokens import BaseTokenStore
+
+
+class Bitrix24Pool:
+    """
+    Registry of Bitrix24 clients for many portals
+
+    Clients are found by domain or member_id, e.g. from command meta.
+    Each client has own driver with own rate limiter, because Bitrix24 limits requests per portal,
+    all clients share one aiohttp session (connection pool).
+    """
+
+    def __init__(self, connections: int = 100, connections_per_host: int = 0,
+                 token_store: Optional[BaseTokenStore] = None, loop=None):
+        """
+        :param connections: max open connections of all portals, 0 - unlimited
+        :param connections_per_host: max open connections of one portal, 0 - unlimited
+        :param token_store: persistent storage of tokens for all portals
+        :param loop: event loop
+        """
+        self.connections = connections
+        self.connections_per_host = connections_per_host
+        self.token_store = token_store
+        self._loop = loop
+
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        self._clients: List[Bitrix24] = []
+        self._by_domain: Dict[str, Bitrix24] = {}
+        self._by_member_id: Dict[str, Bitrix24] = {}
+        self.default: Optional[Bitrix24] = None
+        # close of replaced clients
+        self._closing: Set[asyncio.Future] = set()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        Shared session, created on first use, because it requires running event loop
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.connections,
+                    limit_per_host=self.connections_per_host,
+                ),
+                json_serialize=ujson.dumps,
+            )
+        return self._session
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __iter__(self) -> Iterator[Bitrix24]:
+        return iter(self._clients)
+
+    def add(self, domain: str, default: bool = False, **kwargs) -> Bitrix24:
+        """
+        Create client with shared session and register it,
+        if client of the same domain or member_id exists, it is replaced
+        :param domain: portal domain
+        :param default: use client for commands without portal in meta
+        :param kwargs: Bitrix24 kwargs, e.g. member_id, webhook_code, client_id, client_secret
+        :return: new client
+        """
+        kwargs.setdefault('token_store', self.token_store)
+        client = Bitrix24(domain, session=self.session, loop=self._loop, **kwargs)
+        self.register(client, default=default)
+        return client
+
+    def register(self, client: Bitrix24, default: bool = False) -> None:
+        """
+        Register client, replaced client of the same domain or member_id is closed by pool
+        :param client:
+        :param default: use client for commands without portal in meta
+        """
+        old = self._by_domain.get(client.domain)
+        if old is None and client.member_id:
+            old = self._by_member_id.get(client.member_id)
+        if old is not None and old is not client:
+            self.unregister(old)
+            """
+            Driver, rate limiter timer and metrics of old client are released,
+            shared session is not closed by client
+            """
+            closing = asyncio.ensure_future(old.close(), loop=self._loop)
+            self._closing.add(closing)
+            closing.add_done_callback(self._closing.discard)
+
+        self._clients.append(client)
+        self._by_domain[client.domain] = client
+        if client.member_id:
+            self._by_member_id[client.member_id] = client
+
+        if default or self.default is None:
+            self.default = client
+
+    def unregister(self, client: Bitrix24) -> None:
+        try:
+            self._clients.remove(client)
+        except ValueError:
+            return
+
+        if self._by_domain.get(client.domain) is client:
+            del self._by_domain[client.domain]
+        if client.member_id and self._by_member_id.get(client.member_id) is client:
+            del self._by_member_id[client.member_id]
+        if self.default is client:
+            self.default = self._clients[0] if self._clients else None
+
+    def get(self, domain: Optional[str] = None, member_id: Optional[str] = None) -> Optional[Bitrix24]:
+        """
+        Find client by member_id, then by domain
+        :param domain:
+        :param member_id:
+        :return: client or None
+        """
+        client = None
+        if member_id:
+            client = self._by_member_id.get(member_id)
+        if client is None and domain:
+            client = self._by_domain.get(domain)
+        return client
+
+    def resolve(self, meta: Optional[Dict] = None) -> Bitrix24:
+        """
+        Client for command meta: meta.member_id or meta.domain, default client if meta has no portal
+        :param meta: command meta
+        :return: client
+        :raise UnknownPortal: portal from meta is not registered or there are no clients at all
+        """
+        domain = member_id = None
+        if isinstance(meta, dict):
+            domain = meta.get('domain')
+            member_id = meta.get('member_id')
+
+        if domain or member_id:
+            client = self.get(domain=domain, member_id=member_id)
+            if client is None:
+                raise UnknownPortal(f"Portal is not registered: domain={domain}, member_id={member_id}")
+            return client
+
+        if self.default is None:
+            raise UnknownPortal("There are no registered portals")
+        return self.default
+
+    async def load_tokens(self) -> None:
+        """
+        Load saved tokens of all portals
+        """
+        for client in self._clients:
+            await client.load_tokens()
+
+    async def close(self):
+        for client in self._clients:
+            await client.close()
+
+        if self._closing:
+            await asyncio.gather(*self._closing)
+
+        if self.token_store is not None:
+            await self.token_store.close()
+
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
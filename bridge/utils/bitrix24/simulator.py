@@ -0,0 +1,341 @@
+import asyncio
+import re
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple, Any
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+from .api import Bitrix24
+
+HTTP_BAD_REQUEST = 400
+HTTP_NOT_FOUND = 404
+HTTP_SERVICE_UNAVAILABLE = 503
+
+# $result[name][key]... in decoded param value
+RESULT_MACRO = re.compile(r'\$result\[(?P<name>[^\]]+)\](?P<path>(?:\[[^\]]*\])*)')
+
+
+class SimulatorBitrix24(Bitrix24):
+    """
+    Bitrix24 client for simulator, which is served by plain http
+    """
+    _client_endpoint_template = 'http://{domain}/rest/'
+    _oauth_endpoint_template = 'http://{domain}/oauth/{action}/'
+    _webhook_endpoint_template = 'http://{domain}/rest/{user_id}/{code}/'
+
+
+def parse_query(query: str) -> Dict:
+    """
+    Parse php-like query of batch sub command: filter[>ID]=10&select[0]=ID -> {"filter": {">ID": "10"}, "select": ["ID"]}
+    :param query:
+    :return:
+    """
+    result: Dict = {}
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        name, _, rest = key.partition('[')
+        path = [name] + (rest[:-1].split('][') if rest else [])
+
+        node = result
+        for part in path[:-1]:
+            node = node.setdefault(part, {})
+        node[path[-1]] = value
+
+    return _lists(result)
+
+
+def _lists(node: Any) -> Any:
+    """
+    Dicts with 0..n keys to lists
+    """
+    if not isinstance(node, dict):
+        return node
+    node = {key: _lists(value) for key, value in node.items()}
+    if node and all(key.isdigit() for key in node) and sorted(map(int, node)) == list(range(len(node))):
+        return [node[str(i)] for i in range(len(node))]
+    return node
+
+
+def resolve_macros(params: Any, results: Dict[str, Any]) -> Any:
+    """
+    Replace $result[name][key]... macros in parsed params of batch sub command by results of previous sub commands,
+    value which is one macro gets result as is, macro inside string is replaced by its string,
+    macros of unknown sub commands and missing keys are left as is
+    :param params: parse_query() result
+    :param results: sub command name -> result
+    :return:
+    """
+    if isinstance(params, dict):
+        return {key: resolve_macros(value, results) for key, value in params.items()}
+    if isinstance(params, list):
+        return [resolve_macros(value, results) for value in params]
+    if not isinstance(params, str) or '$result' not in params:
+        return params
+
+    match = RESULT_MACRO.fullmatch(params)
+    if match is not None:
+        return _macro_value(match, results)
+
+    def replace(match) -> str:
+        value = _macro_value(match, results)
+        return value if isinstance(value, str) else str(value)
+
+    return RESULT_MACRO.sub(replace, params)
+
+
+def _macro_value(match, results: Dict[str, Any]) -> Any:
+    name = match.group('name')
+    if name not in results:
+        return match.group(0)
+
+    value = results[name]
+    for key in match.group('path')[1:-1].split('][') if match.group('path') else ():
+        try:
+            value = value[int(key)] if isinstance(value, list) else value[key]
+        except (KeyError, IndexError, ValueError, TypeError):
+            return match.group(0)
+    return value
+
+
+class MethodError(Exception):
+    def __init__(self, error: str, description: str = '', status: int = HTTP_BAD_REQUEST):
+        super().__init__(error)
+        self.error = error
+        self.description = description
+        self.status = status
+
+    def data(self) -> Dict:
+        return {'error': self.error, 'error_description': self.description}
+
+
+class Bitrix24Simulator:
+    """
+    Local fake Bitrix24 portal for tests and benchmarks
+
+    Supports <entity>.list (filter by ID, order by ID, start, total/next), <entity>.get, add, update, delete, fields
+    and batch with $result macros. Requests are throttled by leaky bucket as on portal:
+    request over limit gets 503 QUERY_LIMIT_EXCEEDED, batch is one request.
+    Works with webhook and OAuth urls, auth is not checked.
+    """
+    PAGE_SIZE = 50
+
+    def __init__(self, entities: Optional[Dict[str, int]] = None, bucket_size: int = 50, leak_rate: float = 2,
+                 latency: float = 0):
+        """
+        :param entities: entity -> count of generated items, e.g. {"crm.product": 1000}
+        :param bucket_size: max burst of requests
+        :param leak_rate: requests per second after burst
+        :param latency: seconds of every request processing
+        """
+        self.bucket_size = bucket_size
+        self.leak_rate = leak_rate
+        self.latency = latency
+
+        self.items: Dict[str, Dict[int, Dict]] = {}
+        for entity, count in (entities or {}).items():
+            self.items[entity] = {
+                i: {'ID': str(i), 'NAME': f"{entity} {i}"} for i in range(1, count + 1)
+            }
+
+        self._level = 0.0
+        self._updated_at = time.monotonic()
+
+        # stats
+        self.requests = 0
+        self.throttled = 0
+        self.methods: Counter = Counter()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/rest/{method}.json', self.handle)
+        app.router.add_post('/rest/{user_id}/{code}/{method}.json', self.handle)
+        return app
+
+    def client(self, domain: str, **kwargs) -> SimulatorBitrix24:
+        """
+        Webhook client for simulator
+        :param domain: host:port of running simulator
+        :param kwargs: Bitrix24 kwargs
+        """
+        kwargs.setdefault('webhook_code', 'simulator')
+        kwargs.setdefault('use_webhook', True)
+        return SimulatorBitrix24(domain, **kwargs)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'requests': self.requests,
+            'throttled': self.throttled,
+        }
+
+    def reset_stats(self) -> None:
+        self.requests = 0
+        self.throttled = 0
+        self.methods.clear()
+
+    def _try_acquire(self) -> bool:
+        now = time.monotonic()
+        self._level = max(0.0, self._level - (now - self._updated_at) * self.leak_rate)
+        self._updated_at = now
+
+        if self._level + 1 > self.bucket_size:
+            return False
+        self._level += 1
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+
+        if not self._try_acquire():
+            self.throttled += 1
+            return web.json_response(
+                MethodError('QUERY_LIMIT_EXCEEDED', 'Too many requests').data(),
+                status=HTTP_SERVICE_UNAVAILABLE,
+            )
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        method = request.match_info['method']
+        params = await request.json() if request.can_read_body else {}
+
+        try:
+            if method == 'batch':
+                data = self.batch(params or {})
+            else:
+                data = self.call(method, params or {})
+        except MethodError as e:
+            return web.json_response(e.data(), status=e.status)
+
+        return web.json_response(data)
+
+    def batch(self, params: Dict) -> Dict:
+        result, result_error, result_total, result_next = {}, {}, {}, {}
+        halt = str(params.get('halt', 0)).lower() in ('1', 'true')
+
+        for name, command in (params.get('cmd') or {}).items():
+            method, _, query = command.partition('?')
+            try:
+                data = self.call(method, resolve_macros(parse_query(query), result))
+            except MethodError as e:
+                result_error[name] = e.data()
+                if halt:
+                    break
+                continue
+
+            result[name] = data['result']
+            if 'total' in data:
+                result_total[name] = data['total']
+            if 'next' in data:
+                result_next[name] = data['next']
+
+        return {
+            'result': {
+                'result': result,
+                'result_error': result_error,
+                'result_total': result_total,
+                'result_next': result_next,
+            }
+        }
+
+    def call(self, method: str, params: Dict) -> Dict:
+        """
+        Process single method
+        :return: response data
+        :raise MethodError:
+        """
+        self.methods[method] += 1
+
+        entity, _, method_type = method.rpartition('.')
+        items = self.items.get(entity)
+        if items is None or method_type not in ('list', 'get', 'add', 'update', 'delete', 'fields'):
+            raise MethodError('ERROR_METHOD_NOT_FOUND', f"Method not found: {method}", HTTP_NOT_FOUND)
+
+        return getattr(self, f"call_{method_type}")(items, params)
+
+    def call_list(self, items: Dict[int, Dict], params: Dict) -> Dict:
+        selected = list(items.values())
+
+        for key, value in (params.get('filter') or {}).items():
+            operator, field = self._split_filter(key)
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                # e.g. unresolved $result macro
+                selected = []
+                break
+            selected = [item for item in selected if self._compare(operator, int(item.get(field) or 0), value)]
+
+        order = params.get('order') or {}
+        if str(order.get('ID', 'ASC')).upper() == 'DESC':
+            selected.sort(key=lambda item: -int(item['ID']))
+        else:
+            selected.sort(key=lambda item: int(item['ID']))
+
+        start = int(params.get('start') or 0)
+        if start == -1:
+            """
+            Without total counting
+            """
+            return {'result': selected[:self.PAGE_SIZE]}
+
+        data = {
+            'result': selected[start: start + self.PAGE_SIZE],
+            'total': len(selected),
+        }
+        if start + self.PAGE_SIZE < len(selected):
+            data['next'] = start + self.PAGE_SIZE
+        return data
+
+    @staticmethod
+    def _split_filter(key: str) -> Tuple[str, str]:
+        for operator in ('>=', '<=', '>', '<', '!', '='):
+            if key.startswith(operator):
+                return operator, key[len(operator):]
+        return '=', key
+
+    @staticmethod
+    def _compare(operator: str, a: int, b: int) -> bool:
+        return {
+            '>=': a >= b,
+            '<=': a <= b,
+            '>': a > b,
+            '<': a < b,
+            '!': a != b,
+            '=': a == b,
+        }[operator]
+
+    def _get_item(self, items: Dict[int, Dict], params: Dict) -> Dict:
+        try:
+            item_id = int(params.get('id') or params.get('ID'))
+        except (TypeError, ValueError):
+            raise MethodError('ID_NOT_DEFINED', 'ID is not defined or invalid')
+
+        item = items.get(item_id)
+        if item is None:
+            raise MethodError('NOT_FOUND', 'Not found')
+        return item
+
+    def call_get(self, items: Dict[int, Dict], params: Dict) -> Dict:
+        return {'result': self._get_item(items, params)}
+
+    def call_add(self, items: Dict[int, Dict], params: Dict) -> Dict:
+        item_id = max(items, default=0) + 1
+        items[item_id] = {**(params.get('fields') or {}), 'ID': str(item_id)}
+        return {'result': item_id}
+
+    def call_update(self, items: Dict[int, Dict], params: Dict) -> Dict:
+        item = self._get_item(items, params)
+        item.update({**(params.get('fields') or {}), 'ID': item['ID']})
+        return {'result': True}
+
+    def call_delete(self, items: Dict[int, Dict], params: Dict) -> Dict:
+        item = self._get_item(items, params)
+        del items[int(item['ID'])]
+        return {'result': True}
+
+    def call_fields(self, items: Dict[int, Dict], params: Dict) -> Dict:
+        return {'result': {
+            'ID': {'type': 'integer', 'isReadOnly': True},
+            'NAME': {'type': 'string', 'isReadOnly': False},
+        }}
@@ -0,0 +1,190 @@
+import asyncio
+import fcntl
+import os
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+import ujson
+
+
+class BaseTokenStore(ABC):
+    """
+    Persistent storage of OAuth tokens, tokens of portal are saved by key (member_id or domain)
+    """
+
+    @abstractmethod
+    async def load(self, key: str) -> Optional[Dict]:
+        """
+        :param key: portal key
+        :return: tokens dict or None
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save(self, key: str, tokens: Dict) -> None:
+        """
+        :param key: portal key
+        :param tokens: access_token, refresh_token, expires_at, ...
+        """
+        raise NotImplementedError
+
+    @asynccontextmanager
+    async def lock(self, key: str) -> AsyncIterator[None]:
+        """
+        Lock tokens of portal for all processes, which share the store, while they are refreshed and saved.
+        Refresh token is single use, so only one process should refresh it
+        :param key: portal key
+        """
+        yield
+
+    async def close(self) -> None:
+        pass
+
+
+class FileTokenStore(BaseTokenStore):
+    """
+    Tokens of all portals in one json file, file is replaced atomically on save
+
+    File operations run in executor, lock() is flock of <path>.lock file for all portals
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _read(self) -> Dict:
+        try:
+            with open(self.path) as f:
+                return ujson.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, key: str, tokens: Dict) -> None:
+        data = self._read()
+        data[key] = tokens
+
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            ujson.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _lock(self) -> int:
+        fd = os.open(f"{self.path}.lock", os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except OSError:
+            os.close(fd)
+            raise
+        return fd
+
+    @staticmethod
+    def _unlock(fd: int) -> None:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    async def load(self, key: str) -> Optional[Dict]:
+        data = await asyncio.get_event_loop().run_in_executor(None, self._read)
+        return data.get(key)
+
+    async def save(self, key: str, tokens: Dict) -> None:
+        await asyncio.get_event_loop().run_in_executor(None, self._write, key, tokens)
+
+    @asynccontextmanager
+    async def lock(self, key: str) -> AsyncIterator[None]:
+        loop = asyncio.get_event_loop()
+        fd = await loop.run_in_executor(None, self._lock)
+        try:
+            yield
+        finally:
+            await loop.run_in_executor(None, self._unlock, fd)
+
+
+class DatabaseTokenStore(BaseTokenStore):
+    """
+    Tokens in table of DATABASE, requires databases package
+
+    lock() is transaction with row lock (SELECT ... FOR UPDATE) on PostgreSQL and MySQL,
+    SQLite locks database on write
+    """
+    TABLE = 'bitrix24_tokens'
+
+    def __init__(self, url: str):
+        from databases import Database
+
+        self.database = Database(url)
+        self._ready = False
+
+    async def _connect(self) -> None:
+        if self._ready:
+            return
+
+        if not self.database.is_connected:
+            await self.database.connect()
+
+        await self.database.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.TABLE} (key VARCHAR(255) PRIMARY KEY, data TEXT NOT NULL)"
+        )
+        self._ready = True
+
+    async def load(self, key: str) -> Optional[Dict]:
+        await self._connect()
+
+        row = await self.database.fetch_one(
+            f"SELECT data FROM {self.TABLE} WHERE key = :key",
+            values={'key': key},
+        )
+        if row is None:
+            return None
+
+        try:
+            return ujson.loads(row[0])
+        except ValueError:
+            return None
+
+    async def save(self, key: str, tokens: Dict) -> None:
+        await self._connect()
+
+        await self.database.execute(
+            f"INSERT INTO {self.TABLE} (key, data) VALUES (:key, :data) "
+            f"ON CONFLICT (key) DO UPDATE SET data = excluded.data",
+            values={'key': key, 'data': ujson.dumps(tokens)},
+        )
+
+    @asynccontextmanager
+    async def lock(self, key: str) -> AsyncIterator[None]:
+        await self._connect()
+
+        async with self.database.transaction():
+            if self.database.url.dialect in ('postgresql', 'mysql'):
+                # row of new portal doesn't exist yet and isn't locked, first save creates it
+                await self.database.fetch_one(
+                    f"SELECT key FROM {self.TABLE} WHERE key = :key FOR UPDATE",
+                    values={'key': key},
+                )
+            yield
+
+    async def close(self) -> None:
+        if self.database.is_connected:
+            await self.database.disconnect()
+        self._ready = False
+
+
+def get_token_store(backend: str, path: Optional[str] = None, url: Optional[str] = None) -> Optional[BaseTokenStore]:
+    """
+    :param backend: file, database or empty - tokens are not saved
+    :param path: json file for file backend
+    :param url: database url for database backend
+    :return:
+    """
+    if not backend:
+        return None
+    if backend == 'file':
+        return FileTokenStore(path)
+    if backend == 'database':
+        return DatabaseTokenStore(url)
+    raise ValueError(f"Unknown token store: {backend}")
@@ -1,4 +1,6 @@
-from typing import Dict, Optional, Any, Union, List
+from functools import lru_cache
+from typing import Dict, Optional, Any, Union, List, Tuple, Mapping, Iterable
+from urllib.parse import quote
 
 import aiohttp
 import ujson
@@ -10,85 +12,216 @@ def get_request_params(request_params):
     return {param['key']: param['value'] for param in request_params}
 
 
-async def resolve_response(response: aiohttp.ClientResponse) -> Dict:
+async def resolve_response(response: aiohttp.ClientResponse) -> 'Response':
     """
-
+    Read and parse response body once, before release aiohttp.ClientResponse
     :param response:
-    :return:
+    :return: Response
     """
-    if not response:
-        return {}
+    body = await response.read()
+
     try:
-        # TODO check ujson.loads
-        result = await response.json(loads=ujson.loads)
-    except:
-        result = {}
-    return result
-
-
-def dfs(data: Any, path: Optional[str] = None):
-    if isinstance(data, (dict,)):
-        return "&".join(
-            dfs(
-                next_data,
-                f"{path}[{key}]" if path else key
-            )
-            for key, next_data in data.items()
-        )
-    elif isinstance(data, (list, tuple)):
-        return "&".join(
-            dfs(
-                next_data,
-                f"{path}[{i}]" if path else i
-            )
-            for i, next_data in enumerate(data)
-        )
-    else:
-        return f"{path}={str(data)}" if path else str(data)
+        data = ujson.loads(body)
+    except ValueError:
+        data = {}
+
+    return Response(
+        data=data,
+        url=str(response.url),
+        status=response.status,
+        headers=response.headers,
+        size=len(body),
+    )
+
+
+@lru_cache(maxsize=1024)
+def _quote_key(key: Any) -> str:
+    return quote(str(key), safe='')
 
 
-def bitrix_urlencode(data: Union[Dict, List]) -> str:
-    result = dfs(data)
+def _quote_value(value: Any) -> str:
+    if type(value) is int:
+        return str(value)
+    return quote(str(value), safe='')
+
+
+def bitrix_urlencode(data: Union[Dict, List, Tuple]) -> str:
+    """
+    Encode params to query string in PHP format, e.g. filter[>ID]=1&select[0]=*
+
+    Iterative depth-first walk, keys and values are percent-escaped,
+    so values with "&", "=", "%" are transmitted as is
+    :param data:
+    :return:
+    """
+    if not isinstance(data, (dict, list, tuple)):
+        return _quote_value(data)
+
+    parts: List[str] = []
+    stack: List[Tuple[Optional[str], Any]] = [(None, data)]
 
-    return result
+    while stack:
+        path, value = stack.pop()
+
+        if isinstance(value, dict):
+            items = value.items()
+        elif isinstance(value, (list, tuple)):
+            items = enumerate(value)
+        else:
+            parts.append(f"{path}={_quote_value(value)}")
+            continue
+
+        # reversed, to pop children from stack in original order
+        stack.extend(reversed([
+            (f"{path}[{_quote_key(key)}]" if path is not None else _quote_key(key), next_value)
+            for key, next_value in items
+        ]))
+
+    return '&'.join(parts)
+
+
+def prepare_list_calls(method: str, params: Optional[Dict], starts: Iterable[int]) -> List[str]:
+    """
+    Encode list() sub commands, which differ by start param only,
+    common part of query string is encoded once
+    :param method:
+    :param params: list() params, start param is ignored
+    :param starts: start values
+    :return: list of encoded sub commands
+    """
+    query = bitrix_urlencode({
+        key: value for key, value in (params or {}).items() if key != 'start'
+    })
+
+    prefix = f"{method}?{query}&start=" if query else f"{method}?start="
+
+    return [f"{prefix}{start}" for start in starts]
+
+
+def prepare_call(name: str, call: Union[str, List, Tuple, Dict]) -> str:
+    """
+    Encode batch sub command, call formats:
+    - str - already encoded "method?query"
+    - list or tuple - (method, params)
+    - dict - {"method": method, "params": params}
+    :param name: sub command name
+    :param call:
+    :return: encoded sub command
+    """
+    # TODO remove isinstance()
+    if isinstance(call, str):
+        command = call
+    elif isinstance(call, (tuple, list)):
+        try:
+            command = '{}?{}'.format(call[0], bitrix_urlencode(call[1]))
+        except IndexError:
+            raise IncorrectCall(name, call)
+    elif isinstance(call, dict):
+        try:
+            command = '{}?{}'.format(call['method'], bitrix_urlencode(call['params']))
+        except KeyError:
+            raise IncorrectCall(name)
+    else:
+        raise IncorrectCall(name, call)
+    return command
 
 
 def prepare_batch(calls: Dict) -> Dict[str, str]:
     commands = {}
     for name, call in calls.items():
-        # TODO remove isinstance()
-        if isinstance(call, str):
-            command = call
-        elif isinstance(call, (tuple, list)):
-            try:
-                command = '{}?{}'.format(call[0], bitrix_urlencode(call[1]))
-            except IndexError:
-                raise IncorrectCall(name, call)
-        elif isinstance(call, dict):
-            try:
-                command = '{}?{}'.format(call['method'], bitrix_urlencode(call['params']))
-            except KeyError:
-                raise IncorrectCall(name)
-        else:
-            raise IncorrectCall(name, call)
-        commands[name] = command
+        commands[name] = prepare_call(name, call)
     return commands
 
 
+# json overhead of batch item: "name":"command",
+BATCH_ITEM_OVERHEAD = 6
+
+
+def get_batch_item_size(name: str, command: str) -> int:
+    """
+    Size of encoded sub command in batch request body, bytes
+    """
+    # encoded command is ascii, name can be not
+    return len(command) + len(name.encode()) + BATCH_ITEM_OVERHEAD
+
+
+def pack_batches(calls: Iterable[Tuple[str, Any]], max_count: int, max_size: int) -> List[Dict[str, str]]:
+    """
+    Encode sub commands and split them to batches by count and by encoded size,
+    each batch contains as many sub commands as possible without exceeding max_count and max_size,
+    sub command bigger than max_size is sent in separate batch.
+    Sub commands order is saved.
+    :param calls: (name, call) pairs, call in any prepare_batch format
+    :param max_count: max sub commands count in batch
+    :param max_size: max encoded size of batch sub commands in bytes
+    :return: list of encoded batches
+    """
+    batches: List[Dict[str, str]] = []
+    batch: Dict[str, str] = {}
+    batch_size = 0
+
+    for name, call in calls:
+        command = prepare_call(name, call)
+        size = get_batch_item_size(name, command)
+
+        if batch and (len(batch) >= max_count or batch_size + size > max_size):
+            batches.append(batch)
+            batch = {}
+            batch_size = 0
+
+        batch[name] = command
+        batch_size += size
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def get_call_method(call: Union[str, List, Tuple, Dict]) -> Optional[str]:
+    """
+    Method name of batch sub command in any format supported by prepare_batch
+    :param call:
+    :return:
+    """
+    if isinstance(call, str):
+        return call.split('?', 1)[0]
+    elif isinstance(call, (tuple, list)):
+        return call[0] if call else None
+    elif isinstance(call, dict):
+        return call.get('method')
+    return None
+
+
 class Response(object):
+    """
+    Parsed response, returned by drivers instead of aiohttp.ClientResponse
+    :param data: parsed json body
+    :param url:
+    :param status: HTTP status, None if request failed without response (connection error)
+    :param params:
+    :param headers:
+    :param size: body size in bytes
+    """
     __slots__ = [
         'status',
         'data',
         'url',
         'params',
+        'headers',
+        'size',
     ]
 
     def __init__(self, data: Optional[Dict] = None,
                  url: Optional[str] = None,
-                 status: int = 200,
-                 params: Optional[Dict] = None
+                 status: Optional[int] = 200,
+                 params: Optional[Dict] = None,
+                 headers: Optional[Mapping] = None,
+                 size: int = 0,
                  ):
         self.data = data or {}
         self.status = status
         self.url = url
         self.params = params
+        self.headers = headers or {}
+        self.size = size
@@ -1,10 +1,16 @@
 from typing import Union, Dict, List, Optional
 
-import aiohttp
+from bridge.utils.bitrix24.utils import Response
 
 RETRY_CODES = {
     409, 429, 500, 502, 503, 504
 }
+# Bitrix24 error codes, which mean temporary error
+RETRY_ERRORS = {
+    'QUERY_LIMIT_EXCEEDED',
+    'OPERATION_TIME_LIMIT',
+    'INTERNAL_SERVER_ERROR',
+}
 HTTP_OK = 200
 
 
@@ -105,52 +111,14 @@ class CommandResponse:
         }
 
     @staticmethod
-    async def from_client_response(cmd: Command, response: aiohttp.ClientResponse) -> 'CommandResponse':
+    def from_response(cmd: Command, response: Response) -> 'CommandResponse':
         """
-        Build CommandResponse from Command and aiohttp.ClientResponse
-        :param self:
+        Build CommandResponse from Command and parsed driver Response
         :param cmd:
         :param response:
         :return:
         """
-        data = {}
-
-        try:
-            """
-            response._body should be read in context manager before and saved in object cache
-            """
-            data = await response.json()
-        except Exception as e:
-            pass
-            print(e)
-
-        return CommandResponse(
-            cmd=cmd,
-            status_code=response.status,
-            next=data.get('next'),
-            total=data.get('total'),
-            result=[data]
-        )
-
-    @staticmethod
-    async def from_batch_response(cmd: Command, response: aiohttp.ClientResponse) -> 'CommandResponse':
-        """
-        Build CommandResponse from Command and batch aiohttp.ClientResponse
-        :param cmd:
-        :param response:
-        :return:
-        """
-
-        data = {}
-
-        try:
-            """
-            response._body should be read in context manager before and saved in object cache
-            """
-            data = await response.json()
-        except Exception as e:
-            pass
-            print(e)
+        data = response.data
 
         return CommandResponse(
             cmd=cmd,
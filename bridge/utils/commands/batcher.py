@@ -0,0 +1,238 @@
+import asyncio
+from typing import Dict, List, Optional
+
+from bridge.conf import settings
+from bridge.utils.bitrix24.api import Bitrix24
+from bridge.utils.bitrix24.limiter import current_priority, current_flow
+from bridge.utils.bitrix24.utils import Response, get_batch_item_size, prepare_call
+from bridge.utils.commands import HTTP_OK
+from bridge.utils.commands.utils import retry, RetryPolicy, RetryBudget, current_retry_budget
+
+
+class BatchCall:
+    """
+    Request waiting in AutoBatcher with context of its command
+    """
+    __slots__ = [
+        'method',
+        'params',
+        'future',
+        'size',
+        'attempt',
+        'budget',
+        'priority',
+        'flow',
+    ]
+
+    def __init__(self, method: str, params: Dict, future: asyncio.Future, size: int = 0, attempt: int = 0,
+                 budget: Optional[RetryBudget] = None, priority: int = 0, flow: str = 'default'):
+        """
+        :param method:
+        :param params:
+        :param future: resolved by response of request
+        :param size: size of encoded request in batch
+        :param attempt: retry number, starts from 0
+        :param budget: retry budget of command
+        :param priority: rate limiter priority of command
+        :param flow: fair share flow of command
+        """
+        self.method = method
+        self.params = params
+        self.future = future
+        self.size = size
+        self.attempt = attempt
+        self.budget = budget
+        self.priority = priority
+        self.flow = flow
+
+
+class AutoBatcher:
+    """
+    Collect single requests, which arrive in short window, and send them as one batch request
+
+    Batch is sent when window passed, max_size requests collected or their encoded size reached max_bytes,
+    batch result and result_error are split back to response for each request.
+    Batch request waits rate limiter with the highest priority of its requests (flow of that request),
+    request with temporary error in result_error (e.g. QUERY_LIMIT_EXCEEDED) is added to next batch after delay,
+    retries are taken from retry budget of its command.
+    """
+
+    def __init__(self, bx_client: Bitrix24, window: float, max_size: Optional[int] = None,
+                 max_bytes: Optional[int] = None, policy: Optional[RetryPolicy] = None, loop=None):
+        """
+        :param bx_client: Bitrix24 client
+        :param window: max seconds request waits in batch
+        :param max_size: max count of requests in batch, by default bx_client.PAGE_SIZE
+        :param max_bytes: max size of encoded requests in batch, by default COMMAND_BATCH_MAX_SIZE
+        :param policy: retries of failed requests, by default RetryPolicy with settings COMMAND_RETRY_*
+        :param loop: event loop
+        """
+        self.bx_client = bx_client
+        self.window = window
+        self.max_size = max_size or bx_client.PAGE_SIZE
+        self.max_bytes = max_bytes or settings.COMMAND_BATCH_MAX_SIZE
+        self.policy = policy or RetryPolicy(
+            max_count=settings.COMMAND_RETRY_MAX_COUNT,
+            base_delay=settings.COMMAND_RETRY_BASE_DELAY,
+            max_delay=settings.COMMAND_RETRY_MAX_DELAY,
+        )
+        self._loop = loop
+
+        self._calls: List[BatchCall] = []
+        self._size = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _get_loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def call(self, method: str, params: Optional[Dict] = None) -> Response:
+        """
+        Add request to next batch and wait response
+        :param method:
+        :param params:
+        :return: Response with data in format of single request
+        """
+        future = self._get_loop().create_future()
+        self._add(BatchCall(
+            method, params or {}, future,
+            budget=current_retry_budget.get(),
+            priority=current_priority.get(),
+            flow=current_flow.get(),
+        ))
+        return await future
+
+    def _add(self, call: BatchCall) -> None:
+        if call.future.done():
+            """
+            Caller doesn't wait response anymore
+            """
+            return
+
+        name = f"cmd_{len(self._calls)}"
+        call.size = get_batch_item_size(name, prepare_call(name, (call.method, call.params)))
+
+        if self._calls and self._size + call.size > self.max_bytes:
+            self.flush()
+
+        self._calls.append(call)
+        self._size += call.size
+
+        if len(self._calls) >= self.max_size or self._size >= self.max_bytes:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self._get_loop().call_later(self.window, self.flush)
+
+    def flush(self) -> None:
+        """
+        Send collected requests
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        calls, self._calls = self._calls, []
+        self._size = 0
+        if calls:
+            asyncio.ensure_future(self._send(calls), loop=self._get_loop())
+
+    async def _send(self, calls: List[BatchCall]) -> None:
+        # task has copy of context of request, which triggered flush, batch request gets context of all requests
+        first = max(calls, key=lambda call: call.priority)
+        current_priority.set(first.priority)
+        current_flow.set(first.flow)
+        # retries of whole batch are not charged to budget of one command
+        current_retry_budget.set(None)
+
+        try:
+            response = await retry(
+                self.bx_client.call_batch,
+                kwargs={
+                    'calls': {
+                        f"cmd_{i}": {
+                            'method': call.method,
+                            'params': call.params,
+                        }
+                        for i, call in enumerate(calls)
+                    }
+                },
+                policy=self.policy,
+            )
+            data = response.data
+        except Exception as e:
+            for call in calls:
+                if not call.future.done():
+                    call.future.set_exception(e)
+            return
+
+        # estimated size of single response
+        size = response.size // len(calls)
+
+        for i, call in enumerate(calls):
+            if call.future.done():
+                continue
+
+            call_response = self.split_response(f"cmd_{i}", response.status, data, size)
+
+            if response.status == HTTP_OK and 'error' in call_response.data and self.should_retry(call_response, call):
+                """
+                Temporary error of request in batch, send it again as unbatched request would be
+                """
+                self._get_loop().call_later(self.policy.get_delay(call.attempt, call_response), self._add, call)
+                call.attempt += 1
+                continue
+
+            call.future.set_result(call_response)
+
+    def should_retry(self, response: Response, call: BatchCall) -> bool:
+        if call.attempt >= self.policy.max_count or not self.policy.should_retry(response):
+            return False
+
+        return call.budget is None or call.budget.take()
+
+    @staticmethod
+    def split_response(name: str, status: int, data: Dict, size: int = 0) -> Response:
+        """
+        Build response of single request from batch response
+        :param name: request name in batch
+        :param status: batch response status
+        :param data: batch response data
+        :param size: estimated size of single response
+        :return:
+        """
+        batch_result = data.get('result')
+
+        if status != HTTP_OK or not isinstance(batch_result, dict):
+            """
+            Batch request failed at all, e.g. expired token
+            """
+            return Response(data=data, status=status, size=size)
+
+        def get(field: str):
+            value = batch_result.get(field)
+            return value.get(name) if isinstance(value, dict) else None
+
+        error = get('result_error')
+        if error is not None:
+            """
+            Error of request, batch status is kept, error is in data['error'] as in response of single request
+            """
+            return Response(data=error, status=status, size=size)
+
+        result = {
+            'result': get('result'),
+        }
+
+        total = get('result_total')
+        if total is not None:
+            result['total'] = total
+
+        next_page = get('result_next')
+        if next_page is not None:
+            result['next'] = next_page
+
+        return Response(data=result, status=status, size=size)
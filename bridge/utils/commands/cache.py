@@ -0,0 +1,195 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Any, Set, Tuple
+
+import ujson
+
+from bridge.utils.metrics import CACHE_HITS, CACHE_MISSES, CACHE_EVICTIONS, CACHE_SIZE, CACHE_ENTRIES
+
+# method types (last part of method name), which change entity
+WRITE_METHOD_TYPES = {
+    'add',
+    'update',
+    'delete',
+    'set',
+}
+
+# method types (last part of method name), which only read entity
+READ_METHOD_TYPES = {
+    'get',
+    'list',
+    'fields',
+}
+
+
+def get_method_entity(method: str) -> Tuple[str, str]:
+    """
+    Split method name to entity and method type, e.g. crm.product.get -> (crm.product, get)
+    :param method:
+    :return: tuple(entity, method type)
+    """
+    entity, _, method_type = method.rpartition('.')
+    return entity, method_type
+
+
+class ResponseCache:
+    """
+    LRU cache with TTL for responses of read only Bitrix24 methods
+
+    TTL defined for method type (e.g. get, fields, list) or full method name (e.g. crm.product.fields),
+    methods without TTL are not cached.
+    Cache size limited by sum of responses body size, least recently used responses are evicted first.
+    Write methods (add, update, delete) invalidate all cached responses of the same entity
+    and increase its generation, so response read before invalidation is not cached after it.
+    """
+
+    def __init__(self, ttl: Dict[str, float], max_size: int, metrics_key: Optional[str] = None):
+        """
+        :param ttl: seconds for method type or method name, e.g. {"get": 60, "crm.product.fields": 3600}
+        :param max_size: max sum of cached responses size in bytes
+        :param metrics_key: label of cache metrics, e.g. portal domain, None - metrics are not exported
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # key -> (expires_at, size, entity, response)
+        self._data: 'OrderedDict[str, Tuple[float, int, str, Any]]' = OrderedDict()
+        self._entities: Dict[str, Set[str]] = {}
+        # entity -> invalidations count
+        self._generations: Dict[str, int] = {}
+
+        if metrics_key is not None:
+            """
+            Collected on scrape, not on each lookup
+            """
+            for metric, function in (
+                    (CACHE_HITS, lambda: self.hits),
+                    (CACHE_MISSES, lambda: self.misses),
+                    (CACHE_EVICTIONS, lambda: self.evictions),
+                    (CACHE_SIZE, lambda: self.size),
+                    (CACHE_ENTRIES, lambda: len(self._data)),
+            ):
+                metric.labels(metrics_key).set_function(function)
+
+    def __len__(self):
+        return len(self._data)
+
+    @staticmethod
+    def make_key(method: str, params: Optional[Dict] = None) -> str:
+        """
+        Key from method and normalized params, params order doesn't matter
+        :param method:
+        :param params:
+        :return:
+        """
+        return f"{method}?{ujson.dumps(params or {}, sort_keys=True)}"
+
+    def get_ttl(self, method: str) -> float:
+        ttl = self.ttl.get(method)
+        if ttl is None:
+            ttl = self.ttl.get(get_method_entity(method)[1], 0)
+        return ttl
+
+    def is_cacheable(self, method: str) -> bool:
+        return self.get_ttl(method) > 0
+
+    def get(self, method: str, params: Optional[Dict] = None) -> Optional[Any]:
+        key = self.make_key(method, params)
+
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        expires_at, _, _, response = item
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def generation(self, method: str) -> int:
+        """
+        Invalidation generation of method entity, should be taken before request and passed to set()
+        """
+        return self._generations.get(get_method_entity(method)[0], 0)
+
+    def set(self, method: str, params: Optional[Dict], response: Any, size: int,
+            generation: Optional[int] = None) -> None:
+        """
+        :param method:
+        :param params:
+        :param response:
+        :param size: response body size in bytes
+        :param generation: generation() before request, response is skipped if entity was invalidated since then
+        """
+        ttl = self.get_ttl(method)
+        if ttl <= 0 or size > self.max_size:
+            return
+
+        if generation is not None and generation != self.generation(method):
+            """
+            Entity was changed while response was in flight, response can be stale
+            """
+            return
+
+        key = self.make_key(method, params)
+        if key in self._data:
+            self._remove(key)
+
+        entity = get_method_entity(method)[0]
+
+        self._data[key] = (time.monotonic() + ttl, size, entity, response)
+        self._entities.setdefault(entity, set()).add(key)
+        self.size += size
+
+        while self.size > self.max_size:
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def invalidate(self, method: str) -> None:
+        """
+        Remove cached responses of entity, if method changes entity
+        :param method:
+        :return:
+        """
+        entity, method_type = get_method_entity(method)
+        if method_type not in WRITE_METHOD_TYPES:
+            return
+
+        self._generations[entity] = self._generations.get(entity, 0) + 1
+
+        for key in self._entities.pop(entity, ()):
+            self._remove(key)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._entities.clear()
+        self.size = 0
+
+    def _remove(self, key: str) -> None:
+        _, size, entity, _ = self._data.pop(key)
+        self.size -= size
+
+        keys = self._entities.get(entity)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._entities[entity]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'count': len(self._data),
+            'size': self.size,
+        }
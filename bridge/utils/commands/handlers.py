@@ -1,11 +1,22 @@
 import asyncio
+import time
 from abc import ABC
-from typing import Dict, List, Optional, Tuple, Coroutine
+from typing import Dict, List, Optional, Set, Tuple, Coroutine, AsyncIterator
 
+from bridge.conf import settings
 from bridge.utils.bitrix24.api import Bitrix24
-from bridge.utils.commands import Command, CommandResponse
+from bridge.utils.bitrix24.exceptions import UnknownPortal
+from bridge.utils.bitrix24.limiter import current_priority, current_flow
+from bridge.utils.bitrix24.pool import Bitrix24Pool
+from bridge.utils.bitrix24.utils import get_call_method, prepare_batch, prepare_list_calls, Response
+from bridge.utils.commands import Command, CommandResponse, HTTP_OK
 from bridge.extensions import ext
-from bridge.utils.commands.utils import fast_div_ceil, retry
+from bridge.utils.commands.batcher import AutoBatcher
+from bridge.utils.commands.scheduler import schedule_batch, resolve_batch
+from bridge.utils.commands.cache import ResponseCache, READ_METHOD_TYPES, get_method_entity
+from bridge.utils.commands.utils import fast_div_ceil, retry, SingleFlight, RetryBudget, current_retry_budget, \
+    get_priority, get_flow, get_method_label
+from bridge.utils.metrics import COMMAND_DURATION, COMMAND_ERRORS, OTHER_LABEL
 
 
 class BaseCommandHandler(ABC):
@@ -50,9 +61,47 @@ class BaseCommandHandler(ABC):
 
 
 class CommandHandler(BaseCommandHandler):
+    # entity ID field, used for keyset() pagination
+    KEYSET_FIELD = 'ID'
 
-    def __init__(self, bx_client: Optional[Bitrix24] = None):
+    def __init__(self, bx_client: Optional[Bitrix24] = None,
+                 batch_concurrency: Optional[int] = None, batch_max_size: Optional[int] = None,
+                 cache: Optional[ResponseCache] = None, coalesce: Optional[bool] = None,
+                 auto_batcher: Optional[AutoBatcher] = None, retry_budget: Optional[int] = None):
+        """
+        :param bx_client: Bitrix24 client
+        :param batch_concurrency: max count of sub batches processed in parallel
+        :param batch_max_size: max size of encoded sub commands in one batch request, bytes
+        :param cache: cache for responses of read only methods, by default used if COMMAND_CACHE_ENABLED
+        :param coalesce: identical concurrent read only commands share one request
+        :param auto_batcher: send default commands by batch requests, by default used if COMMAND_AUTO_BATCH_ENABLED
+        :param retry_budget: max retries count for all requests of one command
+        """
         self.bx_client = bx_client or ext.bitrix24
+        self.batch_concurrency = batch_concurrency or settings.COMMAND_BATCH_CONCURRENCY
+        self.batch_max_size = batch_max_size or settings.COMMAND_BATCH_MAX_SIZE
+        self.retry_budget = settings.COMMAND_RETRY_BUDGET if retry_budget is None else retry_budget
+
+        if cache is None and settings.COMMAND_CACHE_ENABLED:
+            cache = ResponseCache(
+                ttl=settings.COMMAND_CACHE_TTL,
+                max_size=settings.COMMAND_CACHE_MAX_SIZE,
+                metrics_key=self.bx_client.domain,
+            )
+        self.cache = cache
+
+        if coalesce is None:
+            coalesce = settings.COMMAND_COALESCE_ENABLED
+        self.single_flight = SingleFlight() if coalesce else None
+
+        if auto_batcher is None and settings.COMMAND_AUTO_BATCH_ENABLED:
+            auto_batcher = AutoBatcher(
+                self.bx_client,
+                window=settings.COMMAND_AUTO_BATCH_WINDOW,
+                max_size=settings.COMMAND_AUTO_BATCH_SIZE,
+                max_bytes=self.batch_max_size,
+            )
+        self.auto_batcher = auto_batcher
 
     async def dispatch(self, data: Dict, *args, **kwargs) -> Optional[List[CommandResponse]]:
         cmd = Command(**data)
@@ -61,12 +110,26 @@ class CommandHandler(BaseCommandHandler):
             ext.logger.error(f"Error on cmd dispatch, data.method is None: {str(data)}")
             return None
 
+        started_at = time.monotonic()
+        budget_token = current_retry_budget.set(RetryBudget(self.retry_budget))
+        priority = get_priority(cmd.meta)
+        priority_token = current_priority.set(priority) if priority is not None else None
+        flow_token = current_flow.set(get_flow(cmd.meta, cmd.method))
+        handler = getattr(self, cmd.action, self.default)
+        """action and method come from message, label metrics by handler and known method only"""
+        labels = (getattr(handler, '__name__', OTHER_LABEL), get_method_label(cmd.method))
         try:
-            handler = getattr(self, cmd.action, self.default)
             response: List[CommandResponse] = await handler(cmd)
         except Exception as e:
             ext.logger.error(f"Error on process cmd: {str(e)}")
+            COMMAND_ERRORS.labels(*labels).inc()
             return None
+        finally:
+            current_retry_budget.reset(budget_token)
+            if priority_token is not None:
+                current_priority.reset(priority_token)
+            current_flow.reset(flow_token)
+            COMMAND_DURATION.labels(*labels).observe(time.monotonic() - started_at)
 
         return response
 
@@ -79,12 +142,65 @@ class CommandHandler(BaseCommandHandler):
         """
         return self.dispatch(*args, **kwargs)
 
+    async def stream(self, data: Dict) -> AsyncIterator[List[CommandResponse]]:
+        """
+        Same as dispatch, but list() and keyset() results yielded page by page (or sub batch),
+        as soon as they arrive, other actions yield single dispatch result
+        :param data:
+        :return: async iterator of List[CommandResponse]
+        """
+        cmd = Command(**data)
+
+        pages_iterators = {
+            'list': self._iter_list,
+            'keyset': self._iter_keyset,
+        }
+
+        if not cmd.method or cmd.action not in pages_iterators:
+            response = await self.dispatch(data)
+            if response is not None:
+                yield response
+            return
+
+        # not reset, generator can be finalized in other context
+        current_retry_budget.set(RetryBudget(self.retry_budget))
+        priority = get_priority(cmd.meta)
+        if priority is not None:
+            current_priority.set(priority)
+        current_flow.set(get_flow(cmd.meta, cmd.method))
+
+        async for page in pages_iterators[cmd.action](cmd):
+            yield [page]
+
     async def list(self, cmd: Command) -> List[CommandResponse]:
         """
         Make requests with pagination, get all list() response
         :param cmd:
         :return: List[CommandResponse], len(return) == 1
         """
+        first_page: Optional[CommandResponse] = None
+        responses_data: List[Dict] = []
+
+        async for page in self._iter_list(cmd):
+            if first_page is None:
+                first_page = page
+            responses_data.extend(page.result)
+
+        cmd_response = CommandResponse(
+            cmd=cmd,
+            status_code=first_page.status_code,
+            total=first_page.total,
+            result=responses_data
+        )
+
+        return [cmd_response]
+
+    async def _iter_list(self, cmd: Command) -> AsyncIterator[CommandResponse]:
+        """
+        Make requests with pagination, yield first page, then result of each batch request
+        :param cmd:
+        :return: async iterator of CommandResponse
+        """
 
         # remove pagination param if it exist in params
         cmd.params.pop('start', 0)
@@ -96,9 +212,15 @@ class CommandHandler(BaseCommandHandler):
             cmd.params['select'] = ["*", "PROPERTY_*"]
 
         # make first request for getting next and total values
-        first_request_response = await self.bx_client.call_method(cmd.method, params=cmd.params)
+        first_request_response = await retry(
+            self.bx_client.call_method,
+            kwargs={
+                "method": cmd.method,
+                "params": cmd.params
+            }
+        )
 
-        first_request_data = await first_request_response.json()
+        first_request_data = first_request_response.data
         total = first_request_data.get('total', 0)
 
         # additional requests count, exclude first_request (-1)
@@ -111,54 +233,244 @@ class CommandHandler(BaseCommandHandler):
             ) - 1
         )
 
-        # no copy, because first_request_data not used without other data
-        responses_data: List[Dict] = first_request_data.get('result')
+        yield CommandResponse(
+            cmd=cmd,
+            status_code=first_request_response.status,
+            total=first_request_data.get('total'),
+            result=first_request_data.get('result')
+        )
 
         if requests_count > 0:
             """
             Composite requests to batch command,
             Exclude start = 0, case it first_request,
             """
+            calls = prepare_list_calls(
+                cmd.method,
+                cmd.params,
+                starts=(i * self.bx_client.PAGE_SIZE for i in range(1, requests_count + 1))
+            )
+
             batch_command = Command(
                 method="batch",
                 params={
                     "cmd": {
-                        str(i): {
-                            "method": cmd.method,
-                            "params": {
-                                **cmd.params,
-                                "start": i * self.bx_client.PAGE_SIZE
-                            }
-                        }
-                        for i in range(1, requests_count + 1)
+                        str(i): call
+                        for i, call in enumerate(calls, start=1)
                     }
                 }
             )
 
-            batch_result = await self.batch(batch_command)
+            async for command_response in self._iter_batch(batch_command):
+                responses_data: List[Dict] = []
+
+                # iterate over CommandResponse result
+                for inner_result in command_response.result:
+                    """
+                    Unpack Bitrix Batch 'result' + Bitrix list 'result'
+                    """
+                    for res_list in inner_result.get('result', {}).get('result', {}).values():
+                        responses_data.extend(
+                            res_list
+                        )
+
+                yield CommandResponse(
+                    cmd=cmd,
+                    status_code=command_response.status_code,
+                    total=total,
+                    result=responses_data
+                )
+
+    async def keyset(self, cmd: Command) -> List[CommandResponse]:
+        """
+        Make requests with ID-cursor pagination, get all list() response
+
+        Alternative for list(), which is faster for big entities:
+        order by ID, filter >ID from last page and start=-1 (skip total counting).
+        Cursor steps packed to batch, next step get last ID from previous step with $result macro,
+        steps count in batch grows from 1 to PAGE_SIZE, so small lists cost one request.
+        Only first step counts total, so batches have no steps after the last page.
 
-            # get first response, because we send only one command
-            command_response: CommandResponse = batch_result[0]
+        :param cmd:
+        :return: List[CommandResponse], len(return) == 1, error response if list can't be loaded completely
+        """
+        status_code = HTTP_OK
+        responses_data: List[Dict] = []
 
-            # iterate over CommandResponse result
-            for inner_result in command_response.result:
+        async for page, failed in self._iter_keyset_pages(cmd):
+            if failed:
                 """
-                Unpack Bitrix Batch 'result' + Bitrix list 'result'
+                Not complete list is not returned as success
                 """
-                for res_list in inner_result.get('result', {}).get('result', {}).values():
-                    responses_data.extend(
-                        res_list
-                    )
+                return [page]
+
+            status_code = page.status_code
+            responses_data.extend(page.result)
 
         cmd_response = CommandResponse(
             cmd=cmd,
-            status_code=first_request_response.status,
-            total=first_request_data.get('total'),
+            status_code=status_code,
+            total=len(responses_data),
             result=responses_data
         )
 
         return [cmd_response]
 
+    async def _iter_keyset(self, cmd: Command) -> AsyncIterator[CommandResponse]:
+        """
+        Make requests with ID-cursor pagination, yield result of each batch request,
+        last response is error if list can't be loaded completely
+        :param cmd:
+        :return: async iterator of CommandResponse
+        """
+        async for page, _ in self._iter_keyset_pages(cmd):
+            yield page
+
+    async def _iter_keyset_pages(self, cmd: Command) -> AsyncIterator[Tuple[CommandResponse, bool]]:
+        """
+        :param cmd:
+        :return: async iterator of (CommandResponse, failed), iteration stops after failed response
+        """
+        key = self.KEYSET_FIELD
+        page_size = self.bx_client.PAGE_SIZE
+
+        cmd.params.pop('start', None)
+
+        if 'select' not in cmd.params:
+            """
+            Add select params to return custom property
+            """
+            cmd.params['select'] = ["*", "PROPERTY_*"]
+        elif key not in cmd.params['select'] and "*" not in cmd.params['select']:
+            cmd.params['select'] = [*cmd.params['select'], key]
+
+        cmd_filter = dict(cmd.params.get('filter') or {})
+        last_id = cmd_filter.pop(f">{key}", 0)
+
+        params = {
+            **cmd.params,
+            'order': {key: 'ASC'},
+            'start': -1,
+        }
+
+        steps_count = 1
+        # records left after last_id, unknown until first step returns total
+        remaining: Optional[int] = None
+
+        while True:
+            calls = {
+                f"step_{i}": {
+                    "method": cmd.method,
+                    "params": {
+                        **params,
+                        # first request counts total once
+                        **({'start': 0} if remaining is None else {}),
+                        "filter": {
+                            **cmd_filter,
+                            f">{key}": last_id if i == 0 else f"$result[step_{i - 1}][{page_size - 1}][{key}]"
+                        }
+                    }
+                }
+                for i in range(steps_count)
+            }
+
+            response = await retry(self._call_keyset_steps, kwargs={'calls': calls})
+
+            if self._is_failed(response):
+                """
+                First step failed, retries are exhausted
+                """
+                yield CommandResponse(
+                    cmd=cmd,
+                    status_code=response.status,
+                    result=[response.data]
+                ), True
+                break
+
+            batch_result = response.data['result']
+            pages = batch_result.get('result') or {}
+            errors = batch_result.get('result_error') or {}
+
+            if remaining is None:
+                total = (batch_result.get('result_total') or {}).get('step_0')
+                # -1: total is not returned, steps count is only doubled
+                remaining = int(total) if total is not None else -1
+
+            responses_data: List[Dict] = []
+            finished = False
+            failed = False
+            for i in range(steps_count):
+                if f"step_{i}" in errors:
+                    """
+                    Step failed, next batch starts from last good cursor
+                    """
+                    failed = True
+                    break
+
+                page = pages.get(f"step_{i}") or []
+                responses_data.extend(page)
+
+                if len(page) < page_size:
+                    # last page
+                    finished = True
+                    break
+
+                last_id = page[-1][key]
+
+            yield CommandResponse(
+                cmd=cmd,
+                status_code=response.status,
+                result=responses_data
+            ), False
+
+            if finished:
+                break
+
+            if failed:
+                steps_count = max(steps_count // 2, 1)
+            else:
+                steps_count = min(steps_count * 2, page_size)
+
+            if remaining >= 0:
+                """
+                Not more steps than pages left, records added since counting are loaded by next batches
+                """
+                remaining = max(remaining - len(responses_data), 0)
+                steps_count = max(min(steps_count, fast_div_ceil(remaining, page_size)), 1)
+
+    @staticmethod
+    def _is_failed(response: Response) -> bool:
+        return response.status != HTTP_OK or 'error' in response.data
+
+    async def _call_keyset_steps(self, calls: Dict[str, Dict]) -> Response:
+        """
+        Batch request of cursor steps,
+        error of first step or response without result is returned as error response,
+        so it is retried from the same cursor
+        :param calls: steps step_0, step_1, ...
+        :return:
+        """
+        response = await self.bx_client.call_batch(calls=calls)
+        if response.status != HTTP_OK:
+            return response
+
+        batch_result = response.data.get('result') if isinstance(response.data, dict) else None
+        if not isinstance(batch_result, dict):
+            """
+            Empty or not json body, not the end of list
+            """
+            return Response(
+                data={'error': 'INTERNAL_SERVER_ERROR', 'error_description': 'Batch response without result'},
+                url=response.url, status=response.status, headers=response.headers, size=response.size,
+            )
+
+        errors = batch_result.get('result_error') or {}
+        if 'step_0' in errors:
+            return Response(data=errors['step_0'], url=response.url, status=response.status,
+                            headers=response.headers, size=response.size)
+
+        return response
+
     async def batch(self, cmd: Command) -> List[CommandResponse]:
         """
         Make batch request with pagination if command numbers more than 50
@@ -168,37 +480,88 @@ class CommandHandler(BaseCommandHandler):
         :param cmd:
         :return: list of CommandResponse, len(return) >= 1
         """
-        # create list[tuple] of commands
-        commands: List[Tuple] = list(cmd.params.pop('cmd', None).items())
+        return [response async for response in self._iter_batch(cmd)]
 
-        sub_commands_count = fast_div_ceil(
-            x=len(commands),
-            y=self.bx_client.PAGE_SIZE,
-            coeff=self.bx_client.PAGE_SIZE_MINIS_ONE
+    async def _iter_batch(self, cmd: Command) -> AsyncIterator[CommandResponse]:
+        """
+        Schedule sub commands by $result[name] dependencies, send independent sub batches in parallel,
+        yield CommandResponse for each sub batch in order of scheduled chains
+        :param cmd:
+        :return: async iterator of CommandResponse
+        """
+        # split commands by dependencies, PAGE_SIZE and encoded size
+        chains: List[List[Dict[str, str]]] = schedule_batch(
+            prepare_batch(cmd.params.pop('cmd', None)),
+            max_count=self.bx_client.PAGE_SIZE,
+            max_size=self.batch_max_size,
         )
 
-        # split command by PAGE_SIZE
-        sub_commands: List[List[Tuple]] = [
-            commands[i: i + self.bx_client.PAGE_SIZE]
-            for i in range(0, sub_commands_count, self.bx_client.PAGE_SIZE)
-        ]
-
-        responses = []
+        # limit parallel sub batches, request rate limited by bx_client driver
+        semaphore = asyncio.Semaphore(self.batch_concurrency)
 
-        for sub_command in sub_commands:
-            response = await retry(
-                self.bx_client.call_batch,
-                kwargs={
-                    'calls': {
-                        name: command
-                        for name, command in sub_command
+        async def process(sub_command: Dict[str, str]) -> CommandResponse:
+            async with semaphore:
+                response = await retry(
+                    self.bx_client.call_batch,
+                    kwargs={
+                        'calls': sub_command
                     }
-                }
-            )
-            res = await CommandResponse.from_client_response(cmd=cmd, response=response)
-            responses.append(res)
+                )
+
+                if self.cache is not None:
+                    for command in sub_command.values():
+                        self.cache.invalidate(get_call_method(command))
 
-        return responses
+                return CommandResponse.from_response(cmd=cmd, response=response)
+
+        async def process_chain(chain: List[Dict[str, str]]) -> List[CommandResponse]:
+            """
+            Send batches of chain one by one, macros of previous batches are resolved by their results
+            """
+            responses = []
+            # results of sent batches by macro family: {"result": {name: result}, "result_next": ...}
+            results: Dict[str, Dict] = {}
+            sent: Set[str] = set()
+
+            for sub_command in chain:
+                sub_command, errors = resolve_batch(sub_command, results, sent)
+                sent.update(sub_command)
+                sent.update(errors)
+
+                if sub_command:
+                    response = await process(sub_command)
+                else:
+                    response = CommandResponse.from_response(
+                        cmd=cmd, response=Response({'result': {'result': {}, 'result_error': {}}}, status=HTTP_OK)
+                    )
+                responses.append(response)
+
+                # batch response: {"result": {"result": {name: result}, "result_error": ...}}
+                batch_result = response.result[0].get('result') if response.result else None
+                if not isinstance(batch_result, dict):
+                    continue
+
+                if errors:
+                    """Bitrix24 returns empty result_error as list"""
+                    result_error = batch_result.get('result_error')
+                    batch_result['result_error'] = {**(result_error if isinstance(result_error, dict) else {}), **errors}
+
+                for family, values in batch_result.items():
+                    if isinstance(values, dict):
+                        results.setdefault(family, {}).update(values)
+
+            return responses
+
+        tasks = [asyncio.ensure_future(process_chain(chain)) for chain in chains]
+
+        try:
+            # await in order of chains
+            for task in tasks:
+                for response in await task:
+                    yield response
+        finally:
+            for task in tasks:
+                task.cancel()
 
     async def default(self, cmd: Command) -> List[CommandResponse]:
         """
@@ -206,15 +569,106 @@ class CommandHandler(BaseCommandHandler):
         :param cmd:
         :return: list of CommandResponse, len(return) == 1
         """
+        use_cache = self.cache is not None and self.cache.is_cacheable(cmd.method)
 
-        response = await retry(
-            self.bx_client.call_method,
-            kwargs={
-                "method": cmd.method,
-                "params": cmd.params
-            }
-        )
+        response = self.cache.get(cmd.method, cmd.params) if use_cache else None
+
+        if response is None:
+            if self.single_flight is not None and get_method_entity(cmd.method)[1] in READ_METHOD_TYPES:
+                """
+                Identical read commands in flight share one request, each gets own CommandResponse
+                """
+                response = await self.single_flight.do(
+                    ResponseCache.make_key(cmd.method, cmd.params),
+                    self._call_method, cmd.method, cmd.params, use_cache
+                )
+            else:
+                response = await self._call_method(cmd.method, cmd.params, use_cache)
 
-        cmd_response = await CommandResponse.from_client_response(cmd=cmd, response=response)
+        if self.cache is not None:
+            self.cache.invalidate(cmd.method)
+
+        cmd_response = CommandResponse.from_response(cmd=cmd, response=response)
 
         return [cmd_response]
+
+    async def _call_method(self, method: str, params: Dict, use_cache: bool = False) -> Response:
+        """
+        Make single request with retry and save response to cache
+        :param method:
+        :param params:
+        :param use_cache:
+        :return: response
+        """
+        generation = self.cache.generation(method) if use_cache else None
+
+        if self.auto_batcher is not None and method != 'batch':
+            """
+            Batch request can't contain batch sub command
+            """
+            response = await self.auto_batcher.call(method, params)
+        else:
+            response = await retry(
+                self.bx_client.call_method,
+                kwargs={
+                    "method": method,
+                    "params": params
+                }
+            )
+
+        if use_cache and response.status == HTTP_OK:
+            self.cache.set(method, params, response, size=response.size, generation=generation)
+
+        return response
+
+
+class PortalCommandHandler(BaseCommandHandler):
+    """
+    Route commands of many portals, portal is selected from command meta (member_id or domain)
+
+    Each portal has own CommandHandler, so cache, coalescing and auto batching never mix portals,
+    and own Bitrix24 client from pool with own rate limiter.
+    """
+
+    def __init__(self, pool: Bitrix24Pool, **handler_options):
+        """
+        :param pool: Bitrix24 clients
+        :param handler_options: CommandHandler kwargs for each portal
+        """
+        self.pool = pool
+        self.handler_options = handler_options
+
+        # domain -> CommandHandler
+        self._handlers: Dict[str, CommandHandler] = {}
+
+    def get_handler(self, meta: Optional[Dict] = None) -> CommandHandler:
+        """
+        CommandHandler of portal from meta
+        :param meta: command meta
+        :return:
+        :raise UnknownPortal:
+        """
+        client = self.pool.resolve(meta)
+
+        handler = self._handlers.get(client.domain)
+        if handler is None or handler.bx_client is not client:
+            """
+            New portal or client was replaced in pool
+            """
+            handler = CommandHandler(client, **self.handler_options)
+            self._handlers[client.domain] = handler
+
+        return handler
+
+    async def dispatch(self, data: Dict, *args, **kwargs) -> Optional[List[CommandResponse]]:
+        try:
+            handler = self.get_handler(data.get('meta'))
+        except UnknownPortal as e:
+            ext.logger.error(f"Error on cmd dispatch: {str(e)}")
+            return None
+
+        return await handler.dispatch(data, *args, **kwargs)
+
+    async def stream(self, data: Dict) -> AsyncIterator[List[CommandResponse]]:
+        async for response in self.get_handler(data.get('meta')).stream(data):
+            yield response
@@ -0,0 +1,205 @@
+import heapq
+import re
+from typing import Dict, List, Set, Any, Optional, Tuple
+from urllib.parse import quote, unquote
+
+from bridge.utils.bitrix24.utils import get_batch_item_size, pack_batches
+
+# $result[name][field]... macro, raw or url encoded,
+# also $result_error, $result_total, $result_next and $result_time macros of the same sub command
+RESULT_MACRO = re.compile(
+    r'(?:\$|%24)(?P<family>result(?:_error|_total|_next|_time)?)(?:\[|%5B)(?P<name>[^&=]+?)(?:\]|%5D)'
+    r'(?P<path>(?:(?:\[|%5B)[^&=]*?(?:\]|%5D))*)',
+    re.IGNORECASE,
+)
+MACRO_PATH_KEY = re.compile(r'(?:\[|%5B)([^&=]*?)(?:\]|%5D)', re.IGNORECASE)
+UNRESOLVED_REF_ERROR = 'UNRESOLVED_RESULT'
+
+
+class UnresolvedRef(Exception):
+    """
+    Macro refers to sub command of previous batch, which result can't be substituted
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.name = name
+
+
+def get_call_refs(command: str) -> Set[str]:
+    """
+    Names of sub commands, which results are used by $result[name] (and $result_next[name], etc.) macros
+    :param command: encoded sub command
+    :return:
+    """
+    if 'result' not in command:
+        return set()
+    return {unquote(match.group('name')) for match in RESULT_MACRO.finditer(command)}
+
+
+def resolve_refs(command: str, results: Dict[str, Dict[str, Any]], sent: Optional[Set[str]] = None) -> str:
+    """
+    Replace $result[name][field]... macros by values from results of already sent batches,
+    macros of unknown sub commands and not scalar values are left for Bitrix24
+    :param command: encoded sub command
+    :param results: results of sent batches by macro family,
+        e.g. {'result': {name: result}, 'result_next': {name: next}}
+    :param sent: names of sub commands of sent batches, their macros can't be left for Bitrix24
+    :return: encoded sub command
+    :raise UnresolvedRef: macro of sent sub command can't be resolved, e.g. sub command failed
+    """
+    if 'result' not in command:
+        return command
+
+    def replace(match) -> str:
+        name = unquote(match.group('name'))
+        values = results.get(match.group('family').lower(), {})
+        strict = sent is not None and name in sent
+        if name not in values:
+            if strict:
+                raise UnresolvedRef(name)
+            return match.group(0)
+
+        value = values[name]
+        for key in MACRO_PATH_KEY.findall(match.group('path')):
+            key = unquote(key)
+            try:
+                value = value[int(key)] if isinstance(value, list) else value[key]
+            except (KeyError, IndexError, ValueError, TypeError):
+                value = None
+                break
+
+        if isinstance(value, (dict, list)) or value is None:
+            if strict:
+                raise UnresolvedRef(name)
+            return match.group(0)
+        return quote(str(value), safe='')
+
+    return RESULT_MACRO.sub(replace, command)
+
+
+def resolve_batch(batch: Dict[str, str], results: Dict[str, Dict[str, Any]],
+                  sent: Set[str]) -> Tuple[Dict[str, str], Dict[str, Dict[str, str]]]:
+    """
+    Resolve macros of batch from chain by results of previous batches,
+    sub commands with unresolved macros and their consumers in the batch are failed instead of sending
+    :param batch: encoded sub commands, name -> command
+    :param results: results of sent batches by macro family, see resolve_refs()
+    :param sent: names of sub commands of sent batches
+    :return: resolved sub commands, errors of failed sub commands in result_error format
+    """
+    resolved: Dict[str, str] = {}
+    errors: Dict[str, Dict[str, str]] = {}
+
+    # batch is in topological order, producers are checked before consumers
+    for name, command in batch.items():
+        try:
+            failed = get_call_refs(command) & set(errors)
+            if failed:
+                raise UnresolvedRef(failed.pop())
+            resolved[name] = resolve_refs(command, results, sent)
+        except UnresolvedRef as e:
+            errors[name] = {
+                'error': UNRESOLVED_REF_ERROR,
+                'error_description': f'Result of sub command {e.name} is not available',
+            }
+
+    return resolved, errors
+
+
+def schedule_batch(commands: Dict[str, str], max_count: int, max_size: int) -> List[List[Dict[str, str]]]:
+    """
+    Split batch sub commands to chains of batches by $result[name] dependencies
+
+    Connected sub commands (producer and its consumers) are kept in the same batch in topological order,
+    so Bitrix24 resolves macros itself. Independent groups are packed together into batches,
+    which can be sent in parallel. Group bigger than one batch becomes chain of batches,
+    which should be sent one by one with resolve_refs() of previous results.
+
+    :param commands: encoded sub commands, name -> command
+    :param max_count: max sub commands count in batch
+    :param max_size: max encoded size of batch sub commands in bytes
+    :return: list of chains, chain is list of batches
+    """
+    names = list(commands)
+    index = {name: i for i, name in enumerate(names)}
+
+    deps: Dict[str, Set[str]] = {
+        name: {ref for ref in get_call_refs(commands[name]) if ref in index and ref != name}
+        for name in names
+    }
+
+    # connected components by union-find
+    parent = list(range(len(names)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for name, refs in deps.items():
+        for ref in refs:
+            a, b = find(index[name]), find(index[ref])
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+
+    components: Dict[int, List[str]] = {}
+    for name in names:
+        components.setdefault(find(index[name]), []).append(name)
+
+    chains: List[List[Dict[str, str]]] = []
+    batch: Dict[str, str] = {}
+    batch_size = 0
+
+    for component in components.values():
+        ordered = _toposort(component, deps, index)
+        size = sum(get_batch_item_size(name, commands[name]) for name in ordered)
+
+        if len(ordered) > max_count or size > max_size:
+            chains.append(pack_batches(((name, commands[name]) for name in ordered), max_count, max_size))
+            continue
+
+        if batch and (len(batch) + len(ordered) > max_count or batch_size + size > max_size):
+            chains.append([batch])
+            batch = {}
+            batch_size = 0
+
+        for name in ordered:
+            batch[name] = commands[name]
+        batch_size += size
+
+    if batch:
+        chains.append([batch])
+
+    return chains
+
+
+def _toposort(component: List[str], deps: Dict[str, Set[str]], index: Dict[str, int]) -> List[str]:
+    """
+    Producers before consumers, otherwise original order,
+    sub commands of cycle are left in original order
+    """
+    pending = {name: len(deps[name]) for name in component}
+    consumers: Dict[str, List[str]] = {}
+    for name in component:
+        for ref in deps[name]:
+            consumers.setdefault(ref, []).append(name)
+
+    ready = [(index[name], name) for name, count in pending.items() if count == 0]
+    heapq.heapify(ready)
+
+    ordered: List[str] = []
+    while ready:
+        _, name = heapq.heappop(ready)
+        ordered.append(name)
+        for consumer in consumers.get(name, ()):
+            pending[consumer] -= 1
+            if pending[consumer] == 0:
+                heapq.heappush(ready, (index[consumer], consumer))
+
+    if len(ordered) < len(component):
+        done = set(ordered)
+        ordered.extend(name for name in component if name not in done)
+
+    return ordered
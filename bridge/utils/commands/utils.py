@@ -1,8 +1,14 @@
-from typing import Optional, Set, List, Union, Dict
+import asyncio
+import random
+import time
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from typing import Optional, Set, List, Union, Dict, Hashable, Callable, Awaitable, Any
 
-import aiohttp
-
-from bridge.utils.commands import RETRY_CODES
+from bridge.conf import settings
+from bridge.utils.bitrix24.utils import Response
+from bridge.utils.commands import RETRY_CODES, RETRY_ERRORS
+from bridge.utils.metrics import LabelValues
 
 
 def fast_div_ceil(x: int, y: int, coeff: Optional[int] = None) -> int:
@@ -32,39 +38,230 @@ def fast_div_ceil(x: int, y: int, coeff: Optional[int] = None) -> int:
     return (x + coeff) // y
 
 
+class RetryBudget:
+    """
+    Retries count shared by all requests of one command
+    """
+
+    def __init__(self, max_count: int):
+        self.left = max_count
+
+    def take(self) -> bool:
+        if self.left <= 0:
+            return False
+        self.left -= 1
+        return True
+
+
+# retry budget of current command, set by command handler
+current_retry_budget: 'ContextVar[Optional[RetryBudget]]' = ContextVar('current_retry_budget', default=None)
+
+
+def get_priority(meta: Optional[Dict], default: Optional[int] = None) -> Optional[int]:
+    """
+    Command priority from meta.priority, greater value - requests of command are served earlier by rate limiter
+    :param meta: command meta
+    :param default: priority if meta has no valid priority, e.g. AMQP message priority
+    :return:
+    """
+    if isinstance(meta, dict) and meta.get('priority') is not None:
+        try:
+            return int(meta['priority'])
+        except (TypeError, ValueError):
+            pass
+    return default
+
+
+def get_flow(meta: Optional[Dict], method: Optional[str]) -> str:
+    """
+    Fair share flow of command: meta.producer or entity of method, e.g. crm.deal.list -> crm.deal
+    :param meta: command meta
+    :param method: Bitrix24 method
+    :return:
+    """
+    if isinstance(meta, dict) and meta.get('producer'):
+        return str(meta['producer'])
+    return method.rsplit('.', 1)[0] if method else 'default'
+
+
+_method_labels: Optional[LabelValues] = None
+
+
+def get_method_label(method: Optional[str]) -> str:
+    """
+    Method of command as metrics label: METRICS_COMMAND_METHODS or first METRICS_COMMAND_METHODS_MAX methods,
+    any other method is labeled "other"
+    :param method: Bitrix24 method from command
+    :return:
+    """
+    global _method_labels
+    if _method_labels is None:
+        _method_labels = LabelValues(settings.METRICS_COMMAND_METHODS, settings.METRICS_COMMAND_METHODS_MAX)
+    return _method_labels(method)
+
+
+class RetryPolicy:
+    """
+    When and after what delay repeat request
+
+    Repeat request on retry HTTP codes, Bitrix24 temporary errors (e.g. QUERY_LIMIT_EXCEEDED)
+    and connection errors (empty response).
+    Delay - exponential backoff with full jitter, or Retry-After header value if response has it.
+    """
+
+    def __init__(self,
+                 max_count: int = 3,
+                 base_delay: float = 0.5,
+                 max_delay: float = 30,
+                 retry_codes: Union[Set, List] = RETRY_CODES,
+                 retry_errors: Union[Set, List] = RETRY_ERRORS,
+                 ):
+        """
+        :param max_count: max retries count for one request
+        :param base_delay: seconds, delay before first retry is random in [0, base_delay]
+        :param max_delay: seconds, max delay before retry
+        :param retry_codes: HTTP codes
+        :param retry_errors: Bitrix24 error codes
+        """
+        self.max_count = max_count
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_codes = retry_codes
+        self.retry_errors = retry_errors
+
+    def should_retry(self, response: Response) -> bool:
+        if response.status is None:
+            """
+            Connection error, request failed without response
+            """
+            return True
+
+        if response.status in self.retry_codes:
+            return True
+
+        return isinstance(response.data, dict) and response.data.get('error') in self.retry_errors
+
+    def get_delay(self, attempt: int, response: Optional[Response] = None) -> float:
+        """
+        :param attempt: retry number, starts from 0
+        :param response:
+        :return: seconds
+        """
+        retry_after = self.get_retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    @staticmethod
+    def get_retry_after(response: Optional[Response]) -> Optional[float]:
+        """
+        Retry-After header in seconds or HTTP-date format
+        """
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return None
+
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
 async def retry(
         async_func,
         args: Optional[List] = None,
         kwargs: Optional[Dict] = None,
         retry_codes: Union[Set, List] = RETRY_CODES,
-        max_count: int = 3
-) -> aiohttp.ClientResponse:
+        max_count: Optional[int] = None,
+        policy: Optional[RetryPolicy] = None,
+        budget: Optional[RetryBudget] = None,
+) -> Response:
     """
     Wrapper over api func,
-    :param max_count:
+    repeated requests pass rate limit of api driver as usual requests
+    :param max_count: used if policy is None
     :param async_func:
-    :param retry_codes:
+    :param retry_codes: used if policy is None
     :param args:
     :param kwargs:
+    :param policy: by default RetryPolicy with settings COMMAND_RETRY_*
+    :param budget: by default budget of current command
     :return:
     """
-    counter = 0
-    work = True
-    response = None
+    if policy is None:
+        policy = RetryPolicy(
+            max_count=settings.COMMAND_RETRY_MAX_COUNT if max_count is None else max_count,
+            base_delay=settings.COMMAND_RETRY_BASE_DELAY,
+            max_delay=settings.COMMAND_RETRY_MAX_DELAY,
+            retry_codes=retry_codes,
+        )
+
+    if budget is None:
+        budget = current_retry_budget.get()
 
     if not args:
         args = []
     if not kwargs:
         kwargs = {}
 
-    while work:
+    attempt = 0
+
+    while True:
         response = await async_func(
             *args,
             **kwargs
         )
-        if response.status in retry_codes and counter < max_count:
-            counter += 1
-        else:
-            work = False
+
+        if attempt >= policy.max_count or not policy.should_retry(response):
+            break
+
+        if budget is not None and not budget.take():
+            break
+
+        await asyncio.sleep(policy.get_delay(attempt, response))
+        attempt += 1
 
     return response
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key into one call,
+    all callers wait and get result of the first (in-flight) call
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.shared = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key: Hashable, async_func: Callable[..., Awaitable], *args, **kwargs) -> Any:
+        """
+        Call async_func or wait result of in-flight call with same key
+        :param key:
+        :param async_func:
+        :param args: async_func args
+        :param kwargs: async_func kwargs
+        :return: async_func result
+        """
+        future = self._calls.get(key)
+
+        if future is None:
+            self.calls += 1
+            future = asyncio.ensure_future(async_func(*args, **kwargs))
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._calls.pop(key, None))
+        else:
+            self.shared += 1
+
+        # cancel of one caller should not cancel call for others
+        return await asyncio.shield(future)
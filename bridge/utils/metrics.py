@@ -0,0 +1,298 @@
+"""
+Minimal in-process metrics in Prometheus text format
+
+Values are plain python numbers updated without locks (single event loop),
+labeled values are cached by label tuple, so hot path costs one dict lookup and one addition.
+"""
+import math
+import re
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+OTHER_LABEL = 'other'
+METHOD_NAME = re.compile(r'^[a-z][a-z0-9_]*(\.[a-z0-9_]+)*$')
+METHOD_NAME_MAX_LENGTH = 128
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    labels = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class CounterValue:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        Value is read on collect from counter of other object, e.g. cache hits
+        """
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+
+class GaugeValue:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        Value is calculated on collect, e.g. current rate limiter level
+        """
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+
+class HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    TYPE = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional['Registry'] = None):
+        """
+        :param name: metric name
+        :param documentation: HELP text
+        :param labelnames: label names, values are passed to labels() in the same order
+        :param registry: by default global REGISTRY
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        value = self._values.get(values)
+        if value is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            value = self._values[values] = self._new_value()
+        return value
+
+    def remove(self, *values: str) -> None:
+        self._values.pop(values, None)
+
+    def clear(self) -> None:
+        self._values.clear()
+
+    def collect(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.TYPE}",
+        ]
+        for values, value in list(self._values.items()):
+            lines.extend(self._collect_value(values, value))
+        return lines
+
+    def _collect_value(self, values: Tuple[str, ...], value) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def _new_value(self) -> CounterValue:
+        return CounterValue()
+
+    def _collect_value(self, values: Tuple[str, ...], value: CounterValue) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value.get())}"]
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def _new_value(self) -> GaugeValue:
+        return GaugeValue()
+
+    def _collect_value(self, values: Tuple[str, ...], value: GaugeValue) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value.get())}"]
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, registry: Optional['Registry'] = None):
+        """
+        :param buckets: upper bounds of buckets, +Inf is added
+        """
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_value(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def _collect_value(self, values: Tuple[str, ...], value: HistogramValue) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), value.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, f'le="{_format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(value.sum)}")
+        lines.append(f"{self.name}_count{labels} {value.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """
+        All metrics in Prometheus text exposition format
+        """
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+
+class LabelValues:
+    """
+    Bounds label values taken from untrusted input, e.g. method of command from AMQP message,
+    so typo or hostile input can't grow registry forever.
+
+    Values from `allowed` are kept, if `allowed` is empty first `max_count` well-formed
+    method names are kept, any other value is labeled `other`
+    """
+
+    def __init__(self, allowed: Iterable[str] = (), max_count: int = 200, other: str = OTHER_LABEL):
+        self.allowed: Set[str] = {value.lower() for value in allowed}
+        self.max_count = max_count
+        self.other = other
+        self.seen: Set[str] = set()
+
+    def __call__(self, value: Optional[str]) -> str:
+        if not value or len(value) > METHOD_NAME_MAX_LENGTH:
+            return self.other
+        """Bitrix24 methods are case-insensitive"""
+        value = value.lower()
+        if value in self.allowed or value in self.seen:
+            return value
+        if self.allowed or len(self.seen) >= self.max_count or not METHOD_NAME.match(value):
+            return self.other
+        self.seen.add(value)
+        return value
+
+
+REGISTRY = Registry()
+
+# CommandHandler.dispatch
+COMMAND_DURATION = Histogram(
+    'bridge_command_duration_seconds', 'Command processing time', ('action', 'method'),
+)
+COMMAND_ERRORS = Counter(
+    'bridge_command_errors_total', 'Commands failed with exception', ('action', 'method'),
+)
+
+# HttpDriver
+HTTP_REQUEST_DURATION = Histogram(
+    'bridge_http_request_duration_seconds', 'Bitrix24 HTTP request time', ('http_method',),
+)
+HTTP_RESPONSES = Counter(
+    'bridge_http_responses_total', 'Bitrix24 HTTP responses by status, error - connection error', ('status',),
+)
+
+# LimitRateDriverMixin
+RATE_LIMIT_WAIT = Histogram(
+    'bridge_rate_limit_wait_seconds', 'Time request waited free slot of rate limiter', ('key',),
+    buckets=(.001, .01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60),
+)
+RATE_LIMIT_LEVEL = Gauge(
+    'bridge_rate_limit_level', 'Rate limiter bucket occupancy', ('key',),
+)
+RATE_LIMIT_WAITING = Gauge(
+    'bridge_rate_limit_waiting', 'Requests waiting free slot of rate limiter', ('key',),
+)
+
+# ResponseCache
+CACHE_HITS = Counter(
+    'bridge_cache_hits_total', 'Responses served from cache', ('key',),
+)
+CACHE_MISSES = Counter(
+    'bridge_cache_misses_total', 'Cache lookups without fresh response', ('key',),
+)
+CACHE_EVICTIONS = Counter(
+    'bridge_cache_evictions_total', 'Responses evicted from full cache', ('key',),
+)
+CACHE_SIZE = Gauge(
+    'bridge_cache_size_bytes', 'Sum of cached responses size', ('key',),
+)
+CACHE_ENTRIES = Gauge(
+    'bridge_cache_entries', 'Count of cached responses', ('key',),
+)
+
+# AMQPHandler
+AMQP_COMMAND_LAG = Histogram(
+    'bridge_amqp_command_lag_seconds', 'Time from command consume to result publish', ('action',),
+)
+AMQP_COMMANDS_IN_FLIGHT = Gauge(
+    'bridge_amqp_commands_in_flight', 'Consumed commands, which results are not published yet', ('action',),
+)
@@ -1,9 +1,12 @@
 #!/bin/python
+import asyncio
+import logging
 
 import uvicorn
 import click
 
 from bridge.app import create_app
+from bridge.extensions import ext
 
 
 def create_core():
@@ -46,8 +49,67 @@ def debug(host: str = '0.0.0.0', port: int = 8000, log_level: str = 'info'):
     )
 
 
+@click.command()
+@click.option('--broker', type=click.Choice(['memory', 'rabbitmq']), default='memory',
+              help='memory - in-process broker and Bitrix24 simulator, rabbitmq - RABBITMQ_URL and running bridge')
+@click.option('--count', default=1000, help='Commands count')
+@click.option('--mix', default='list=1,batch=2,default=7', help='Workloads weights: list, batch, default')
+@click.option('--rate', default=0.0, help='Commands per second, 0 - publish all at once')
+@click.option('--batch-size', default=100, help='Sub commands in batch command')
+@click.option('--entity', default='crm.product', help='Entity of commands')
+@click.option('--items', default=1000, help='Entity items count (simulator), ids of get commands')
+@click.option('--timeout', default=60.0, help='Seconds to wait result of command')
+@click.option('--accept', default=None, help='Results format (meta.accept), e.g. application/msgpack')
+@click.option('--prefetch', default=None, type=int, help='memory: prefetch count, RABBITMQ_PREFETCH_COUNT by default')
+@click.option('--workers', default=None, type=int, help='memory: parallel commands, COMMAND_WORKERS by default')
+@click.option('--bucket-size', default=None, type=int, help='memory: portal burst, REQUESTS_BUCKET_SIZE by default')
+@click.option('--leak-rate', default=None, type=float, help='memory: portal rate, REQUESTS_LEAK_RATE by default')
+@click.option('--latency', default=0.0, help='memory: simulator request latency, seconds')
+def bench(broker: str, count: int, mix: str, rate: float, batch_size: int, entity: str, items: int, timeout: float,
+          accept: str, prefetch: int, workers: int, bucket_size: int, leak_rate: float, latency: float):
+    """
+    Load generator for AMQP path, reports end-to-end latency and throughput
+    """
+    # bench tools are not loaded by run and debug commands
+    from bridge.utils.bench import mix_commands, parse_mix, run_memory_bench, run_rabbitmq_bench
+
+    ext.logger = logging.getLogger('bitrix24-bridge-bench')
+
+    commands = mix_commands(parse_mix(mix), count, batch_size=batch_size, entity=entity, items_count=items)
+    if accept:
+        commands = [{**command, 'meta': {'accept': accept}} for command in commands]
+
+    if broker == 'memory':
+        result = asyncio.get_event_loop().run_until_complete(run_memory_bench(
+            commands, rate=rate, timeout=timeout, prefetch_count=prefetch, workers=workers,
+            bucket_size=bucket_size, leak_rate=leak_rate, entities={entity: items}, latency=latency,
+        ))
+    else:
+        result = asyncio.get_event_loop().run_until_complete(run_rabbitmq_bench(
+            commands, rate=rate, timeout=timeout,
+        ))
+
+    click.echo(result.report())
+    click.echo(f"p90 {result.percentile(90) * 1000:.1f} ms, p99.9 {result.percentile(99.9) * 1000:.1f} ms")
+
+
+
+@click.command('bench-encode')
+@click.option('--calls', default=50, help='Sub commands in batch')
+@click.option('--filter-size', default=1000, help='Count of IDs in filter of sub commands')
+def bench_encode(calls: int, filter_size: int):
+    """
+    Encoding speed of list() sub commands
+    """
+    from bridge.utils.bench import run_encode_bench
+
+    for name, ms in run_encode_bench(calls_count=calls, filter_size=filter_size).items():
+        click.echo(f"{name}: {ms:.2f} ms per batch")
+
 cli.add_command(run)
 cli.add_command(debug)
+cli.add_command(bench)
+cli.add_command(bench_encode)
 
 if __name__ == "__main__":
     cli()